@@ -1,6 +1,11 @@
 import subprocess
 import os
+import shutil
+from tools import manifest
+from utils import cube_store, kernels
 from tools.retrieve_data import retrieve_input_data, access_local_data
+from tools.archive_cache import ArchiveCache
+from tools.crowdsource_archive import CrowdsourceArchive
 from tools.main_expertise import make_expertise
 
 DIR = os.path.abspath(os.path.dirname(__file__))
@@ -60,6 +65,86 @@ def run_expertise(
      Whether to use OpenStreetMap data for the individual file maps. Default is False.
      - make_kml_file: bool, optional
      Whether to generate a KML file for the region of interest. Default is False.
+     - n_workers: int, optional
+     Number of days that are retrieved concurrently. Default is 1 (serial).
+     - copy_archive: bool, optional
+     Whether to keep a local copy of the daily zip files. By default the
+     needed members are extracted straight from the archive.
+     - cache_dir: str, optional
+     Directory of a cache of daily zip files shared between expertises, so
+     that the archive is read only once per day. Default is None (no cache).
+     - cache_size: float, optional
+     Size budget of the cache in GB, least recently used files are removed
+     first. Default is 50.
+     - crowdsource_archive: str, optional
+     Directory of an archive of the crowdsourced hail reports partitioned by
+     day and shared between expertises (tools.crowdsource_archive). The
+     reports of the event are added to it and read from it. Default is None.
+     - incremental: bool, optional
+     Whether to only decode the timesteps that are missing in an existing
+     totalroi.bin of the output folder (e.g. after extending end_time) and
+     append them. If False the cube is decoded again. Default is True.
+     - decoder: str, optional
+     "pexp" (default) decodes the 5-min files with the pexp binary into
+     totalroi.bin, "python" decodes HDF5 files in-process (utils.decoder),
+     without subprocess and temporary files.
+     - decode_workers: int, optional
+     Number of processes used by the python decoder, decoding into a cube
+     in shared memory. Default is 1.
+     - decode_chunksize: int, optional
+     Number of consecutive 5-min files per task of a decoding process.
+     Default spreads the files over four tasks per process.
+     - mmap: bool, optional
+     Whether to memory-map totalroi.bin instead of loading it completely,
+     keeping memory use close to the parts that are accessed. Default is False.
+     - quantized: bool, optional
+     Whether the python decoder keeps the cube as 8-bit class indices of
+     the color scale (1 byte per pixel), converted to mm/h block by block
+     when it is used. Default is False.
+     - stream: bool, optional
+     Whether to compute the precipitation aggregates in a single pass over
+     the time steps, so that memory grows with the region of interest
+     instead of the whole domain. Default is False.
+     - regions: list, optional
+     (name, regionRectangle) of several regions of interest of the same
+     event, e.g. all catchments hit by a storm. The data is retrieved and
+     decoded once and the output of every region is written to a folder
+     named after the region. Replaces name and regionRectangle.
+     Default is None.
+     - catchments: str, optional
+     Shapefile or GeoJSON with polygons (e.g. catchments) to analyse as
+     regions of interest, added to regions. Areal means are weighted by the
+     fraction of every 1 km cell covered by a polygon (utils.catchment).
+     Default is None.
+     - catchment_field: str, optional
+     Attribute holding the names of the polygons in catchments, which name
+     the output folders. Default is None (numbered by their index).
+     - durations: list, optional
+     Durations in minutes, e.g. [60, 180, 360, 1440, 2880], for which the
+     maximum accumulation per pixel and of the region mean (with the time
+     of the maximum) are added to the summary files. Default is None.
+     - kernels: str, optional
+     Implementation of the reductions over the cube (utils.kernels),
+     "numba" for parallel kernels on all cores or "numpy". Default is the
+     EXPERTISE_KERNELS environment variable, or "numba".
+     - cube_store: bool, optional
+     Whether to convert totalroi.bin decoded by pexp into a chunked,
+     zlib-compressed totalroi.nc (utils.cube_store), from which only the
+     chunks of the region are read. Default is False.
+     - store_chunks: tuple, optional
+     Chunk size of totalroi.nc as (time steps, rows, columns).
+     Default is (12, 64, 64).
+     - store_complevel: int, optional
+     Compression level of totalroi.nc (1-9). Default is 4.
+     - hail_swath: bool, optional
+     Whether to write the hail swath over the whole domain (maximum POH,
+     first hit and duration above thresholds) from the 5-min POH files,
+     which requires POHSingleFiles. Default is False.
+     - swath_window: tuple, optional
+     (start, end) of the hail swath, e.g. ("2023-07-24T14:00",
+     "2023-07-24T19:00"). Default is None (the whole period).
+     - swath_thresholds: list, optional
+     POH thresholds of the hail swath. Default is [0.8].
 
     Returns:
     --------
@@ -81,6 +166,125 @@ def run_expertise(
     else:
         POHSingleFiles = False
 
+    if "n_workers" in opt_kwargs.keys():
+        n_workers = opt_kwargs["n_workers"]
+    else:
+        n_workers = 1
+
+    if "copy_archive" in opt_kwargs.keys():
+        copy_archive = opt_kwargs["copy_archive"]
+    else:
+        copy_archive = False
+
+    if "cache_dir" in opt_kwargs.keys() and opt_kwargs["cache_dir"] is not None:
+        if "cache_size" in opt_kwargs.keys():
+            cache_size = opt_kwargs["cache_size"]
+        else:
+            cache_size = 50
+        cache = ArchiveCache(opt_kwargs["cache_dir"], max_bytes=cache_size * 1024**3)
+    else:
+        cache = None
+
+    if (
+        "crowdsource_archive" in opt_kwargs.keys()
+        and opt_kwargs["crowdsource_archive"] is not None
+    ):
+        crowd_archive = CrowdsourceArchive(opt_kwargs["crowdsource_archive"])
+    else:
+        crowd_archive = None
+
+    if "incremental" in opt_kwargs.keys():
+        incremental = opt_kwargs["incremental"]
+    else:
+        incremental = True
+
+    if "decoder" in opt_kwargs.keys():
+        decoder_name = opt_kwargs["decoder"]
+    else:
+        decoder_name = "pexp"
+
+    if "decode_workers" in opt_kwargs.keys():
+        decode_workers = opt_kwargs["decode_workers"]
+    else:
+        decode_workers = 1
+
+    if "decode_chunksize" in opt_kwargs.keys():
+        decode_chunksize = opt_kwargs["decode_chunksize"]
+    else:
+        decode_chunksize = None
+
+    if "mmap" in opt_kwargs.keys():
+        mmap = opt_kwargs["mmap"]
+    else:
+        mmap = False
+
+    if "quantized" in opt_kwargs.keys():
+        quantized = opt_kwargs["quantized"]
+    else:
+        quantized = False
+
+    if "stream" in opt_kwargs.keys():
+        stream = opt_kwargs["stream"]
+    else:
+        stream = False
+
+    if "regions" in opt_kwargs.keys():
+        regions = opt_kwargs["regions"]
+    else:
+        regions = None
+
+    if "catchments" in opt_kwargs.keys() and opt_kwargs["catchments"] is not None:
+        from utils import catchment
+
+        if "catchment_field" in opt_kwargs.keys():
+            catchment_field = opt_kwargs["catchment_field"]
+        else:
+            catchment_field = None
+        regions = list(regions or []) + catchment.load_catchments(
+            opt_kwargs["catchments"], name_field=catchment_field
+        )
+
+    if "durations" in opt_kwargs.keys():
+        durations = opt_kwargs["durations"]
+    else:
+        durations = None
+
+    if "kernels" in opt_kwargs.keys():
+        kernels.set_backend(opt_kwargs["kernels"])
+
+    if "hail_swath" in opt_kwargs.keys():
+        hail_swath = opt_kwargs["hail_swath"]
+    else:
+        hail_swath = False
+    if hail_swath and not POHSingleFiles:
+        print("The hail swath needs the 5-min POH files, set POHSingleFiles")
+        hail_swath = False
+
+    if "swath_window" in opt_kwargs.keys():
+        swath_window = opt_kwargs["swath_window"]
+    else:
+        swath_window = None
+
+    if "swath_thresholds" in opt_kwargs.keys():
+        swath_thresholds = opt_kwargs["swath_thresholds"]
+    else:
+        swath_thresholds = None
+
+    if "cube_store" in opt_kwargs.keys():
+        use_store = opt_kwargs["cube_store"]
+    else:
+        use_store = False
+
+    if "store_chunks" in opt_kwargs.keys():
+        store_chunks = opt_kwargs["store_chunks"]
+    else:
+        store_chunks = cube_store.CHUNKS
+
+    if "store_complevel" in opt_kwargs.keys():
+        store_complevel = opt_kwargs["store_complevel"]
+    else:
+        store_complevel = 4
+
     # 1. Retrieve input
 
     # 1a. Retrieve and extract from meteoswiss environment or CSCS
@@ -98,6 +302,10 @@ def run_expertise(
             prd=product,
             get_daily_POH=POHfiles,
             get_single_POH=POHSingleFiles,
+            n_workers=n_workers,
+            copy_archive=copy_archive,
+            cache=cache,
+            crowd_archive=crowd_archive,
         )
     # 1b. Use copied files from own folder.
     else:
@@ -109,26 +317,55 @@ def run_expertise(
             output_dir=file_dir,
             get_daily_POH=POHfiles,
             get_single_POH=POHSingleFiles,
+            n_workers=n_workers,
+            copy_archive=copy_archive,
+            cache=cache,
+            crowd_archive=crowd_archive,
         )
         print("zip files from a given path are used")
 
     os.chdir(outDir)
 
-    # 2. run the shell script using subprocess.run
-    if os.path.exists(os.path.join(outDir, "totalroi.bin")) and os.path.exists(
-        os.path.join(outDir, "totalroi.json")
-    ):
-        print("totalroi already exists in this folder")
+    # 2. run the shell script using subprocess.run, only for the timesteps
+    # that are not yet in totalroi.bin. The python decoder reads the files
+    # directly in make_expertise.
+    if decoder_name == "pexp":
+        frames, missing, append = manifest.plan_decoding(outDir, product)
+        if not missing:
+            print("totalroi already exists in this folder")
 
-    else:
-        bashCommand = f"{DIR}/expertise.sh {DIR} {outDir} {product}"
-        result = subprocess.run([bashCommand], shell=True, check=True)
+        elif append and incremental:
+            print(f"totalroi is extended with {len(missing)} timesteps")
+            partDir = os.path.join(outDir, "increment")
+            if os.path.exists(partDir):
+                shutil.rmtree(partDir)
+            os.makedirs(os.path.join(partDir, product))
+            for frame in missing:
+                os.symlink(
+                    os.path.join(outDir, product, frame),
+                    os.path.join(partDir, product, frame),
+                )
+            _run_pexp(partDir, product)
+            if os.path.exists(os.path.join(outDir, "totalroi.bin")):
+                manifest.append_totalroi(outDir, partDir)
+            else:
+                cube_store.append_bin_to_cube_store(outDir, partDir, missing)
+            shutil.rmtree(partDir)
 
-        # check the return code of the script
-        if result.returncode == 0:
-            print("Script ran successfully")
         else:
-            print("Script failed with return code {}".format(result.returncode))
+            # invalidate the manifest until the new cube is completely written
+            manifest.update_manifest(outDir, prd=product, decoded=[])
+            if os.path.exists(os.path.join(outDir, cube_store.STORE)):
+                os.remove(os.path.join(outDir, cube_store.STORE))
+            _run_pexp(outDir, product)
+
+        if use_store and os.path.exists(os.path.join(outDir, "totalroi.bin")):
+            print("totalroi.bin is converted to totalroi.nc")
+            cube_store.bin_to_cube_store(
+                outDir, frames, chunks=store_chunks, complevel=store_complevel
+            )
+
+        manifest.update_manifest(outDir, prd=product, decoded=frames)
 
     if "singleFiles" in opt_kwargs.keys():
         singleFiles = opt_kwargs["singleFiles"]
@@ -175,4 +412,30 @@ def run_expertise(
         useOsmSingleFiles,
         make_kml_file,
         *rg_args,
+        decoder_name=decoder_name,
+        decode_workers=decode_workers,
+        decode_chunksize=decode_chunksize,
+        mmap=mmap,
+        quantized=quantized,
+        stream=stream,
+        regions=regions,
+        durations=durations,
+        hail_swath=hail_swath,
+        swath_window=swath_window,
+        swath_thresholds=swath_thresholds,
     )
+
+
+def _run_pexp(outDir, product):
+    """
+    Decode all 5-min files in {outDir}/{product} into totalroi.bin
+     and totalroi.json in outDir.
+    """
+    bashCommand = f"{DIR}/expertise.sh {DIR} {outDir} {product}"
+    result = subprocess.run([bashCommand], shell=True, check=True, cwd=outDir)
+
+    # check the return code of the script
+    if result.returncode == 0:
+        print("Script ran successfully")
+    else:
+        print("Script failed with return code {}".format(result.returncode))
@@ -0,0 +1,291 @@
+"""
+Single-pass accumulation of the precipitation aggregates of a region,
+consuming the cube one time step at a time
+"""
+import numpy as np
+
+from utils import open_data
+from utils.transformation import coordx2ind, coordy2ind
+from utils.validity import ValidityMask
+
+# time steps consumed at once by RegionsAccumulator in a streaming pass
+STREAM_STEPS = 12
+
+
+class PrecipAccumulator(object):
+    """
+    Running aggregates of the precipitation over the domain and a region of
+     interest. Only the domain sum and the region of interest are kept, so
+     memory is O(frame + ROI x time) instead of O(domain x time).
+
+    Attributes:
+    -----------
+    prd: str
+     The product, "AQC" is accumulated without the 5-min to mm conversion.
+    n_steps: int
+     Number of time steps consumed so far.
+    domainSum: ndarray
+     Running sum (mm/h) over time of the whole domain, missing values
+     counted as 0.
+    validity: ValidityMask
+     Valid values of the consumed time steps, filled one frame at a time.
+    totalRoi: ndarray
+     (y, x, time) precipitation (mm/h) over the region of interest,
+     missing values set to 0.
+    intensity: ndarray
+     Average intensity (mm/h) over the region of interest per time step.
+    roiSum: ndarray
+     Sum (mm/h) over the region of interest per time step.
+    """
+
+    def __init__(self, rectangle, shape, n_steps, prd="RZC", weights=None):
+        """
+        Initializes the accumulator
+
+        Args:
+        -----
+        rectangle: ndarray
+         Bounds of the region as (xmin, xmax, ymin, ymax).
+        shape: tuple
+         (y, x) shape of the domain.
+        n_steps: int
+         Number of time steps that will be consumed.
+        prd: str, optional
+         The product. Default is "RZC".
+        weights: ndarray, optional
+         Weight of every cell of the region of interest, e.g. the covered
+         fraction of a polygon (RegionInfo.weights). Default is None
+         (all cells count fully).
+        """
+        self.prd = prd
+        self.weights = weights
+        self.rows = slice(coordy2ind(rectangle[3]), coordy2ind(rectangle[2]))
+        self.cols = slice(coordx2ind(rectangle[0]), coordx2ind(rectangle[1]))
+        roiShape = np.empty(shape, dtype=bool)[self.rows, self.cols].shape
+
+        self.n_steps = 0
+        self.domainSum = np.zeros(shape, dtype=np.float64)
+        self.validity = ValidityMask.empty(tuple(shape) + (n_steps,))
+        self.totalRoi = np.empty(roiShape + (n_steps,), dtype=np.float32)
+        self.intensity = np.empty(n_steps, dtype=np.float64)
+        self.roiSum = np.empty(n_steps, dtype=np.float64)
+
+    def add(self, frame):
+        """
+        Consume the next time step.
+
+        Args:
+        -----
+        frame: ndarray
+         (y, x) precipitation (mm/h) of the domain, missing values negative.
+
+        Returns:
+        --------
+        None
+        """
+        t = self.n_steps
+        valid = frame >= 0
+        self.validity.set_frame(t, valid)
+        self.domainSum += np.where(valid, frame, 0)
+        roi = self.totalRoi[:, :, t]
+        roi[:] = np.where(valid[self.rows, self.cols], frame[self.rows, self.cols], 0)
+        if self.weights is None:
+            self.intensity[t] = np.mean(roi)
+            self.roiSum[t] = np.sum(roi)
+        else:
+            self.roiSum[t] = np.sum(self.weights * roi)
+            self.intensity[t] = self.roiSum[t] / np.sum(self.weights)
+        self.n_steps += 1
+
+    def add_block(self, block):
+        """
+        Consume consecutive time steps.
+
+        Args:
+        -----
+        block: ndarray
+         (y, x, n) precipitation (mm/h) of the domain, missing values negative.
+
+        Returns:
+        --------
+        None
+        """
+        for i in range(block.shape[2]):
+            self.add(block[:, :, i])
+
+    def finish(self, surfacekm2):
+        """
+        Derive the aggregates of RegionInfo.fetch_precip_data.
+
+        Args:
+        -----
+        surfacekm2: float
+         Surface of the region of interest in km2.
+
+        Returns:
+        --------
+        aggregates: dict
+         validity, totalSum, totalRoi, totalSumRoiS, intensityOverTime and
+         sumOverTime as set by RegionInfo.fetch_precip_data.
+        """
+        totalRoi = self.totalRoi[:, :, : self.n_steps]
+        roiSum = self.roiSum[: self.n_steps]
+        totalSum = self.domainSum.astype(np.float32)
+        totalSum[self.validity.count() == 0] = np.nan
+        if self.prd != "AQC":
+            totalSum /= 12.0
+            roiSum = roiSum / 12.0
+
+        totalSumRoiS = open_data.get_totalSumRois(totalRoi, self.prd)
+        if self.weights is not None:
+            totalSumRoiS[self.weights == 0] = np.nan
+
+        return {
+            "validity": self.validity,
+            "totalSum": totalSum,
+            "totalRoi": totalRoi,
+            "totalSumRoiS": totalSumRoiS,
+            "intensityOverTime": self.intensity[: self.n_steps],
+            "sumOverTime": np.cumsum(roiSum) / np.array(surfacekm2),
+        }
+
+
+class RegionsAccumulator(object):
+    """
+    Running aggregates of several regions of interest, as PrecipAccumulator
+     for one region. The time series of all regions are reduced together:
+     the box around all regions is cut from every block of time steps and
+     reduced for all of them with one sparse matrix product.
+
+    Attributes:
+    -----------
+    n_steps: int
+     Number of time steps consumed so far.
+    domainSum: ndarray
+     Running sum (mm/h) over time of the whole domain, missing values
+     counted as 0, accumulated by add_block.
+    validity: ValidityMask
+     Valid values of the consumed time steps, filled by add_block.
+    totalRois: list
+     (y, x, time) precipitation (mm/h) over every region of interest,
+     missing values set to 0.
+    roiSums: ndarray
+     (region, time) weighted sum (mm/h) over every region of interest.
+    """
+
+    def __init__(self, bounds, weights, shape, n_steps):
+        """
+        Initializes the accumulator
+
+        Args:
+        -----
+        bounds: ndarray
+         (region, 4) index bounds (y0, y1, x0, x1) of every region.
+        weights: csr_matrix
+         (region, pixels of the box) weight of every pixel of the box
+         around all regions in every region.
+        shape: tuple
+         (y, x) shape of the domain.
+        n_steps: int
+         Number of time steps that will be consumed.
+        """
+        self.bounds = bounds
+        self.weights = weights
+        self.box = (
+            slice(bounds[:, 0].min(), bounds[:, 1].max()),
+            slice(bounds[:, 2].min(), bounds[:, 3].max()),
+        )
+        self.n_steps = 0
+        self.domainSum = np.zeros(shape, dtype=np.float64)
+        self.validity = ValidityMask.empty(tuple(shape) + (n_steps,))
+        self.totalRois = [
+            np.empty((y1 - y0, x1 - x0, n_steps), dtype=np.float32)
+            for y0, y1, x0, x1 in bounds
+        ]
+        self.roiSums = np.empty((len(bounds), n_steps), dtype=np.float64)
+
+    def add_block(self, block):
+        """
+        Consume consecutive time steps of the whole domain.
+
+        Args:
+        -----
+        block: ndarray
+         (y, x, n) precipitation (mm/h) of the domain, missing values negative.
+
+        Returns:
+        --------
+        valid: ndarray
+         (y, x, n) mask of the valid values of block, e.g. for the other
+         consumers of the same pass.
+        """
+        valid = block >= 0
+        for i in range(block.shape[2]):
+            self.validity.set_frame(self.n_steps + i, valid[:, :, i])
+        block = np.where(valid, block, np.float32(0))
+        self.domainSum += np.sum(block, axis=2)
+        self.add_box(block[self.box])
+        return valid
+
+    def add_box(self, box):
+        """
+        Consume consecutive time steps of the box around all regions only,
+         e.g. when the domain sum is computed otherwise.
+
+        Args:
+        -----
+        box: ndarray
+         (y, x, n) precipitation (mm/h) of the box, missing values set to 0.
+
+        Returns:
+        --------
+        None
+        """
+        start, stop = self.n_steps, self.n_steps + box.shape[2]
+        self.roiSums[:, start:stop] = self.weights @ box.reshape(-1, box.shape[2])
+        y0, x0 = self.box[0].start, self.box[1].start
+        for totalRoi, (ya, yb, xa, xb) in zip(self.totalRois, self.bounds):
+            totalRoi[:, :, start:stop] = box[ya - y0 : yb - y0, xa - x0 : xb - x0]
+        self.n_steps = stop
+
+    def totalSum(self):
+        """
+        Sum (mm/h) over time of the whole domain, NaN where no time step
+         is valid.
+        """
+        totalSum = self.domainSum.astype(np.float32)
+        totalSum[self.validity.count() == 0] = np.nan
+        return totalSum
+
+
+def accumulate_precip(totalDomain, rectangle, surfacekm2, prd="RZC", weights=None):
+    """
+    Compute all precipitation aggregates of a region in one pass over
+     a lazily read cube, one time step at a time.
+
+    Args:
+    -----
+    totalDomain: LazyCube
+     (y, x, time) cube that is read on access, e.g. from
+     open_data.get_totalDomain(mmap=True) or utils.decoder.lazy_precip.
+    rectangle: ndarray
+     Bounds of the region as (xmin, xmax, ymin, ymax).
+    surfacekm2: float
+     Surface of the region of interest in km2.
+    prd: str, optional
+     The product. Default is "RZC".
+    weights: ndarray, optional
+     Weight of every cell of the region of interest. Default is None.
+
+    Returns:
+    --------
+    aggregates: dict
+     validity, totalSum, totalRoi, totalSumRoiS, intensityOverTime and
+     sumOverTime.
+    """
+    acc = PrecipAccumulator(
+        rectangle, totalDomain.shape[:2], totalDomain.shape[2], prd, weights=weights
+    )
+    for __, frame in totalDomain.iter_chunks(size=1):
+        acc.add_block(frame)
+    return acc.finish(surfacekm2)
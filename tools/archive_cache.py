@@ -0,0 +1,174 @@
+"""
+Shared on-disk cache for daily archive files (RZC, CPC, BZC, dBZCH zips)
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ArchiveCache(object):
+    """
+    Content-addressed cache of daily zip files retrieved from the archive.
+     An entry is identified by product, YYDOY and the size and modification
+     time of the source file, so a reprocessed archive file is fetched again.
+     The cache is shared between jobs and processes: entries are published
+     atomically and eviction runs under a file lock.
+
+    Attributes:
+    -----------
+    cache_dir: str
+     Directory where the cached zip files are stored.
+    max_bytes: int
+     Size budget of the cache. Least recently used entries are removed
+     once the cache grows beyond it.
+    min_age: float
+     Entries used within the last min_age seconds are never evicted,
+     as another job may be reading them.
+    """
+
+    def __init__(self, cache_dir, max_bytes=50 * 1024**3, min_age=600):
+        """
+        Initializes the cache
+
+        Args:
+        -----
+        cache_dir: str
+         Directory where the cached zip files are stored, created if needed.
+        max_bytes: int, optional
+         Size budget of the cache in bytes. Default is 50 GB.
+        min_age: float, optional
+         Seconds during which a used entry is protected from eviction.
+         Default is 600.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.min_age = min_age
+        self._thread_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, src, prd, YYDOY):
+        """
+        Key of the cache entry for a source file.
+
+        Args:
+        -----
+        src: str
+         Path to the file in the archive.
+        prd: str
+         Product stored in the file.
+        YYDOY: str
+         Day stored in the file.
+
+        Returns:
+        --------
+        key: str
+         Hash of product, day, size and modification time of src.
+        """
+        stat = os.stat(src)
+        ident = f"{prd}|{YYDOY}|{stat.st_size}|{stat.st_mtime_ns}"
+        return hashlib.sha1(ident.encode()).hexdigest()[:16]
+
+    def fetch(self, src, prd, YYDOY):
+        """
+        Return a local path holding the content of src, copying it into
+         the cache on the first request.
+
+        Args:
+        -----
+        src: str
+         Path to the file in the archive.
+        prd: str
+         Product stored in the file.
+        YYDOY: str
+         Day stored in the file.
+
+        Returns:
+        --------
+        path: str
+         Path to the cached copy of src.
+        """
+        path = os.path.join(
+            self.cache_dir, f"{prd}{YYDOY}-{self.key(src, prd, YYDOY)}.zip"
+        )
+        try:
+            # touching the entry protects it from eviction for min_age
+            os.utime(path)
+        except FileNotFoundError:
+            # not cached, or evicted by another job meanwhile
+            pass
+        else:
+            print(f"{prd} {YYDOY} taken from cache")
+            return path
+
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        self._evict(keep=path)
+        return path
+
+    def size(self):
+        """
+        Total size of the cached files in bytes.
+        """
+        return sum(size for __, __, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".zip"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _evict(self, keep=None):
+        with file_lock(os.path.join(self.cache_dir, ".lock"), self._thread_lock):
+            entries = sorted(self._entries())
+            total = sum(size for __, __, size in entries)
+            now = time.time()
+            for mtime, path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep or now - mtime < self.min_age:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+@contextmanager
+def file_lock(path, thread_lock):
+    """
+    Exclusive lock held by one thread of one process at a time: the
+     threads of this process wait on thread_lock, the other processes
+     (e.g. other jobs) on fcntl.flock of the file path.
+
+    Args:
+    -----
+    path: str
+     Lock file, created if needed.
+    thread_lock: threading.Lock
+     Lock shared by the threads of this process.
+    """
+    with thread_lock:
+        with open(path, "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
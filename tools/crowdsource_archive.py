@@ -0,0 +1,318 @@
+"""
+Persistent archive of the crowdsourced hail reports, partitioned by day
+"""
+import json
+import os
+import re
+import threading
+import numpy as np
+
+from utils import crowdsource
+from tools.archive_cache import file_lock
+
+# where the daily HQX{YYDOY}0000.prd files are delivered
+HQX_DIR = "/store/msrad/crowdsourcing/hail/HQX"
+
+_HQX_NAME = re.compile(r"HQX(\d{5})0000\.prd$")
+
+
+def _day(YYDOY):
+    # first second of the day YYDOY
+    return (
+        np.datetime64(f"20{YYDOY[:2]}-01-01", "D")
+        + np.timedelta64(int(YYDOY[2:]) - 1, "D")
+    ).astype("datetime64[s]")
+
+
+def _empty():
+    return {
+        "time": np.array([], dtype="datetime64[s]"),
+        "xcoord": np.array([]),
+        "ycoord": np.array([]),
+        "hailsize": np.array([]),
+    }
+
+
+class CrowdsourceArchive(object):
+    """
+    Columnar store of the hail reports of several years, shared between
+     jobs. Every day is one partition, {root}/{YYYY}/{YYDOY}.npz, holding the
+     arrays of its reports in LV95 sorted by time. A catalog records per day
+     the source .prd file (size and modification time), the number of
+     reports and their time span and bounds, so a query opens only the
+     partitions that can hold reports of its region and time window, and an
+     update parses only the .prd files that are new or changed. The catalog
+     is read again when another job has changed it.
+
+    Attributes:
+    -----------
+    root: str
+     Directory of the archive.
+    catalog: dict
+     Per YYDOY the entry {"source", "size", "mtime", "n", "start", "end",
+     "bounds"} of its partition, bounds being (xmin, xmax, ymin, ymax).
+    """
+
+    def __init__(self, root):
+        """
+        Initializes the archive
+
+        Args:
+        -----
+        root: str
+         Directory of the archive, created if needed.
+        """
+        self.root = root
+        self._thread_lock = threading.Lock()
+        self._catalog_stat = None
+        os.makedirs(self.root, exist_ok=True)
+        self.catalog = self._read_catalog()
+
+    @property
+    def catalog_path(self):
+        return os.path.join(self.root, "catalog.json")
+
+    def partition_path(self, YYDOY):
+        return os.path.join(self.root, "20" + YYDOY[:2], YYDOY + ".npz")
+
+    def __len__(self):
+        self._refresh()
+        return sum(entry["n"] for entry in self.catalog.values())
+
+    def _stat_catalog(self):
+        # the catalog is replaced atomically, a new inode means a new version
+        try:
+            stat = os.stat(self.catalog_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino)
+
+    def _read_catalog(self):
+        self._catalog_stat = self._stat_catalog()
+        if self._catalog_stat is None:
+            return {}
+        with open(self.catalog_path) as f:
+            return json.load(f)
+
+    def _refresh(self):
+        # partitions added by other jobs since the catalog was read
+        if self._stat_catalog() != self._catalog_stat:
+            self.catalog = self._read_catalog()
+
+    def add_day(self, YYDOY, src):
+        """
+        Store the reports of a .prd file as the partition of a day, unless
+         the partition was already built from the same file.
+
+        Args:
+        -----
+        YYDOY: str
+         The day of the reports.
+        src: str
+         Path of the .prd file.
+
+        Returns:
+        --------
+        added: bool
+         False if the partition was up to date.
+        """
+        stat = os.stat(src)
+        self._refresh()
+        entry = self.catalog.get(YYDOY)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime_ns
+            and os.path.exists(self.partition_path(YYDOY))
+        ):
+            return False
+
+        reports = crowdsource.parse_prd(src)
+        reports["xcoord"], reports["ycoord"] = crowdsource.lv03_to_lv95(
+            reports["xcoord"], reports["ycoord"]
+        )
+        order = np.argsort(reports["time"], kind="stable")
+        reports = {key: value[order] for key, value in reports.items()}
+
+        path = self.partition_path(YYDOY)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp, **reports)
+        os.replace(tmp, path)
+
+        n = len(reports["time"])
+        entry = {
+            "source": os.path.abspath(src),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "n": n,
+            "start": str(reports["time"][0]) if n else None,
+            "end": str(reports["time"][-1]) if n else None,
+            "bounds": [
+                float(reports["xcoord"].min()),
+                float(reports["xcoord"].max()),
+                float(reports["ycoord"].min()),
+                float(reports["ycoord"].max()),
+            ]
+            if n
+            else None,
+        }
+        with file_lock(os.path.join(self.root, ".lock"), self._thread_lock):
+            # merge with the entries written by other jobs meanwhile
+            self.catalog = self._read_catalog()
+            self.catalog[YYDOY] = entry
+            tmp = f"{self.catalog_path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.catalog, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.catalog_path)
+            self._catalog_stat = self._stat_catalog()
+        return True
+
+    def update(self, source_dir=HQX_DIR, start=None, end=None):
+        """
+        Add the new or changed HQX{YYDOY}0000.prd files of a directory.
+
+        Args:
+        -----
+        source_dir: str, optional
+         Directory of the .prd files. Default is HQX_DIR.
+        start: datetime64, optional
+         First day to add. Default is None (from the first file).
+        end: datetime64, optional
+         Last day to add, included. Default is None (to the last file).
+
+        Returns:
+        --------
+        added: list
+         The YYDOY of the partitions that were (re)built.
+        """
+        added = []
+        for name in sorted(os.listdir(source_dir)):
+            match = _HQX_NAME.match(name)
+            if match is None:
+                continue
+            YYDOY = match.group(1)
+            day = _day(YYDOY)
+            if start is not None and day < np.datetime64(start, "D"):
+                continue
+            if end is not None and day > np.datetime64(end, "D"):
+                continue
+            if self.add_day(YYDOY, os.path.join(source_dir, name)):
+                print(f"crowdsource reports of {YYDOY} added to the archive")
+                added.append(YYDOY)
+        return added
+
+    def days(self, rectangle=None, start=None, end=None):
+        """
+        Days whose partition may hold reports in a region and time window,
+         according to the catalog.
+
+        Args:
+        -----
+        rectangle: list, optional
+         Bounds (xmin, xmax, ymin, ymax). Default is None.
+        start: datetime64, optional
+         Start of the window. Default is None.
+        end: datetime64, optional
+         End of the window, included. Default is None.
+
+        Returns:
+        --------
+        YYDOYS: list
+         Sorted YYDOY strings.
+        """
+        self._refresh()
+        days = []
+        for YYDOY, entry in sorted(self.catalog.items()):
+            if entry["n"] == 0:
+                continue
+            if start is not None and np.datetime64(entry["end"]) < np.datetime64(start, "s"):
+                continue
+            if end is not None and np.datetime64(entry["start"]) > np.datetime64(end, "s"):
+                continue
+            if rectangle is not None:
+                xmin, xmax, ymin, ymax = entry["bounds"]
+                if (
+                    xmax < rectangle[0]
+                    or xmin > rectangle[1]
+                    or ymax < rectangle[2]
+                    or ymin > rectangle[3]
+                ):
+                    continue
+            days.append(YYDOY)
+        return days
+
+    def query(self, rectangle=None, geometry=None, start=None, end=None):
+        """
+        Reports within a region and a time window, reading only the
+         partitions selected by days.
+
+        Args:
+        -----
+        rectangle: list, optional
+         Bounds (xmin, xmax, ymin, ymax) in LV95, included. Default is None.
+        geometry: shapely.Geometry, optional
+         Polygon in LV95, the reports inside it are selected.
+         Default is None.
+        start: datetime64, optional
+         Time of the first report. Default is None.
+        end: datetime64, optional
+         Time of the last report, included. Default is None.
+
+        Returns:
+        --------
+        reports: dict
+         Arrays "time" (datetime64[s]), "xcoord" and "ycoord" (m, LV95) and
+         "hailsize", sorted by time.
+        """
+        if geometry is not None and rectangle is None:
+            xmin, ymin, xmax, ymax = geometry.bounds
+            rectangle = (xmin, xmax, ymin, ymax)
+
+        parts = []
+        for YYDOY in self.days(rectangle, start, end):
+            with np.load(self.partition_path(YYDOY)) as npz:
+                time = npz["time"]
+                t0, t1 = 0, len(time)
+                if start is not None:
+                    t0 = np.searchsorted(time, np.datetime64(start, "s"))
+                if end is not None:
+                    t1 = np.searchsorted(time, np.datetime64(end, "s"), side="right")
+                day = {key: npz[key][t0:t1] for key in npz.files}
+            if rectangle is not None:
+                x, y = day["xcoord"], day["ycoord"]
+                inside = (
+                    (x >= rectangle[0])
+                    & (x <= rectangle[1])
+                    & (y >= rectangle[2])
+                    & (y <= rectangle[3])
+                )
+                day = {key: value[inside] for key, value in day.items()}
+            if len(day["time"]):
+                parts.append(day)
+
+        if not parts:
+            return _empty()
+        reports = {key: np.concatenate([day[key] for day in parts]) for key in parts[0]}
+        if geometry is not None:
+            import shapely
+
+            inside = shapely.contains_xy(geometry, reports["xcoord"], reports["ycoord"])
+            reports = {key: value[inside] for key, value in reports.items()}
+        return reports
+
+    def index(self, rectangle=None, geometry=None, start=None, end=None):
+        """
+        CrowdsourceIndex (utils.crowdsource) of the reports whose 5-min bin
+         lies in [start, end], e.g. for CrowdsourceIndex.max_per_slot. The
+         window of query is widened by half a step on both sides for the
+         reports rounded into its first and last bin.
+        """
+        half = np.timedelta64(150, "s")
+        if start is not None:
+            start = np.datetime64(start, "s") - half
+        if end is not None:
+            end = np.datetime64(end, "s") + half
+        return crowdsource.CrowdsourceIndex(
+            self.query(rectangle=rectangle, geometry=geometry, start=start, end=end)
+        )
@@ -0,0 +1,286 @@
+"""
+Maximum precipitation accumulation over rolling durations (10 min to 72 h)
+"""
+import numpy as np
+
+from utils import kernels
+from utils.cube import CHUNK_BYTES, iter_time_blocks
+from utils.timeaxis import TIMESTEP
+
+# durations in minutes
+DURATIONS = [10, 60, 180, 360, 720, 1440, 2880, 4320]
+
+
+def duration_label(duration):
+    """
+    Short label of a duration, e.g. "10min" or "24h".
+
+    Args:
+    -----
+    duration: int
+     Duration in minutes.
+
+    Returns:
+    --------
+    label: str
+    """
+    if duration % 60 == 0:
+        return f"{duration // 60}h"
+    return f"{duration}min"
+
+
+def duration_maxima(
+    totalDomain, durations=DURATIONS, prd="RZC", validity=None, timeAxis=None
+):
+    """
+    Maximum accumulation (mm) over rolling durations for every pixel.
+
+    The domain is processed in bands of rows. For every band the time series
+     of all pixels is summed cumulatively once, from which every duration is
+     a difference of two cumulative sums. A lazily read cube (LazyCube) is
+     instead read once, block by block over time, keeping the cumulative sums
+     of the longest duration in a ring buffer (see DurationAccumulator).
+
+    Args:
+    -----
+    totalDomain: ndarray
+     (y, x, time) precipitation (mm/h) with 5-min time steps, missing values
+     negative (counted as 0). Can be a LazyCube.
+    durations: list, optional
+     Durations in minutes, multiples of 5. Default is DURATIONS.
+    prd: str, optional
+     The product, "AQC" is accumulated without the 5-min to mm conversion.
+     Default is "RZC".
+    validity: ValidityMask, optional
+     Valid values of totalDomain, see utils.validity. Default is None
+     (negative values are missing).
+    timeAxis: TimeAxis, optional
+     Times of the time steps, see utils.timeaxis. The windows are then
+     measured on the regular 5-min axis, missing frames counting as 0.
+     Default is None (the time steps are consecutive).
+
+    Returns:
+    --------
+    maxima: dict
+     Per duration (minutes) a tuple (maxSum, endStep): the maximum
+     accumulation (mm) and the index of the last time step of the window
+     in which it occurs, both (y, x) arrays. Durations longer than the
+     event are left out.
+    """
+    ny, nx, n_steps = totalDomain.shape
+    if not isinstance(totalDomain, np.ndarray):
+        acc = DurationAccumulator((ny, nx), n_steps, durations, prd, timeAxis)
+        if acc.steps:
+            for start, block in iter_time_blocks(totalDomain):
+                stop = start + block.shape[2]
+                acc.add_block(
+                    block, None if validity is None else validity[:, :, start:stop]
+                )
+        return acc.maxima()
+
+    # number of time steps up to every slot of the regular axis
+    upTo = _files_up_to(timeAxis)
+    n_slots = n_steps if upTo is None else len(upTo)
+    steps = _duration_steps(durations, n_slots)
+    maxima = {
+        d: (np.empty((ny, nx), dtype=np.float32), np.empty((ny, nx), dtype=np.int32))
+        for d in steps
+    }
+
+    rows = max(1, CHUNK_BYTES // (8 * nx * (n_steps + n_slots + 1)))
+    for r0 in range(0, ny, rows):
+        band = np.asarray(totalDomain[r0 : r0 + rows, :, :], dtype=np.float64)
+        r1 = r0 + band.shape[0]
+        if validity is None:
+            band = np.maximum(band, 0)
+        else:
+            band = np.where(validity[r0:r1], band, 0)
+        if prd != "AQC":
+            band /= 12.0
+
+        # (time + 1, y, x) cumulative sum with a leading zero
+        cumsum = np.zeros((n_steps + 1,) + band.shape[:2])
+        np.cumsum(np.moveaxis(band, -1, 0), axis=0, out=cumsum[1:])
+        del band
+        if upTo is not None:
+            cumsum = cumsum[np.concatenate(([0], upTo))]
+        for d, n in steps.items():
+            value, end = kernels.rolling_max(cumsum, n)
+            maxima[d][0][r0:r1] = value
+            maxima[d][1][r0:r1] = end if upTo is None else upTo[end] - 1
+    return maxima
+
+
+class DurationAccumulator(object):
+    """
+    duration_maxima of a cube consumed block by block over time, so every
+     time step is read (or decoded) once, e.g. in the single pass of
+     tools.region.RegionCollection.fetch_precip_data(stream=True). The
+     cumulative sum of every slot is kept in a ring buffer as long as the
+     longest duration, memory is O(longest duration x frame) instead of
+     O(event x frame). The sums are those of the bands of duration_maxima.
+
+    Attributes:
+    -----------
+    n_steps: int
+     Number of time steps consumed so far.
+    steps: dict
+     Per duration (minutes) its number of 5-min slots, durations longer
+     than the event are left out.
+    """
+
+    def __init__(self, shape, n_steps, durations=DURATIONS, prd="RZC", timeAxis=None):
+        """
+        Initializes the accumulator
+
+        Args:
+        -----
+        shape: tuple
+         (y, x) shape of the domain.
+        n_steps: int
+         Number of time steps that will be consumed.
+        durations: list, optional
+         Durations in minutes, multiples of 5. Default is DURATIONS.
+        prd: str, optional
+         The product, see duration_maxima. Default is "RZC".
+        timeAxis: TimeAxis, optional
+         Times of the time steps, see duration_maxima. Default is None.
+        """
+        self.prd = prd
+        self.n_steps = 0
+        self.upTo = _files_up_to(timeAxis)
+        self.steps = _duration_steps(durations, n_steps if self.upTo is None else len(self.upTo))
+        self.slots = np.arange(n_steps) if self.upTo is None else timeAxis.slots
+        size = max(self.steps.values(), default=0) + 1
+        # cumsum[k], the sum of the first k slots, is ring[k % size]
+        self.ring = np.zeros((size,) + tuple(shape))
+        self.window = np.empty(shape)
+        self.best = {d: np.empty(shape) for d in self.steps}
+        self.bestEnd = {d: np.zeros(shape, dtype=np.int64) for d in self.steps}
+        # the time steps of the current slot are summed in frame, which is
+        # added once the next slot starts (several files can share a slot)
+        self.frame = np.zeros(shape)
+        self.k = 0
+
+    def _add_slot(self, frame):
+        # cumsum[k] from cumsum[k - 1] and slot k - 1
+        self.k += 1
+        k, size = self.k, len(self.ring)
+        np.add(self.ring[(k - 1) % size], frame, out=self.ring[k % size])
+        for d, n in self.steps.items():
+            if k < n:
+                continue
+            np.subtract(self.ring[k % size], self.ring[(k - n) % size], out=self.window)
+            if k == n:
+                self.best[d][:] = self.window
+                continue
+            better = self.window > self.best[d]
+            self.best[d][better] = self.window[better]
+            self.bestEnd[d][better] = k - n
+
+    def add_block(self, block, valid=None):
+        """
+        Consume consecutive time steps of the whole domain.
+
+        Args:
+        -----
+        block: ndarray
+         (y, x, n) precipitation (mm/h) of the domain.
+        valid: ndarray, optional
+         (y, x, n) mask of the valid values of block. Default is None
+         (negative values are missing).
+
+        Returns:
+        --------
+        None
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if valid is None:
+            block = np.maximum(block, 0)
+        else:
+            block = np.where(valid, block, 0)
+        if self.prd != "AQC":
+            block /= 12.0
+        for i in range(block.shape[2]):
+            slot = self.slots[self.n_steps + i]
+            if slot > self.k:
+                self._add_slot(self.frame)
+                self.frame[:] = 0
+                # missing slots add nothing to the cumulative sum
+                while self.k < slot:
+                    self._add_slot(0.0)
+            self.frame += block[:, :, i]
+        self.n_steps += block.shape[2]
+
+    def maxima(self):
+        """
+        The maxima of the consumed time steps, once all of them are consumed.
+
+        Returns:
+        --------
+        maxima: dict
+         Per duration (minutes) a tuple (maxSum, endStep), see duration_maxima.
+        """
+        if self.steps:
+            self._add_slot(self.frame)
+            self.frame[:] = 0
+        maxima = {}
+        for d, n in self.steps.items():
+            # index of the last slot of the window, as kernels.rolling_max
+            end = self.bestEnd[d] + n - 1
+            maxima[d] = (
+                self.best[d].astype(np.float32),
+                (end if self.upTo is None else self.upTo[end] - 1).astype(np.int32),
+            )
+        return maxima
+
+
+def _duration_steps(durations, n_slots):
+    # number of slots of every duration that fits in the event
+    return {d: d // TIMESTEP for d in durations if 0 < d // TIMESTEP <= n_slots}
+
+
+def _files_up_to(timeAxis):
+    """
+    Number of time steps at or before every slot of a TimeAxis,
+     None without gaps and shared slots (or without a time axis).
+    """
+    if timeAxis is None or not (timeAxis.n_missing or timeAxis.n_shared):
+        return None
+    return np.searchsorted(timeAxis.slots, np.arange(len(timeAxis)), side="right")
+
+
+def series_duration_maxima(sumOverTime, durations=DURATIONS, timeAxis=None):
+    """
+    Maximum accumulation (mm) over rolling durations of a cumulative
+     time series, e.g. RegionInfo.sumOverTime (mean over the region).
+
+    Args:
+    -----
+    sumOverTime: ndarray
+     1-dimensional cumulative sum (mm) per 5-min time step.
+    durations: list, optional
+     Durations in minutes, multiples of 5. Default is DURATIONS.
+    timeAxis: TimeAxis, optional
+     Times of the time steps, see duration_maxima. Default is None.
+
+    Returns:
+    --------
+    maxima: dict
+     Per duration (minutes) a tuple (maxSum, endStep). Durations longer
+     than the event are left out.
+    """
+    upTo = _files_up_to(timeAxis)
+    cumsum = np.concatenate(([0.0], np.asarray(sumOverTime, dtype=np.float64)))
+    if upTo is not None:
+        cumsum = cumsum[np.concatenate(([0], upTo))]
+    maxima = {}
+    for d in durations:
+        n = d // TIMESTEP
+        if 0 < n <= len(cumsum) - 1:
+            value, end = kernels.rolling_max(cumsum[:, np.newaxis, np.newaxis], n)
+            value, end = value[0, 0], end[0, 0]
+            if upTo is not None:
+                end = upTo[end] - 1
+            maxima[d] = (float(value), int(end))
+    return maxima
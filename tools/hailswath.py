@@ -0,0 +1,116 @@
+"""
+Hail swath over the whole domain from the 5-min POH files
+"""
+import os
+import numpy as np
+
+from utils import open_data
+from utils.timeaxis import TIMESTEP
+
+# POH from which a pixel is counted as hit
+THRESHOLDS = [0.8]
+
+
+class HailSwath(object):
+    """
+    Running per-pixel hail statistics over a time window, fed one POH field
+     at a time, so memory is O(frame) whatever the length of the window.
+
+    Attributes:
+    -----------
+    start: datetime64
+     Start of the window, origin of firstHit.
+    end: datetime64
+     Time of the last field consumed.
+    n_frames: int
+     Number of fields consumed.
+    maxPOH: ndarray
+     (y, x) maximum POH, NaN where there was never any data.
+    firstHit: dict
+     Per threshold the (y, x) minutes since start of the first field with
+     POH >= threshold, -1 where it was never reached.
+    exceedance: dict
+     Per threshold the (y, x) number of minutes with POH >= threshold.
+    """
+
+    def __init__(self, shape, thresholds=THRESHOLDS, start=None):
+        """
+        Initializes the swath
+
+        Args:
+        -----
+        shape: tuple
+         (y, x) shape of the POH fields.
+        thresholds: list, optional
+         POH thresholds of firstHit and exceedance. Default is [0.8].
+        start: datetime64, optional
+         Start of the window. Default is None (time of the first field).
+        """
+        self.start = None if start is None else np.datetime64(start, "m")
+        self.end = None
+        self.n_frames = 0
+        self.maxPOH = np.full(shape, np.nan, dtype=np.float32)
+        self.firstHit = {thr: np.full(shape, -1, dtype=np.int32) for thr in thresholds}
+        self.exceedance = {thr: np.zeros(shape, dtype=np.int32) for thr in thresholds}
+
+    def add(self, POH, time):
+        """
+        Consume the next field.
+
+        Args:
+        -----
+        POH: ndarray
+         (y, x) POH, NaN where there is no data.
+        time: datetime64
+         Time of the field.
+
+        Returns:
+        --------
+        None
+        """
+        if self.start is None:
+            self.start = np.datetime64(time, "m")
+        self.end = np.datetime64(time, "m")
+        minute = int((self.end - self.start) // np.timedelta64(1, "m"))
+
+        # fmax ignores NaN unless both are NaN
+        np.fmax(self.maxPOH, POH, out=self.maxPOH)
+        for thr, first in self.firstHit.items():
+            hit = POH >= thr
+            first[hit & (first < 0)] = minute
+            self.exceedance[thr][hit] += TIMESTEP
+        self.n_frames += 1
+
+
+def hail_swath(
+    dir, start=None, end=None, thresholds=THRESHOLDS, workers=open_data.POH_WORKERS
+):
+    """
+    Hail swath of a time window, streaming the 5-min POH files once.
+
+    Args:
+    -----
+    dir: str
+     Directory of the event, containing POH/SingleFiles.
+    start: datetime64, optional
+     Start of the window, e.g. "2023-07-24T14:00". Default is None
+     (from the first file).
+    end: datetime64, optional
+     End of the window (included). Default is None (to the last file).
+    thresholds: list, optional
+     POH thresholds of the first hit and exceedance maps. Default is [0.8].
+    workers: int, optional
+     Number of threads reading the files. Default is POH_WORKERS.
+
+    Returns:
+    --------
+    swath: HailSwath or None
+     The swath, None if there is no file in the window.
+    """
+    swath = None
+    fields = open_data.iter_single_POH(os.path.join(dir, "POH"), start, end, workers)
+    for time, POH in fields:
+        if swath is None:
+            swath = HailSwath(POH.shape, thresholds, start=start)
+        swath.add(POH, time)
+    return swath
@@ -2,8 +2,10 @@ import numpy as np
 import os
 
 from visualization import summary, precipfields, timeserie
-from utils import open_data
+from utils import open_data, decoder
+from utils.timeaxis import TimeAxis
 import tools.region as region
+from tools import hailswath
 
 
 ###################
@@ -24,7 +26,18 @@ def make_expertise(
     useOsm=False,
     useOsmSingleFiles=False,
     make_kml_file=False,
-    *rg_args
+    *rg_args,
+    decoder_name="pexp",
+    decode_workers=1,
+    decode_chunksize=None,
+    mmap=False,
+    quantized=False,
+    stream=False,
+    regions=None,
+    durations=None,
+    hail_swath=False,
+    swath_window=None,
+    swath_thresholds=None,
 ):
     """
     Run the expertise script to generate plots for a given date and product (RZC or CPC).
@@ -60,6 +73,50 @@ def make_expertise(
     *rg_args: list, optional
      Additional positional arguments for raingauges, output of func: make_rg
      should be passed.
+    decoder_name: str, optional
+     "pexp" (default) reads the cube written by pexp to totalroi.bin,
+     "python" decodes the 5-min files in-process with utils.decoder.
+    decode_workers: int, optional
+     Number of processes decoding the files into shared memory when
+     decoder_name is "python". Default is 1 (decoded in this process).
+    decode_chunksize: int, optional
+     Number of consecutive files decoded per task by a worker process.
+     Default spreads the files over four tasks per worker.
+    mmap: bool, optional
+     Memory-map totalroi.bin (pexp decoder) instead of loading it,
+     so only the accessed parts are read. Default is False.
+    quantized: bool, optional
+     Keep the cube as 8-bit class indices of the color scale when
+     decoder_name is "python" (utils.decoder.decode_precip_quantized),
+     converting to mm/h only the parts that are accessed. Default is False.
+    stream: bool, optional
+     Compute the precipitation aggregates, the duration maxima and the
+     intensity of {dir}/{eventCodeName}-domain.nc in a single pass over the
+     time steps for all regions, without holding the cube in memory (see
+     RegionCollection.fetch_precip_data). Outputs that need other parts of
+     the full cube (e.g. singleFiles) read it again, decoding the files
+     again with the python decoder. Default is False.
+    regions: list, optional
+     (name, regionRectangle) of several regions of interest, regionRectangle
+     being the bounds or a shapely polygon (e.g. a catchment), replacing
+     name and regionRectangle. The cube is decoded once and reduced for all
+     regions together (tools.region.RegionCollection), the output of every
+     region is written to {dir}/{name}. Default is None (only name).
+    durations: list, optional
+     Durations in minutes (e.g. [60, 180, 360, 1440, 2880]) for which the
+     maximum accumulation per pixel and of the region mean is added to the
+     summary files and to {dir}/{eventCodeName}-domain.nc (tools.duration).
+     Default is None (not computed).
+    hail_swath: bool, optional
+     Whether to write the hail swath over the whole domain (maximum POH,
+     first hit and duration above thresholds, tools.hailswath) from the
+     5-min POH files to {dir}/{eventCodeName}-hailswath.nc, once for all
+     regions. Default is False.
+    swath_window: tuple, optional
+     (start, end) of the hail swath, e.g. ("2023-07-24T14:00",
+     "2023-07-24T19:00"). Default is None (all POH files).
+    swath_thresholds: list, optional
+     POH thresholds of the hail swath. Default is [0.8].
 
     Returns:
     --------
@@ -70,10 +127,8 @@ def make_expertise(
     ###   Directories   ###
     #######################
 
-    outDir = os.path.join(dir, name)
+    # every region writes to the folder {dir}/{name}, created in step 3
     os.chdir(dir)
-    if not os.path.isdir(outDir):
-        os.makedirs(outDir)
 
     #######################
     ###  CONFIGURATION  ###
@@ -81,19 +136,152 @@ def make_expertise(
 
     # step 1 open all files
     allFiles = open_data.get_precip_files(dir, prd)
-    allFiles = np.sort(allFiles)
+    # one time axis for all outputs, the files sorted by time
+    timeAxis = TimeAxis(allFiles)
+    allFiles = timeAxis.files
+    if timeAxis.n_missing:
+        print(
+            f"{timeAxis.n_missing} of {len(timeAxis)} 5-min frames are missing,"
+            " they are left as gaps in the time series"
+        )
+    if timeAxis.n_shared:
+        print(
+            f"{timeAxis.n_shared} files share a 5-min slot with the previous file,"
+            f" they are added to its slot: {list(timeAxis.files[timeAxis.shared])}"
+        )
     print("step 1 open files completed")
     
     # step 2 extract precipitation from files
-    Region = region.RegionInfo(allFiles,name=name,regionRectangle=regionRectangle)
-    Region.fetch_precip_data(dir)
+    if regions is None:
+        regions = [(name, regionRectangle)]
+    Regions = region.RegionCollection(allFiles, regions, timeAxis=timeAxis)
+    totalDomain, validity = _get_totalDomain(
+        dir,
+        prd,
+        allFiles,
+        decoder_name=decoder_name,
+        decode_workers=decode_workers,
+        decode_chunksize=decode_chunksize,
+        mmap=mmap,
+        quantized=quantized,
+        stream=stream,
+    )
+    # the domain summary does not depend on the region, it is written once
+    # next to the region folders, in stream mode during the pass over the cube
+    domainWriter = None
+    if stream:
+        domainWriter = summary.DomainSummary(Regions.regions[0].bname, timeAxis, dir)
+    Regions.fetch_precip_data(
+        dir,
+        totalDomain=totalDomain,
+        stream=stream,
+        validity=validity,
+        durations=durations,
+        domainWriter=domainWriter,
+    )
     print("step 2a extract precipitation completed")
+    if durations:
+        print("step 2a maximum accumulation per duration completed")
+
+    if domainWriter is not None:
+        domainWriter.close(Regions.regions[0].totalSum, Regions.regions[0].durationMaxima)
+    else:
+        summary.make_netCDF_domain(Regions.regions[0], dir)
+    print("step 2a domain summary completed")
 
     # step 2b - optional - extract hail data
     if POHfiles:
-        Region.fetch_POH_data(dir, POHSingleFiles)
+        Regions.fetch_POH_data(dir, POHSingleFiles)
         print("step 2b extract POHfiles completed")
 
+    # step 2c - optional - hail swath of the whole domain
+    swath = None
+    if hail_swath:
+        start, end = swath_window or (None, None)
+        swath = hailswath.hail_swath(
+            dir, start, end, thresholds=swath_thresholds or hailswath.THRESHOLDS
+        )
+        if swath is None:
+            print("No 5-min POH files for the hail swath")
+        else:
+            # domain-wide, written once next to the region folders
+            summary.make_netCDF_hailswath(Regions.regions[0].bname, swath, dir)
+            print("step 2c hail swath completed")
+
+    for Region in Regions:
+        outDir = os.path.join(dir, Region.name)
+        if not os.path.isdir(outDir):
+            os.makedirs(outDir)
+        if len(Regions) > 1:
+            print(f"outputs of region {Region.name}")
+        _make_outputs(
+            Region,
+            dir,
+            outDir,
+            allFiles,
+            singleFiles,
+            POHfiles,
+            POHSingleFiles,
+            roiMap,
+            visibMap,
+            useOsm,
+            useOsmSingleFiles,
+            make_kml_file,
+            *rg_args,
+        )
+
+
+def _get_totalDomain(
+    dir,
+    prd,
+    allFiles,
+    decoder_name="pexp",
+    decode_workers=1,
+    decode_chunksize=None,
+    mmap=False,
+    quantized=False,
+    stream=False,
+):
+    """
+    Decode or open the (y, x, time) cube of the event, see make_expertise.
+     Returns the cube and the mask of its valid values built while decoding,
+     None for a lazily read cube.
+    """
+    if decoder_name == "python" and stream:
+        return decoder.lazy_precip(allFiles), None
+    if decoder_name == "python" and quantized:
+        return decoder.decode_precip_quantized(allFiles, return_validity=True)
+    if decoder_name == "python" and decode_workers > 1:
+        sharedCube = decoder.decode_precip_parallel(
+            allFiles, n_workers=decode_workers, chunksize=decode_chunksize
+        )
+        return sharedCube.totalDomain, sharedCube.validity
+    if decoder_name == "python":
+        return decoder.decode_precip(allFiles, return_validity=True)
+    return open_data.get_totalDomain(
+        dir, prd, mmap=mmap or stream, return_validity=True
+    )
+
+
+def _make_outputs(
+    Region,
+    dir,
+    outDir,
+    allFiles,
+    singleFiles=False,
+    POHfiles=False,
+    POHSingleFiles=False,
+    roiMap=False,
+    visibMap=False,
+    useOsm=False,
+    useOsmSingleFiles=False,
+    make_kml_file=False,
+    *rg_args,
+):
+    """
+    Write the plots and summary files of a region to outDir (steps 3 to 6
+     of make_expertise).
+    """
     # step 3 get precipitation plots and csv files
     precipfields.make_avg_zoom(Region, outDir, useOsm=useOsm)
     precipfields.make_sum_zoom(
@@ -105,7 +293,6 @@ def make_expertise(
 
     # step 3b - optional - get single precipitation files
     if singleFiles:
-        allFiles = np.sort(allFiles)
         precipfields.processAllFiles(
             Region, allFiles, outDir, useOsmSingleFiles=useOsmSingleFiles
         )
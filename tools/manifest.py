@@ -0,0 +1,284 @@
+"""
+Bookkeeping of the 5-min files that are decoded into totalroi.bin,
+used to extend an event window without decoding it again
+"""
+import glob
+import json
+import os
+
+import numpy as np
+
+from utils import cube_store
+
+MANIFEST = "manifest.json"
+
+
+def read_manifest(dir):
+    """
+    Load the manifest of an output directory.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+
+    Returns:
+    --------
+    manifest: dict
+     The manifest, empty if the directory has none yet.
+    """
+    path = os.path.join(dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(dir, manifest):
+    """
+    Save the manifest of an output directory.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    manifest: dict
+     The manifest to save.
+
+    Returns:
+    --------
+    None
+    """
+    tmp = os.path.join(dir, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(dir, MANIFEST))
+
+
+def update_manifest(dir, **entries):
+    """
+    Set entries of the manifest of an output directory, keeping the others.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    **entries:
+     The entries to set, e.g. prd and decoded.
+
+    Returns:
+    --------
+    None
+    """
+    manifest = read_manifest(dir)
+    manifest.update(entries)
+    write_manifest(dir, manifest)
+
+
+def _source_stat(src):
+    # identifies the version of a daily archive file, None if it is absent
+    if not os.path.exists(src):
+        return None
+    stat = os.stat(src)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def unavailable_timesteps(dir, prd, sources):
+    """
+    Timesteps that an earlier retrieval did not find in the daily archive
+     files, for the days whose file has not changed since.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    prd: str
+     The product, e.g. "RZC".
+    sources: dict
+     Path of the daily archive file of every day (YYDOY).
+
+    Returns:
+    --------
+    unavailable: set
+     Timesteps as YYDOYHHMM.
+    """
+    recorded = read_manifest(dir).get("unavailable", {}).get(prd, {})
+    unavailable = set()
+    for YYDOY, src in sources.items():
+        entry = recorded.get(YYDOY)
+        if entry is not None and entry["source"] == _source_stat(src):
+            unavailable.update(entry["timesteps"])
+    return unavailable
+
+
+def record_unavailable(dir, prd, sources, timesteps):
+    """
+    Record requested timesteps that are not in the daily archive files,
+     with the size and modification time of the files, so that they are
+     only looked for again once a file has changed (e.g. a day that is
+     still being archived).
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    prd: str
+     The product, e.g. "RZC".
+    sources: dict
+     Path of the daily archive file of every retrieved day (YYDOY).
+    timesteps: list
+     Requested timesteps (YYDOYHHMM) that were not extracted.
+
+    Returns:
+    --------
+    None
+    """
+    manifest = read_manifest(dir)
+    recorded = manifest.setdefault("unavailable", {}).setdefault(prd, {})
+    for YYDOY, src in sources.items():
+        absent = sorted(date for date in timesteps if date[:5] == YYDOY)
+        if absent:
+            recorded[YYDOY] = {"source": _source_stat(src), "timesteps": absent}
+        else:
+            recorded.pop(YYDOY, None)
+    write_manifest(dir, manifest)
+
+
+def list_frames(dir, prd):
+    """
+    List the extracted 5-min files of a product, in the order in
+     which they are decoded.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    prd: str
+     The product, either "RZC" or "CPC".
+
+    Returns:
+    --------
+    frames: list
+     Sorted base names of the extracted files.
+    """
+    files = glob.glob(os.path.join(dir, prd, "*.h5")) + glob.glob(
+        os.path.join(dir, prd, "*.gif")
+    )
+    return sorted(os.path.basename(file) for file in files)
+
+
+def decoded_frames(dir, prd):
+    """
+    Get the files that are contained in totalroi.bin, or in totalroi.nc
+     if the cube has been converted to the compressed store.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    prd: str
+     The product, either "RZC" or "CPC".
+
+    Returns:
+    --------
+    decoded: list
+     Base names of the files in the order of the time axis of
+     totalroi.bin, empty if there is no usable cube.
+    """
+    if not (
+        os.path.exists(os.path.join(dir, "totalroi.bin"))
+        and os.path.exists(os.path.join(dir, "totalroi.json"))
+    ):
+        if os.path.exists(os.path.join(dir, cube_store.STORE)):
+            # the store carries its own time axis
+            if cube_store.get_store_meta(dir)["prd"] == prd:
+                return cube_store.stored_frames(dir)
+        return []
+
+    manifest = read_manifest(dir)
+    if manifest.get("prd") == prd and "decoded" in manifest:
+        return manifest["decoded"]
+
+    # cube written before manifests existed: only trust it when it has
+    # exactly one timestep per extracted file
+    with open(os.path.join(dir, "totalroi.json")) as f:
+        meta = json.loads(f.readlines()[0])
+    frames = list_frames(dir, prd)
+    if meta["prd"] == prd and int(meta["z"]) == len(frames):
+        return frames
+    return []
+
+
+def plan_decoding(dir, prd):
+    """
+    Compare the extracted files with the content of totalroi.bin.
+
+    Args:
+    -----
+    dir: str
+     The output directory of an expertise.
+    prd: str
+     The product, either "RZC" or "CPC".
+
+    Returns:
+    --------
+    frames: list
+     All extracted files, sorted.
+    missing: list
+     Files that still need to be decoded. Equal to frames if the cube
+     has to be decoded from scratch.
+    append: bool
+     True if the missing files can be appended to the existing cube,
+     i.e. the cube holds the first timesteps of frames.
+    """
+    frames = list_frames(dir, prd)
+    decoded = decoded_frames(dir, prd)
+    if decoded and frames[: len(decoded)] == decoded:
+        return frames, frames[len(decoded) :], True
+    return frames, frames, False
+
+
+def append_totalroi(dir, part_dir):
+    """
+    Append the timesteps of a partial cube to totalroi.bin. The cube is
+     stored time step by time step, so extending it is a plain append.
+
+    Args:
+    -----
+    dir: str
+     Directory containing the existing totalroi.bin and totalroi.json.
+    part_dir: str
+     Directory containing the totalroi.bin and totalroi.json of the
+     additional timesteps.
+
+    Returns:
+    --------
+    None
+    """
+    with open(os.path.join(dir, "totalroi.json")) as f:
+        meta = json.loads(f.readlines()[0])
+    with open(os.path.join(part_dir, "totalroi.json")) as f:
+        part_meta = json.loads(f.readlines()[0])
+
+    if (meta["width"], meta["height"], meta["prd"]) != (
+        part_meta["width"],
+        part_meta["height"],
+        part_meta["prd"],
+    ):
+        raise ValueError("partial cube does not match the grid of totalroi.bin")
+
+    frame_bytes = int(meta["width"]) * int(meta["height"]) * np.dtype("f").itemsize
+    with open(os.path.join(dir, "totalroi.bin"), "r+b") as dst:
+        # drop a partially written frame of an interrupted append
+        dst.truncate(int(meta["z"]) * frame_bytes)
+        dst.seek(0, os.SEEK_END)
+        with open(os.path.join(part_dir, "totalroi.bin"), "rb") as src:
+            while True:
+                buffer = src.read(64 * frame_bytes)
+                if not buffer:
+                    break
+                dst.write(buffer)
+
+    meta["z"] = str(int(meta["z"]) + int(part_meta["z"]))
+    with open(os.path.join(dir, "totalroi.json"), "w") as f:
+        f.write(json.dumps(meta) + "\n")
@@ -1,7 +1,34 @@
 import os
 import numpy as np
-from utils.transformation import get_file_str
-from utils import open_data
+from scipy.sparse import csr_matrix
+from utils.cube import CHUNK_BYTES, iter_time_blocks
+from utils.timeaxis import TimeAxis
+from utils.transformation import coordx2ind, coordy2ind, get_file_str
+from utils import kernels, open_data
+from utils.validity import ValidityMask, masked_time_sum
+from tools.accumulate import STREAM_STEPS, RegionsAccumulator, accumulate_precip
+from tools import duration
+
+
+class _Derived(object):
+    """
+    Attribute of RegionInfo computed by its method _compute_<name> on first
+     access and kept until RegionInfo.invalidate. It can also be assigned,
+     e.g. by the streaming accumulator or a RegionCollection.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.name not in obj._derived:
+            obj._derived[self.name] = getattr(obj, "_compute_" + self.name)()
+        return obj._derived[self.name]
+
+    def __set__(self, obj, value):
+        obj._derived[self.name] = value
 
 
 class RegionInfo(object):
@@ -23,15 +50,46 @@ class RegionInfo(object):
      A dictionary containing information about the first file of the event
     fbname: dict
      A dictionary containing information about the last file of the event
+    timeAxis: TimeAxis
+     Times of the files of the event, i.e. of the time steps of the cube.
+    geometry: shapely.Geometry or None
+     Polygon of the region (e.g. a catchment), None for a rectangle.
+    durationMaxima: dict or None
+     Maximum accumulation per duration for every pixel of the domain,
+     set by fetch_duration_maxima.
+    roiDurationMaxima: dict or None
+     Maximum accumulation per duration of the mean over the region,
+     set by fetch_duration_maxima.
+    weights: ndarray or None
+     Fraction of every cell of rectangle covered by geometry,
+     None for a rectangle.
+
+    The precipitation fields set by fetch_precip_data (totalSum, totalRoi,
+     totalSumRoiS, intensityOverTime, sumOverTime) are computed from
+     totalDomain when they are first accessed, and cached. validity, the
+     bit-packed mask of the measured values of totalDomain (see
+     utils.validity), comes with the decoded cube, or is otherwise built from
+     totalDomain on first access. Every reduction uses it instead of testing
+     for negative values: totalDomain itself is never modified.
 
     """
 
+    validity = _Derived()
+    totalSum = _Derived()
+    totalRoi = _Derived()
+    totalSumRoiS = _Derived()
+    roiSum = _Derived()
+    intensityOverTime = _Derived()
+    sumOverTime = _Derived()
+
     def __init__(
         self,
         allFiles,
         name="Carrerabach",
         regionRectangle=[2739000, 2746000, 1178000, 1185000],
         delta_region=20000,
+        geometry=None,
+        timeAxis=None,
     ):
         """
         Initializes a Region
@@ -45,14 +103,38 @@ class RegionInfo(object):
         regionRectangle: list, optional
          Outer bounds of region of interest. Default is bounds corresponding to Carrerabach.
         delta_region: int, optional
+        geometry: shapely.Geometry, optional
+         Polygon of the region in LV95 coordinates, e.g. from
+         utils.catchment.load_catchments. regionRectangle is then replaced
+         by the bounding rectangle of the polygon and areal means are
+         weighted by the fraction of every cell covered by the polygon.
+         Default is None.
+        timeAxis: TimeAxis, optional
+         Time axis of allFiles, e.g. shared by the regions of a
+         RegionCollection. Default is None (built from allFiles).
         """
+        self._derived = {}
+        self._totalDomain = None
+        self.geometry = geometry
+        self.weights = None
+        self.durationMaxima = None
+        self.roiDurationMaxima = None
+        if geometry is not None:
+            from utils import catchment
+
+            regionRectangle = catchment.bounding_rectangle(geometry)
+            self.weights = catchment.roi_weights(geometry, regionRectangle)
+
         self.rectangle = np.array(regionRectangle)
         self.delta = delta_region
-        self.surfacekm2 = (
-            (self.rectangle[1] - self.rectangle[0])
-            * (self.rectangle[3] - self.rectangle[2])
-            / (1000 * 1000)
-        )
+        if geometry is not None:
+            self.surfacekm2 = geometry.area / (1000 * 1000)
+        else:
+            self.surfacekm2 = (
+                (self.rectangle[1] - self.rectangle[0])
+                * (self.rectangle[3] - self.rectangle[2])
+                / (1000 * 1000)
+            )
         self.roiCentre = (
             self.rectangle[0] + (self.rectangle[1] - self.rectangle[0]) / 2.0,
             self.rectangle[2] + (self.rectangle[3] - self.rectangle[2]) / 2.0,
@@ -68,16 +150,56 @@ class RegionInfo(object):
 
         self.bname = get_file_str(bname)
         self.fbname = get_file_str(fbname)
+        self.timeAxis = timeAxis if timeAxis is not None else TimeAxis(allFiles)
+
+    def roi_weights(self):
+        """
+        Weight of every cell of the rectangle in the areal means of the region.
 
-    def fetch_precip_data(self, dir):
+        Returns:
+        --------
+        weights: ndarray
+         A 2-dimensional float32 array, ones for a rectangular region and the
+         covered fraction of every cell for a polygon.
+        """
+        if self.weights is not None:
+            return self.weights
+        return np.ones(
+            (
+                coordy2ind(self.rectangle[2]) - coordy2ind(self.rectangle[3]),
+                coordx2ind(self.rectangle[1]) - coordx2ind(self.rectangle[0]),
+            ),
+            dtype=np.float32,
+        )
+
+    def fetch_precip_data(
+        self, dir, totalDomain=None, mmap=False, stream=False, validity=None
+    ):
         """
         Class to store and manipulate precipiation data over a domain and
-         region of interest
+         region of interest. Only totalDomain is set here, the other
+         attributes are computed when they are first used.
 
         Args:
         -----
         dir: str
          Directory containing precipiation files
+        totalDomain: ndarray, optional
+         Already decoded (y, x, time) cube, e.g. from utils.decoder.
+         If None, the cube is read from totalroi.bin in dir.
+        mmap: bool, optional
+         Memory-map totalroi.bin instead of reading it, see
+         open_data.get_totalDomain. Default is False.
+        stream: bool, optional
+         Compute all aggregates in a single pass over the time steps
+         (tools.accumulate), keeping only the domain sum and the region of
+         interest in memory. totalDomain stays a lazily read cube: the
+         memory-mapped totalroi.bin if None, or e.g. utils.decoder.lazy_precip.
+         Default is False.
+        validity: ValidityMask, optional
+         Valid values of totalDomain, built when it was decoded (e.g.
+         utils.decoder.decode_precip(return_validity=True)). Default is None
+         (built from totalDomain when first used).
 
         Attributes:
         -----------
@@ -103,26 +225,116 @@ class RegionInfo(object):
         """
         prd = self.bname["prd"]
 
-        self.totalDomain = open_data.get_totalDomain(dir, prd)
+        if stream:
+            if totalDomain is None:
+                totalDomain = open_data.get_totalDomain(dir, prd, mmap=True)
+            self.totalDomain = totalDomain
+            aggregates = accumulate_precip(
+                self.totalDomain,
+                self.rectangle,
+                self.surfacekm2,
+                prd,
+                weights=self.weights,
+            )
+            for key, value in aggregates.items():
+                setattr(self, key, value)
+            return
 
-        if prd == "AQC":
-            self.totalSum = np.sum(self.totalDomain, axis=2)
-        else:
-            self.totalSum = np.sum(self.totalDomain, axis=2) / 12.0
+        if totalDomain is None:
+            totalDomain, validity = open_data.get_totalDomain(
+                dir, prd, mmap=mmap, return_validity=True
+            )
+        self.totalDomain = totalDomain
+        if validity is not None:
+            self.validity = validity
+
+    @property
+    def totalDomain(self):
+        return self._totalDomain
+
+    @totalDomain.setter
+    def totalDomain(self, totalDomain):
+        # everything derived from the previous cube is outdated
+        self._totalDomain = totalDomain
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget the derived precipitation fields, which are computed again
+         from totalDomain when they are accessed. Called when totalDomain
+         is replaced, call it after modifying totalDomain in place.
+        """
+        self._derived.clear()
+        self.durationMaxima = None
+        self.roiDurationMaxima = None
+
+    def _compute_validity(self):
+        return ValidityMask.from_cube(self.totalDomain)
+
+    def _compute_totalSum(self):
+        # missing values count as 0, NaN where no time step is valid
+        if self.bname["prd"] == "AQC":
+            return masked_time_sum(self.totalDomain, self.validity)
+        return masked_time_sum(self.totalDomain, self.validity) / 12.0
+
+    def _compute_totalRoi(self):
+        return open_data.get_totalRoi(self.rectangle, self.totalDomain, self.validity)
+
+    def _compute_totalSumRoiS(self):
+        totalSumRoiS = open_data.get_totalSumRois(self.totalRoi, self.bname["prd"])
+        if self.weights is not None:
+            totalSumRoiS[self.weights == 0] = np.nan
+        return totalSumRoiS
+
+    def _compute_roiSum(self):
+        if self.weights is not None:
+            # areal sums weighted by the covered fraction of every cell
+            return np.tensordot(self.weights, self.totalRoi, axes=2)
+        # missing values of totalRoi are 0, every step is summed once
+        return kernels.step_sums(self.totalRoi)
 
-        self.totalRoi = open_data.get_totalRoi(self.rectangle, self.totalDomain)
-        self.totalSumRoiS = open_data.get_totalSumRois(self.totalRoi, prd)
+    def _compute_intensityOverTime(self):
+        return self.roiSum / np.sum(self.roi_weights())
 
-        self.intensityOverTime = np.average(self.totalRoi, axis=(0, 1))
+    def _compute_sumOverTime(self):
+        if self.bname["prd"] == "AQC":
+            return np.cumsum(self.roiSum) / np.array(self.surfacekm2)
+        return np.cumsum(self.roiSum / 12.0) / np.array(self.surfacekm2)
 
-        if prd == "AQC":
-            self.sumOverTime = np.cumsum(np.sum(self.totalRoi, axis=(0, 1))) / np.array(
-                self.surfacekm2
+    def fetch_duration_maxima(self, durations=duration.DURATIONS, durationMaxima=None):
+        """
+        Maximum accumulation over rolling durations, for every pixel of the
+         domain and for the mean over the region. Requires fetch_precip_data.
+
+        Args:
+        -----
+        durations: list, optional
+         Durations in minutes, multiples of 5. Default is 10 min to 72 h.
+        durationMaxima: dict, optional
+         Already computed maps of the domain, e.g. shared by the regions of
+         a RegionCollection. Default is None (computed from totalDomain).
+
+        Attributes:
+        -----------
+        durationMaxima: dict
+         Per duration a tuple of (y, x) arrays with the maximum
+         accumulation (mm) and the index of the last time step of its window.
+        roiDurationMaxima: dict
+         Per duration a tuple with the maximum accumulation (mm) of the mean
+         over the region and the index of the last time step of its window.
+        """
+        if durationMaxima is None:
+            durationMaxima = duration.duration_maxima(
+                self.totalDomain,
+                durations,
+                self.bname["prd"],
+                validity=self.validity,
+                timeAxis=self.timeAxis,
             )
-        else:
-            self.sumOverTime = np.cumsum(
-                np.sum(self.totalRoi / 12.0, axis=(0, 1))
-            ) / np.array(self.surfacekm2)
+        self.durationMaxima = durationMaxima
+        self.roiDurationMaxima = duration.series_duration_maxima(
+            self.sumOverTime, durations, timeAxis=self.timeAxis
+        )
 
     def fetch_POH_data(self, dir, POHSingleFiles=False):
         """
@@ -149,3 +361,269 @@ class RegionInfo(object):
         self.POH_domain, self.MaxPOHOverTime = open_data.get_POH_domain(
             dir, self.rectangle, POHSingleFiles
         )
+
+
+class RegionCollection(object):
+    """
+    Several regions of interest of the same event, fed from one decoded cube.
+
+    The domain sum is computed once and shared by all regions. The per-region
+     time series are computed together: every block of time steps of the
+     bounding box around all regions is read once and reduced for all regions
+     with one sparse matrix product. In stream mode the validity mask, the
+     domain sum, the duration maxima and the intensity of the domain summary
+     are computed in the same pass, so every file of a lazily decoded cube
+     is decoded once whatever the number of regions.
+
+    Attributes:
+    -----------
+    regions: list
+     The RegionInfo of every region, in the given order.
+    timeAxis: TimeAxis
+     Time axis of the event, shared by all regions.
+    """
+
+    def __init__(self, allFiles, regions, delta_region=20000, timeAxis=None):
+        """
+        Initializes the collection
+
+        Args:
+        -----
+        allFiles: list
+         All files for specific event
+        regions: list
+         (name, regionRectangle) of every region, regionRectangle being the
+         outer bounds as [xmin, xmax, ymin, ymax] or a shapely polygon.
+        delta_region: int, optional
+        timeAxis: TimeAxis, optional
+         Time axis of allFiles. Default is None (built from allFiles).
+        """
+        names = [name for name, __ in regions]
+        if len(set(names)) != len(names):
+            raise ValueError("region names must be unique, they name the output folders")
+        self.timeAxis = timeAxis if timeAxis is not None else TimeAxis(allFiles)
+        self.regions = []
+        for name, area in regions:
+            if hasattr(area, "geom_type"):
+                reg = RegionInfo(
+                    allFiles,
+                    name=name,
+                    delta_region=delta_region,
+                    geometry=area,
+                    timeAxis=self.timeAxis,
+                )
+            else:
+                reg = RegionInfo(
+                    allFiles,
+                    name=name,
+                    regionRectangle=area,
+                    delta_region=delta_region,
+                    timeAxis=self.timeAxis,
+                )
+            self.regions.append(reg)
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def fetch_precip_data(
+        self,
+        dir,
+        totalDomain=None,
+        mmap=False,
+        stream=False,
+        validity=None,
+        durations=None,
+        domainWriter=None,
+    ):
+        """
+        Set the precipitation attributes of RegionInfo.fetch_precip_data
+         for all regions, reading the cube only once.
+
+        Args:
+        -----
+        dir: str
+         Directory containing precipiation files
+        totalDomain: ndarray, optional
+         Already decoded (y, x, time) cube, e.g. from utils.decoder.
+         If None, the cube is read from totalroi.bin in dir.
+        mmap: bool, optional
+         Memory-map totalroi.bin instead of reading it, see
+         open_data.get_totalDomain. Default is False.
+        stream: bool, optional
+         Compute the validity mask, the domain sum and the series of all
+         regions in a single pass over blocks of time steps
+         (tools.accumulate.RegionsAccumulator), as RegionInfo.fetch_precip_data
+         does for one region. totalDomain stays a lazily read cube: the
+         memory-mapped totalroi.bin if None, or e.g. utils.decoder.lazy_precip.
+         Default is False.
+        validity: ValidityMask, optional
+         Valid values of totalDomain, built when it was decoded. Default is
+         None (built from totalDomain, or in the pass of stream).
+        durations: list, optional
+         Also set the attributes of fetch_duration_maxima for these
+         durations (minutes), in the same pass with stream
+         (tools.duration.DurationAccumulator). Default is None.
+        domainWriter: object, optional
+         Fed every block of the pass of stream with its
+         add_block(block, valid), e.g. visualization.summary.DomainSummary
+         writing the intensity of the domain. Default is None.
+
+        Returns:
+        --------
+        None
+        """
+        prd = self.regions[0].bname["prd"]
+        if totalDomain is None:
+            totalDomain, validity = open_data.get_totalDomain(
+                dir, prd, mmap=mmap or stream, return_validity=True
+            )
+
+        bounds, weights = self._box_weights()
+        acc = RegionsAccumulator(
+            bounds, weights, totalDomain.shape[:2], totalDomain.shape[2]
+        )
+        durationAcc = None
+        if stream and durations:
+            durationAcc = duration.DurationAccumulator(
+                totalDomain.shape[:2],
+                totalDomain.shape[2],
+                durations,
+                prd,
+                timeAxis=self.timeAxis,
+            )
+        if stream:
+            # every consumer is fed from the same read (or decoding) of a block
+            for __, block in iter_time_blocks(totalDomain, size=STREAM_STEPS):
+                valid = acc.add_block(block)
+                if durationAcc is not None:
+                    durationAcc.add_block(block, valid)
+                if domainWriter is not None:
+                    domainWriter.add_block(block, valid)
+            validity = acc.validity
+            totalSum = acc.totalSum()
+        else:
+            # one validity mask and domain sum for all regions
+            if validity is None:
+                validity = ValidityMask.from_cube(totalDomain)
+            totalSum = masked_time_sum(totalDomain, validity)
+            rows, cols = acc.box
+            boxPixels = (rows.stop - rows.start) * (cols.stop - cols.start)
+            step = max(1, CHUNK_BYTES // (4 * boxPixels))
+            for start in range(0, totalDomain.shape[2], step):
+                block = np.asarray(totalDomain[rows, cols, start : start + step])
+                stop = start + block.shape[2]
+                acc.add_box(
+                    np.where(validity[rows, cols, start:stop], block, np.float32(0))
+                )
+        if prd != "AQC":
+            totalSum = totalSum / 12.0
+
+        nPixels = np.asarray(weights.sum(axis=1)).ravel()
+        for reg, totalRoi, roiSum, n in zip(
+            self.regions, acc.totalRois, acc.roiSums, nPixels
+        ):
+            reg.totalDomain = totalDomain
+            reg.validity = validity
+            reg.totalSum = totalSum
+            reg.totalRoi = totalRoi
+            reg.totalSumRoiS = open_data.get_totalSumRois(totalRoi, prd)
+            if reg.weights is not None:
+                reg.totalSumRoiS[reg.weights == 0] = np.nan
+            reg.intensityOverTime = roiSum / n
+            if prd != "AQC":
+                roiSum = roiSum / 12.0
+            reg.sumOverTime = np.cumsum(roiSum) / np.array(reg.surfacekm2)
+
+        if durationAcc is not None:
+            durationMaxima = durationAcc.maxima()
+            for reg in self.regions:
+                reg.fetch_duration_maxima(durations, durationMaxima=durationMaxima)
+        elif durations:
+            self.fetch_duration_maxima(durations)
+
+    def _box_weights(self):
+        """
+        Index bounds (y0, y1, x0, x1) of every region and the sparse
+         (region, pixels of the box around all regions) weights: row r holds
+         the weights of the pixels of region r in the box, ones for
+         rectangles and the covered fraction for polygons.
+        """
+        bounds = np.array(
+            [
+                (
+                    coordy2ind(reg.rectangle[3]),
+                    coordy2ind(reg.rectangle[2]),
+                    coordx2ind(reg.rectangle[0]),
+                    coordx2ind(reg.rectangle[1]),
+                )
+                for reg in self.regions
+            ]
+        )
+        y0, x0 = bounds[:, 0].min(), bounds[:, 2].min()
+        y1, x1 = bounds[:, 1].max(), bounds[:, 3].max()
+        boxShape = (y1 - y0, x1 - x0)
+
+        rows, cols, values = [], [], []
+        for r, (reg, (ya, yb, xa, xb)) in enumerate(zip(self.regions, bounds)):
+            pix = np.ravel_multi_index(
+                np.mgrid[ya - y0 : yb - y0, xa - x0 : xb - x0].reshape(2, -1), boxShape
+            )
+            value = reg.roi_weights().ravel()
+            rows.append(np.full(np.count_nonzero(value), r))
+            cols.append(pix[value > 0])
+            values.append(value[value > 0])
+        weights = csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(self.regions), boxShape[0] * boxShape[1]),
+        )
+        return bounds, weights
+
+    def fetch_duration_maxima(self, durations=duration.DURATIONS):
+        """
+        Set the attributes of RegionInfo.fetch_duration_maxima for all
+         regions, computing the maps of the domain only once.
+
+        Args:
+        -----
+        durations: list, optional
+         Durations in minutes, multiples of 5. Default is 10 min to 72 h.
+
+        Returns:
+        --------
+        None
+        """
+        reg = self.regions[0]
+        durationMaxima = duration.duration_maxima(
+            reg.totalDomain,
+            durations,
+            reg.bname["prd"],
+            validity=reg.validity,
+            timeAxis=self.timeAxis,
+        )
+        for reg in self.regions:
+            reg.fetch_duration_maxima(durations, durationMaxima=durationMaxima)
+
+    def fetch_POH_data(self, dir, POHSingleFiles=False):
+        """
+        Set the hail attributes of RegionInfo.fetch_POH_data for all regions,
+         reading every POH file once for all of them.
+
+        Args:
+        -----
+        dir: str
+         Directory containing hail files
+        POHSingleFiles: bool, optional
+
+        Returns:
+        --------
+        None
+        """
+        POH = open_data.get_POH_domains(
+            dir, [reg.rectangle for reg in self.regions], POHSingleFiles
+        )
+        for reg, (POH_domain, MaxPOHOverTime) in zip(self.regions, POH):
+            reg.POH_domain = POH_domain
+            reg.MaxPOHOverTime = MaxPOHOverTime
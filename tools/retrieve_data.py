@@ -1,14 +1,22 @@
 """
 Method for extracting data in specified directory
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import numpy as np
+import re
 import shutil
+import time
 import zipfile
 import os
 
+from tools import manifest
+
 WORKDIR = os.path.abspath(os.path.dirname(__file__))
 
+# product prefix (RZC, CPC, BZC, dBZC, ...) followed by the YYDOYHHMM key
+MEMBER_KEY = re.compile(r"^[A-Za-z]+(\d{9})")
+
 
 def retrieve_input_data(
     start_date,
@@ -18,6 +26,10 @@ def retrieve_input_data(
     prd="RZC",
     get_daily_POH=False,
     get_single_POH=False,
+    n_workers=1,
+    copy_archive=False,
+    cache=None,
+    crowd_archive=None,
 ):
     """Extracts files of a specific product (RZC, CPC, POH and/or hailsize
      crowdsourcedata) from the MeteoSwiss database
@@ -38,6 +50,18 @@ def retrieve_input_data(
      Option to retrieve daily probability of hail product
     get_single_POH: bool, optional
      Option to retrieve 5-min probability of hail product
+    n_workers: int, optional
+     Number of days that are retrieved concurrently. Default is 1 (serial).
+    copy_archive: bool, optional
+     Keep a local copy of every daily zip next to the extracted files.
+     By default the members are read directly from the archive.
+    cache: ArchiveCache, optional
+     Shared cache of daily zip files (see tools.archive_cache). If given,
+     every daily zip is read from the archive only once across jobs.
+    crowd_archive: CrowdsourceArchive, optional
+     Shared archive of the crowdsourced hail reports
+     (tools.crowdsource_archive). If given, the reports are added to it and
+     HailCrowdsource.csv is read from it instead of the copied .prd files.
 
     Returns:
     --------
@@ -57,22 +81,46 @@ def retrieve_input_data(
     if not os.path.exists(sub_dir):
         os.makedirs(sub_dir)
 
-    retrieve_precip(timeserie, prd, archive, sub_dir)
+    retrieve_precip(
+        timeserie,
+        prd,
+        archive,
+        sub_dir,
+        n_workers=n_workers,
+        copy_archive=copy_archive,
+        cache=cache,
+    )
 
     if get_daily_POH:
         hail_path = os.path.join(sub_dir, "POH/")
         if not os.path.exists(hail_path):
             os.makedirs(hail_path)
-        retrieve_POH(timeserie, archive, hail_path, single_POH=get_single_POH)
+        retrieve_POH(
+            timeserie,
+            archive,
+            hail_path,
+            single_POH=get_single_POH,
+            n_workers=n_workers,
+            copy_archive=copy_archive,
+            cache=cache,
+        )
         if get_single_POH:
-            retrieve_hail_crowdsource(timeserie=timeserie, dir=hail_path, transform=True)
+            retrieve_hail_crowdsource(
+                timeserie=timeserie,
+                dir=hail_path,
+                transform=True,
+                crowd_archive=crowd_archive,
+            )
 
     return sub_dir
 
 
-def retrieve_precip(timeserie, prd, archive, dir):
-    """Copies and extracts precipitation (RZC or CPC)
-     from the MeteoSwiss database
+def retrieve_precip(
+    timeserie, prd, archive, dir, n_workers=1, copy_archive=False, cache=None
+):
+    """Extracts precipitation (RZC or CPC) from the MeteoSwiss database.
+     The needed members are read straight from the daily zip in the archive,
+     optionally a local copy of the zip is kept.
 
     Args:
     -----
@@ -84,6 +132,12 @@ def retrieve_precip(timeserie, prd, archive, dir):
      Path to where all the input data is stored and retrieved from.
     dir: str
      The directory where the precipitation data should be saved
+    n_workers: int, optional
+     Number of days that are retrieved concurrently. Default is 1 (serial).
+    copy_archive: bool, optional
+     Copy the daily zip into dir before extracting. Default is False.
+    cache: ArchiveCache, optional
+     Shared cache the daily zip is read through. Default is None.
 
     Returns:
     --------
@@ -101,52 +155,267 @@ def retrieve_precip(timeserie, prd, archive, dir):
     if not os.path.exists(rain_path):
         os.makedirs(rain_path)
 
+    # only fetch timesteps which are not extracted yet, e.g. when the
+    # window of an earlier run is extended
+    base_name, YYDOYS = _missing_timesteps(rain_path, base_name)
+    sources = {YYDOY: _precip_archive_path(archive, prd, YYDOY) for YYDOY in YYDOYS}
+    base_name, YYDOYS = _skip_unavailable(dir, prd, base_name, sources)
+
+    def retrieve_day(YYDOY):
+        src = sources[YYDOY]
+        if cache is not None:
+            src = cache.fetch(src, prd, YYDOY)
+        if copy_archive:
+            dst = os.path.join(dir, prd + YYDOY + ".zip")
+            shutil.copy(src, dst)
+            src = dst
+        _unzip_precip(prd,src,base_name,rain_path)
 
-    for YYDOY in YYDOYS:
-        dst = os.path.join(dir, prd + YYDOY + ".zip")
-        year = "20"+YYDOY[:2]
+    _run_per_day(retrieve_day, YYDOYS, n_workers, label=prd)
+    _record_unavailable(dir, prd, rain_path, base_name, sources)
 
-        if prd == "RZC":
-            try:
-                if archive.startswith("/store"):
-                    src = os.path.join(archive,"data","hdf5",year,YYDOY,f"{prd}{YYDOY}.zip")
-                else:
-                    src = os.path.join(archive,year,YYDOY,f"{prd}{YYDOY}.zip")
-                shutil.copy(src, dst)
-            except FileNotFoundError:
-                if archive.startswith("/store"):
-                    src = os.path.join(archive,"data","hdf5",year,YYDOY,f"{prd}flt{YYDOY}.zip")
-                
-                else:
-                    src = os.path.join(archive,"hdf5",year,YYDOY,f"{prd}flt{YYDOY}.zip")
-                shutil.copy(src, dst)
 
-        elif prd == "CPC":
-            try:
-                src = os.path.join(archive,"data",year,YYDOY,f"{prd}{YYDOY}.zip")
-            except FileNotFoundError:
-                src = os.path.join(archive,year,YYDOY,f"{prd}{YYDOY}.zip")
-            shutil.copy(src, dst)
+def _skip_unavailable(dir, prd, base_name, sources):
+    """
+    Drop the timesteps that an earlier run did not find in the same daily
+     archive files (see tools.manifest.unavailable_timesteps).
+
+    Returns:
+    --------
+    missing: list
+     Timesteps to retrieve.
+    YYDOYS: set
+     Days containing at least one of them.
+    """
+    unavailable = manifest.unavailable_timesteps(dir, prd, sources)
+    missing = [date for date in base_name if date not in unavailable]
+    if len(missing) < len(base_name):
+        print(
+            f"{len(base_name) - len(missing)} timesteps are known to be missing"
+            f" from the {prd} archive and are skipped"
+        )
+    return missing, {date[:5] for date in missing}
+
+
+def _record_unavailable(dir, prd, out_dir, base_name, sources):
+    """
+    Report the requested timesteps that were not found in the archive and
+     record them in the manifest of dir, so later runs skip them.
+    """
+    # only the days that were looked at, the others keep their record
+    retrieved = {date[:5] for date in base_name}
+    sources = {YYDOY: src for YYDOY, src in sources.items() if YYDOY in retrieved}
+    extracted = {member_key(fileName) for fileName in os.listdir(out_dir)}
+    absent = [date for date in base_name if date not in extracted]
+    if absent:
+        print(f"{len(absent)} timesteps are missing from the {prd} archive: {absent}")
+    manifest.record_unavailable(dir, prd, sources, absent)
+
+
+def _missing_timesteps(out_dir, base_name):
+    """
+    Compare the requested timesteps with the files already extracted
+     in out_dir.
+
+    Args:
+    -----
+    out_dir: str
+     Directory the files are extracted to.
+    base_name: list
+     Requested timesteps as YYDOYHHMM.
+
+    Returns:
+    --------
+    missing: list
+     Requested timesteps that are not extracted yet.
+    YYDOYS: set
+     Days containing at least one missing timestep.
+    """
+    extracted = set()
+    for fileName in os.listdir(out_dir):
+        if fileName.endswith(".part"):
+            # left behind by an interrupted extraction
+            os.remove(os.path.join(out_dir, fileName))
+        else:
+            extracted.add(member_key(fileName))
+
+    missing = [date for date in base_name if date not in extracted]
+    if len(missing) < len(base_name):
+        print(
+            f"{len(base_name) - len(missing)} of {len(base_name)} timesteps already extracted"
+        )
+    return missing, {date[:5] for date in missing}
+
+
+def _precip_archive_path(archive, prd, YYDOY):
+    """
+    Locate the daily zip of a precipitation product in the archive.
+
+    Args:
+    -----
+    archive: str
+     Path to where all the input data is stored and retrieved from.
+    prd: str
+     Precipitation product, either RZC or CPC
+    YYDOY: str
+     Day of the archive
+
+    Returns:
+    --------
+    src: str
+     Path to the daily zip file
+    """
+    year = "20"+YYDOY[:2]
+
+    if prd == "RZC":
+        if archive.startswith("/store"):
+            candidates = [
+                os.path.join(archive,"data","hdf5",year,YYDOY,f"{prd}{YYDOY}.zip"),
+                os.path.join(archive,"data","hdf5",year,YYDOY,f"{prd}flt{YYDOY}.zip"),
+            ]
+        else:
+            candidates = [
+                os.path.join(archive,year,YYDOY,f"{prd}{YYDOY}.zip"),
+                os.path.join(archive,"hdf5",year,YYDOY,f"{prd}flt{YYDOY}.zip"),
+            ]
+    else:
+        candidates = [
+            os.path.join(archive,"data",year,YYDOY,f"{prd}{YYDOY}.zip"),
+            os.path.join(archive,year,YYDOY,f"{prd}{YYDOY}.zip"),
+        ]
+
+    for src in candidates:
+        if os.path.exists(src):
+            return src
+    raise FileNotFoundError(f"no {prd} archive found for {YYDOY} in {archive}")
+
+
+def _run_per_day(func, YYDOYS, n_workers=1, label=""):
+    """
+    Runs func(YYDOY) for every day, either serially or on a bounded
+     pool of worker threads, and reports how long each day took.
+     Every day writes to its own files, so the result does not depend
+     on the number of workers.
+
+    Args:
+    -----
+    func: callable
+     Function retrieving the data of a single day, called as func(YYDOY).
+    YYDOYS: set
+     Days (YYDOY) to retrieve.
+    n_workers: int, optional
+     Maximum number of days that are processed concurrently. Default is 1.
+    label: str, optional
+     Name of the retrieved product, used in the timing report.
+
+    Returns:
+    --------
+    timings: dict
+     Seconds spent per YYDOY.
+    """
+
+    def timed(YYDOY):
+        start = time.perf_counter()
+        func(YYDOY)
+        return YYDOY, time.perf_counter() - start
+
+    YYDOYS = sorted(YYDOYS)
+    n_workers = max(1, min(int(n_workers), len(YYDOYS)))
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            timings = list(pool.map(timed, YYDOYS))
+    else:
+        timings = [timed(YYDOY) for YYDOY in YYDOYS]
+
+    for YYDOY, seconds in timings:
+        print(f"{label} {YYDOY} retrieved in {seconds:.1f} s")
+    return dict(timings)
+
+
+def member_key(fileName):
+    """
+    Extract the YYDOYHHMM key from the name of an archive member,
+     e.g. "RZC221851600VL.801.h5" or "CPC2218516000_00005.801.gif".
+
+    Args:
+    -----
+    fileName: str
+     Name of the member within the zip file.
+
+    Returns:
+    --------
+    key: str or None
+     The YYDOYHHMM timestamp of the member, None if the name has no timestamp.
+    """
+    match = MEMBER_KEY.match(os.path.basename(fileName))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def index_members(files):
+    """
+    Index the members of a daily archive by their YYDOYHHMM key.
+     Works for all products stored as {prd}YYDOYHHMM* (RZC, CPC, BZC, dBZCH).
+
+    Args:
+    -----
+    files: list
+     Member names, e.g. the output of ZipFile.namelist().
 
-        _unzip_precip(prd,dst,base_name,rain_path)
+    Returns:
+    --------
+    index: dict
+     Mapping from YYDOYHHMM to the list of members with that timestamp.
+    """
+    index = {}
+    for fileName in files:
+        key = member_key(fileName)
+        if key is not None:
+            index.setdefault(key, []).append(fileName)
+    return index
+
+
+def _select_members(zipObject, base_name):
+    index = index_members(zipObject.namelist())
+    keys = sorted(index.keys() & set(base_name))
+    return [fileName for key in keys for fileName in index[key]]
+
+
+def _extract(zipObject, fileName, out_dir):
+    # write to a temporary name first, so that an interrupted run never
+    # leaves a truncated file that looks extracted
+    target = os.path.join(out_dir, fileName)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        with zipObject.open(fileName) as src, open(target + ".part", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(target + ".part", target)
+    finally:
+        if os.path.exists(target + ".part"):
+            os.remove(target + ".part")
 
 
 def _unzip_precip(prd,src,base_name,rain_path):
     if prd == "RZC":
         with zipfile.ZipFile(src, "r") as zipObject:
-            files = zipObject.namelist()
-            filtered_files = [file for file in files if any(date in file for date in base_name)]
-            for fileName in filtered_files:
-                zipObject.extract(fileName, rain_path)
+            for fileName in _select_members(zipObject, base_name):
+                _extract(zipObject, fileName, rain_path)
     elif prd == "CPC":
         with zipfile.ZipFile(src, "r") as zipObject:
-            files = zipObject.namelist()
-            filtered_files = [file for file in files if any(date in file for date in base_name)]
-            for fileName in filtered_files:
+            for fileName in _select_members(zipObject, base_name):
                 if fileName.endswith("00005.801.gif"):
-                    zipObject.extract(fileName, rain_path)
+                    _extract(zipObject, fileName, rain_path)
 
-def retrieve_POH(timeserie, archive, dir, single_POH=False):
+def retrieve_POH(
+    timeserie,
+    archive,
+    dir,
+    single_POH=False,
+    n_workers=1,
+    copy_archive=False,
+    cache=None,
+):
     """
     Retrieve POH data for a given date and
      optionally extract single 5-min POH files,
@@ -163,6 +432,12 @@ def retrieve_POH(timeserie, archive, dir, single_POH=False):
     single_POH: bool, optional
      Indicates whether to also retrieve the single
      5-min POH files. Defaults to False.
+    n_workers: int, optional
+     Number of days that are retrieved concurrently. Default is 1 (serial).
+    copy_archive: bool, optional
+     Copy the daily 5-min POH zip into dir before extracting. Default is False.
+    cache: ArchiveCache, optional
+     Shared cache the daily zips are read through. Default is None.
 
     Returns:
     --------
@@ -175,7 +450,10 @@ def retrieve_POH(timeserie, archive, dir, single_POH=False):
         base_name[i] = date.strftime("%y%j%H%M")
         YYDOYS.add(base_name[i][:5])
 
-    for YYDOY in YYDOYS:
+    if single_POH:
+        os.makedirs(os.path.join(dir, "SingleFiles"), exist_ok=True)
+
+    def retrieve_day(YYDOY):
         year = "20"+YYDOY[:2]
         if archive.startswith("/store"):
             src = os.path.join(archive,"data","hdf5",year,YYDOY,f"dBZCH{YYDOY}.zip")
@@ -184,6 +462,8 @@ def retrieve_POH(timeserie, archive, dir, single_POH=False):
         print(type(src))
         # src = f"/store/msrad/radar/swiss/hdf5/{year}/{YYDOY}/dBZCH{YYDOY}.zip"
         if os.path.exists(src):
+            if cache is not None:
+                src = cache.fetch(src, "dBZCH", YYDOY)
             _unzip_daily_POH(src,dir)
         else:
             print("daily POH file does not exist in this format")
@@ -196,9 +476,15 @@ def retrieve_POH(timeserie, archive, dir, single_POH=False):
             if not os.path.exists(src):
                 src = os.path.join(archive,year,YYDOY,f"BZCH{YYDOY}.zip")
             # src = f"/store/msrad/radar/swiss/hdf5/{year}/{YYDOY}/BZCH{YYDOY}.zip"
-            dst = os.path.join(dir, f"BZCH{YYDOY}.zip")
-            shutil.copy(src, dst)
-            _unzip_single_POH(dst,base_name,out_dir=dir)
+            if cache is not None:
+                src = cache.fetch(src, "BZCH", YYDOY)
+            if copy_archive:
+                dst = os.path.join(dir, f"BZCH{YYDOY}.zip")
+                shutil.copy(src, dst)
+                src = dst
+            _unzip_single_POH(src,base_name,out_dir=dir)
+
+    _run_per_day(retrieve_day, YYDOYS, n_workers, label="POH")
 
 
 def _unzip_daily_POH(src,out_dir):
@@ -210,15 +496,12 @@ def _unzip_daily_POH(src,out_dir):
 
 def _unzip_single_POH(src,base_name,out_dir):
     hail_dir = os.path.join(out_dir,"SingleFiles")
-    if not os.path.exists(hail_dir):
-        os.makedirs(hail_dir)    
+    os.makedirs(hail_dir, exist_ok=True)
     with zipfile.ZipFile(src, "r") as zipObject:
-        files = zipObject.namelist()
-        filtered_files = [file for file in files if any(date in file for date in base_name)]
-        for fileName in filtered_files:
+        for fileName in _select_members(zipObject, base_name):
             zipObject.extract(fileName,hail_dir)    
 
-def retrieve_hail_crowdsource(timeserie, dir, transform=True):
+def retrieve_hail_crowdsource(timeserie, dir, transform=True, crowd_archive=None):
     """
     Retrieve hail crowdsource data for a given date and optionally transform it.
 
@@ -230,6 +513,10 @@ def retrieve_hail_crowdsource(timeserie, dir, transform=True):
      The directory where the crowdsource data should be saved.
     transform: bool, optional
      Indicates whether to transform the crowdsource data. Defaults to True.
+    crowd_archive: CrowdsourceArchive, optional
+     Shared archive of the reports (tools.crowdsource_archive). The days
+     missing in it are added from the .prd files, which are not copied to
+     dir, and the .csv file is read from it. Defaults to None.
 
     Returns:
     --------
@@ -240,32 +527,43 @@ def retrieve_hail_crowdsource(timeserie, dir, transform=True):
     for date in timeserie:
         YYDOYS.add(date.strftime("%y%j"))
 
+    available = []
     for YYDOY in YYDOYS:
         # get crowdsource data
         crs_path = f"/store/msrad/crowdsourcing/hail/HQX/HQX{YYDOY}0000.prd"
         
         if os.path.isfile(crs_path):
 
-            dst = os.path.join(dir, f"{YYDOY}_crowdsource.prd")
-            shutil.copy(crs_path, dst)
-
-            if transform:
-                transform_crowdsource(YYDOY, dir)
+            if crowd_archive is not None:
+                crowd_archive.add_day(YYDOY, crs_path)
+            else:
+                dst = os.path.join(dir, f"{YYDOY}_crowdsource.prd")
+                shutil.copy(crs_path, dst)
+            available.append(YYDOY)
 
         else:
             print(f"no crowdsource data available on {YYDOY}")
 
+    if transform and available:
+        if crowd_archive is not None:
+            _crowdsource_from_archive(available, dir, crowd_archive)
+        else:
+            transform_crowdsource(available, dir)
+
 
 def transform_crowdsource(YYDOY, hail_dir):
     """
     Transform crowdsource data from the .prd
-     format to a .csv format with Swiss coordinates
+     format to a .csv format with Swiss coordinates (LV95).
+     The parsed reports of every day are cached in {YYDOY}_crowdsource.npz
+     (utils.crowdsource.load_day), so later runs do not parse the .prd again.
 
     Args:
     -----
-    YYDOY: str
-     The YYDOY identifier for the crowdsource data
-    dir: str
+    YYDOY: str or list
+     The YYDOY identifier for the crowdsource data, or several of them,
+     whose reports are all written to the .csv file.
+    hail_dir: str
      The directory containing the .prd file and
      where the .csv file will be saved
 
@@ -273,35 +571,36 @@ def transform_crowdsource(YYDOY, hail_dir):
     --------
     None
     """
+    from utils import crowdsource
+
+    YYDOYS = [YYDOY] if isinstance(YYDOY, str) else list(YYDOY)
+    _write_crowdsource_csv(crowdsource.load_days(YYDOYS, hail_dir), hail_dir)
+
+
+def _crowdsource_from_archive(YYDOYS, hail_dir, crowd_archive):
+    # reports of whole days, read from the partitions of the shared archive
+    days = sorted(datetime.strptime(YYDOY, "%y%j") for YYDOY in YYDOYS)
+    start = np.datetime64(days[0], "s")
+    end = np.datetime64(days[-1] + timedelta(days=1), "s") - np.timedelta64(1, "s")
+    _write_crowdsource_csv(crowd_archive.query(start=start, end=end), hail_dir)
+
+
+def _write_crowdsource_csv(reports, hail_dir):
     import pandas as pd
-    import pyproj
 
-    df = pd.read_csv(
-        os.path.join(hail_dir, YYDOY + "_crowdsource.prd"),
-        sep=" ",
-        header=None,
-    )
-    df = df.dropna(axis=1)
-    df = df.drop(columns=[8])
-    df = df.rename(columns={2: "time", 4: "ycoord", 6: "xcoord", 7: "hailsize"})
-    df["time"] = pd.to_datetime(df["time"], unit="s")
-
-    # Set up the transformation from LV03 to LV95
-    lv95 = pyproj.Proj(init="epsg:2056")
-    lv03 = pyproj.Proj(init="epsg:21781")
-
-    # Convert the coordinates
-    x_lv95, y_lv95 = pyproj.transform(
-        lv03, lv95, df["xcoord"] * 1000, df["ycoord"] * 1000
+    df = pd.DataFrame(
+        {
+            "time": pd.to_datetime(reports["time"]),
+            "ycoord": reports["ycoord"],
+            "xcoord": reports["xcoord"],
+            "hailsize": reports["hailsize"],
+        }
     )
-    df["xcoord"] = x_lv95
-    df["ycoord"] = y_lv95
-
     df.to_csv(os.path.join(hail_dir, "HailCrowdsource.csv"), index=False)
 
 
 def access_local_data(start_date,end_date,prd,input_dir,output_dir,get_daily_POH=False,
-    get_single_POH=False):
+    get_single_POH=False,n_workers=1,copy_archive=False,cache=None,crowd_archive=None):
 
     n_incr = int((end_date-start_date).total_seconds() / (60 * 5))
     timeserie = start_date + np.array(
@@ -329,22 +628,61 @@ def access_local_data(start_date,end_date,prd,input_dir,output_dir,get_daily_POH
     if not os.path.exists(hail_path):
         os.makedirs(hail_path)
 
-    for YYDOY in YYDOYS:
-        input_rain = os.path.join(input_dir, prd + YYDOY + ".zip")
-        output_rain = os.path.join(sub_dir,f"{prd}_{YYDOY}.zip")
-        shutil.copy(input_rain,output_rain)
-        _unzip_precip(prd,input_rain,base_name,rain_path)
+    if get_single_POH:
+        os.makedirs(os.path.join(hail_path, "SingleFiles"), exist_ok=True)
+
+    missing, missing_YYDOYS = _missing_timesteps(rain_path, base_name)
+    sources = {
+        YYDOY: os.path.join(input_dir, prd + YYDOY + ".zip") for YYDOY in missing_YYDOYS
+    }
+    missing, missing_YYDOYS = _skip_unavailable(sub_dir, prd, missing, sources)
+
+    def retrieve_day(YYDOY):
+        if YYDOY in missing_YYDOYS:
+            input_rain = os.path.join(input_dir, prd + YYDOY + ".zip")
+            if cache is not None:
+                input_rain = cache.fetch(input_rain, prd, YYDOY)
+            if copy_archive:
+                output_rain = os.path.join(sub_dir,f"{prd}_{YYDOY}.zip")
+                shutil.copy(input_rain,output_rain)
+            _unzip_precip(prd,input_rain,missing,rain_path)
 
         if get_daily_POH:
             input_dPOH = os.path.join(input_dir, f"dBZCH{YYDOY}.zip")
+            if cache is not None:
+                input_dPOH = cache.fetch(input_dPOH, "dBZCH", YYDOY)
             _unzip_daily_POH(input_dPOH,hail_path)
         if get_single_POH:
             input_sPOH = os.path.join(input_dir, f"BZC{YYDOY}.zip")
+            if cache is not None:
+                input_sPOH = cache.fetch(input_sPOH, "BZC", YYDOY)
             _unzip_single_POH(input_sPOH,base_name,hail_path)
             crs_path = os.path.join(input_dir,f"HQX{YYDOY}0000.prd")
-            if os.path.isfile(crs_path):
-                transform_crowdsource(YYDOY, dir)
+            if crowd_archive is not None and os.path.isfile(crs_path):
+                crowd_archive.add_day(YYDOY, crs_path)
+            elif os.path.isfile(crs_path):
+                shutil.copy(crs_path, os.path.join(hail_path, f"{YYDOY}_crowdsource.prd"))
             else:
                 print(f"no crowdsource data available on {YYDOY}")    
 
+    _run_per_day(retrieve_day, YYDOYS, n_workers, label=prd)
+    _record_unavailable(sub_dir, prd, rain_path, missing, sources)
+
+    if get_single_POH and crowd_archive is not None:
+        available = [
+            YYDOY
+            for YYDOY in YYDOYS
+            if os.path.isfile(os.path.join(input_dir, f"HQX{YYDOY}0000.prd"))
+        ]
+        if available:
+            _crowdsource_from_archive(available, hail_path, crowd_archive)
+    elif get_single_POH:
+        available = [
+            YYDOY
+            for YYDOY in YYDOYS
+            if os.path.isfile(os.path.join(hail_path, f"{YYDOY}_crowdsource.prd"))
+        ]
+        if available:
+            transform_crowdsource(available, hail_path)
+
     return sub_dir
\ No newline at end of file
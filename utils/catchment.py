@@ -0,0 +1,165 @@
+"""
+Methods for polygon regions of interest (e.g. catchments) on the 1 km grid
+"""
+import hashlib
+import os
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix, load_npz, save_npz
+
+from utils.transformation import coordx2ind, coordy2ind
+
+# grid of the radar products (LV95, 1 km), as in coordx2ind/coordy2ind
+X_MIN = 2255000
+Y_MAX = 1480000
+RESOLUTION = 1000
+GRID_SHAPE = (640, 710)
+
+WEIGHTS_DIR = os.path.join(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..")), "common", "weights"
+)
+
+
+def load_catchments(path, name_field=None):
+    """
+    Load polygons from a shapefile or GeoJSON file.
+
+    Args:
+    -----
+    path: str
+     Path to the file, any format read by geopandas.
+    name_field: str, optional
+     Column holding the name of each polygon. Default is None,
+     the polygons are then named after their index.
+
+    Returns:
+    --------
+    catchments: list
+     (name, geometry) of every polygon, in LV95 (EPSG:2056).
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(path)
+    if gdf.crs is not None and gdf.crs.to_epsg() != 2056:
+        gdf = gdf.to_crs(epsg=2056)
+    if name_field is None:
+        names = [str(index) for index in gdf.index]
+    else:
+        names = [str(name) for name in gdf[name_field]]
+    return list(zip(names, gdf.geometry))
+
+
+def bounding_rectangle(geometry):
+    """
+    Smallest rectangle on whole kilometres containing a polygon,
+     clipped to the domain.
+
+    Args:
+    -----
+    geometry: shapely.Geometry
+     Polygon in LV95 coordinates.
+
+    Returns:
+    --------
+    rectangle: list
+     Bounds as [xmin, xmax, ymin, ymax].
+    """
+    xmin, ymin, xmax, ymax = geometry.bounds
+    x_max = X_MIN + GRID_SHAPE[1] * RESOLUTION
+    y_min = Y_MAX - GRID_SHAPE[0] * RESOLUTION
+    return [
+        int(max(np.floor(xmin / RESOLUTION) * RESOLUTION, X_MIN)),
+        int(min(np.ceil(xmax / RESOLUTION) * RESOLUTION, x_max)),
+        int(max(np.floor(ymin / RESOLUTION) * RESOLUTION, y_min)),
+        int(min(np.ceil(ymax / RESOLUTION) * RESOLUTION, Y_MAX)),
+    ]
+
+
+def _rasterize(geometry, rectangle):
+    rows = np.arange(coordy2ind(rectangle[3]), coordy2ind(rectangle[2]))
+    cols = np.arange(coordx2ind(rectangle[0]), coordx2ind(rectangle[1]))
+    col, row = np.meshgrid(cols, rows)
+    x0 = X_MIN + col * RESOLUTION
+    y1 = Y_MAX - row * RESOLUTION
+    cells = shapely.box(x0, y1 - RESOLUTION, x0 + RESOLUTION, y1)
+
+    shapely.prepare(geometry)
+    coverage = np.zeros(cells.shape, dtype=np.float32)
+    inside = shapely.contains_properly(geometry, cells)
+    coverage[inside] = 1.0
+    edge = ~inside & shapely.intersects(geometry, cells)
+    coverage[edge] = shapely.area(shapely.intersection(cells[edge], geometry)) / (
+        RESOLUTION**2
+    )
+    return row, col, coverage
+
+
+def coverage_weights(geometry, cache_dir=WEIGHTS_DIR):
+    """
+    Fraction of every 1 km cell of the domain covered by a polygon.
+     The result is cached on disk under the hash of the geometry, so every
+     catchment is rasterized only once.
+
+    Args:
+    -----
+    geometry: shapely.Geometry
+     Polygon in LV95 coordinates.
+    cache_dir: str, optional
+     Directory of the cached weights, None disables the cache.
+     Default is common/weights.
+
+    Returns:
+    --------
+    weights: csr_matrix
+     A 1 x (640 * 710) sparse matrix of coverage fractions in [0, 1], the
+     cells numbered row by row as in the (y, x) fields.
+    """
+    path = None
+    if cache_dir is not None:
+        ident = shapely.to_wkb(geometry) + f"{X_MIN}|{Y_MAX}|{RESOLUTION}|{GRID_SHAPE}".encode()
+        path = os.path.join(cache_dir, hashlib.sha1(ident).hexdigest() + ".npz")
+        if os.path.exists(path):
+            return load_npz(path).tocsr()
+
+    row, col, coverage = _rasterize(geometry, bounding_rectangle(geometry))
+    hit = coverage > 0
+    weights = csr_matrix(
+        (
+            coverage[hit],
+            (np.zeros(np.count_nonzero(hit), dtype=int), row[hit] * GRID_SHAPE[1] + col[hit]),
+        ),
+        shape=(1, GRID_SHAPE[0] * GRID_SHAPE[1]),
+    )
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        save_npz(tmp, weights)
+        os.replace(tmp, path)
+    return weights
+
+
+def roi_weights(geometry, rectangle, cache_dir=WEIGHTS_DIR):
+    """
+    Coverage fractions of a polygon on the cells of a rectangle.
+
+    Args:
+    -----
+    geometry: shapely.Geometry
+     Polygon in LV95 coordinates.
+    rectangle: list
+     Bounds as [xmin, xmax, ymin, ymax], e.g. from bounding_rectangle.
+    cache_dir: str, optional
+     Directory of the cached weights. Default is common/weights.
+
+    Returns:
+    --------
+    weights: ndarray
+     A 2-dimensional float32 array with the (y, x) shape of the rectangle.
+    """
+    weights = coverage_weights(geometry, cache_dir=cache_dir).toarray()
+    weights = weights.reshape(GRID_SHAPE).astype(np.float32)
+    return weights[
+        coordy2ind(rectangle[3]) : coordy2ind(rectangle[2]),
+        coordx2ind(rectangle[0]) : coordx2ind(rectangle[1]),
+    ]
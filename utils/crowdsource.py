@@ -0,0 +1,360 @@
+"""
+Methods for reading the crowdsourced hail reports (HQX .prd files)
+"""
+import os
+from functools import lru_cache
+import numpy as np
+
+from utils.timeaxis import round_times
+
+
+@lru_cache(maxsize=None)
+def _lv03_to_lv95():
+    from pyproj import Transformer
+
+    return Transformer.from_crs("EPSG:21781", "EPSG:2056", always_xy=True)
+
+
+def lv03_to_lv95(x, y):
+    """
+    Transform Swiss LV03 coordinates to LV95 with one cached Transformer.
+
+    Args:
+    -----
+    x: ndarray
+     Easting (m) in LV03.
+    y: ndarray
+     Northing (m) in LV03.
+
+    Returns:
+    --------
+    x: ndarray
+     Easting (m) in LV95.
+    y: ndarray
+     Northing (m) in LV95.
+    """
+    return _lv03_to_lv95().transform(np.asarray(x), np.asarray(y))
+
+
+def parse_prd(path):
+    """
+    Parse a crowdsource .prd file, reading only the needed columns with
+     fixed types.
+
+    Args:
+    -----
+    path: str
+     Path of the .prd file, space-separated with the unix time in the
+     3rd, the y and x coordinates (km, LV03) in the 5th and 7th and the hail
+     size class in the 8th field.
+
+    Returns:
+    --------
+    reports: dict
+     Arrays "time" (datetime64[s]), "xcoord" and "ycoord" (m, LV03) and
+     "hailsize", one value per report.
+    """
+    import pandas as pd
+
+    if os.path.getsize(path) == 0:
+        # no report on that day
+        return {
+            "time": np.array([], dtype="datetime64[s]"),
+            "xcoord": np.array([]),
+            "ycoord": np.array([]),
+            "hailsize": np.array([]),
+        }
+    df = pd.read_csv(
+        path,
+        sep=" ",
+        header=None,
+        usecols=[2, 4, 6, 7],
+        dtype={2: np.float64, 4: np.float64, 6: np.float64, 7: np.float64},
+        engine="c",
+    ).dropna(axis=0)
+    return {
+        "time": df[2].to_numpy().astype(np.int64).astype("datetime64[s]"),
+        "xcoord": df[6].to_numpy() * 1000,
+        "ycoord": df[4].to_numpy() * 1000,
+        "hailsize": df[7].to_numpy(),
+    }
+
+
+def prd_path(YYDOY, hail_dir):
+    return os.path.join(hail_dir, YYDOY + "_crowdsource.prd")
+
+
+def cache_path(YYDOY, hail_dir):
+    return os.path.join(hail_dir, YYDOY + "_crowdsource.npz")
+
+
+def load_day(YYDOY, hail_dir):
+    """
+    Reports of one day in LV95 coordinates. The parsed and transformed
+     reports are cached in {YYDOY}_crowdsource.npz next to the .prd file,
+     which is parsed again only if it is newer than the cache.
+
+    Args:
+    -----
+    YYDOY: str
+     The YYDOY identifier of the day.
+    hail_dir: str
+     Directory containing {YYDOY}_crowdsource.prd.
+
+    Returns:
+    --------
+    reports: dict
+     Arrays "time" (datetime64[s]), "xcoord" and "ycoord" (m, LV95) and
+     "hailsize", sorted by time.
+    """
+    prd = prd_path(YYDOY, hail_dir)
+    cache = cache_path(YYDOY, hail_dir)
+    if os.path.exists(cache) and (
+        not os.path.exists(prd) or os.path.getmtime(cache) >= os.path.getmtime(prd)
+    ):
+        with np.load(cache) as npz:
+            return {key: npz[key] for key in npz.files}
+
+    reports = parse_prd(prd)
+    reports["xcoord"], reports["ycoord"] = lv03_to_lv95(
+        reports["xcoord"], reports["ycoord"]
+    )
+    order = np.argsort(reports["time"], kind="stable")
+    reports = {key: value[order] for key, value in reports.items()}
+
+    tmp = f"{cache}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, **reports)
+    os.replace(tmp, cache)
+    return reports
+
+
+def load_days(YYDOYS, hail_dir):
+    """
+    Reports of several days, see load_day. Days without a .prd file or
+     cache are skipped.
+
+    Args:
+    -----
+    YYDOYS: list
+     The YYDOY identifiers of the days.
+    hail_dir: str
+     Directory containing the .prd files.
+
+    Returns:
+    --------
+    reports: dict
+     Arrays "time", "xcoord", "ycoord" and "hailsize", sorted by time.
+    """
+    days = [
+        load_day(YYDOY, hail_dir)
+        for YYDOY in sorted(YYDOYS)
+        if os.path.exists(prd_path(YYDOY, hail_dir))
+        or os.path.exists(cache_path(YYDOY, hail_dir))
+    ]
+    if not days:
+        return {
+            "time": np.array([], dtype="datetime64[s]"),
+            "xcoord": np.array([]),
+            "ycoord": np.array([]),
+            "hailsize": np.array([]),
+        }
+    return {key: np.concatenate([day[key] for day in days]) for key in days[0]}
+
+
+def event_days(times):
+    """
+    YYDOY identifiers of the days covered by times.
+
+    Args:
+    -----
+    times: array_like
+     Times convertible to datetime64, e.g. TimeAxis.times.
+
+    Returns:
+    --------
+    YYDOYS: list
+     Sorted YYDOY strings.
+    """
+    days = np.unique(np.asarray(times, dtype="datetime64[D]"))
+    return [day.strftime("%y%j") for day in days.astype(object)]
+
+
+class CrowdsourceIndex(object):
+    """
+    Hail reports sorted by time and binned to the nearest 5 min, with an
+     R-tree over their locations. Selections by region and time window are
+     array queries: the time window is a binary search in the sorted bins,
+     the region an R-tree query (or a vectorized test on the reports of a
+     short time window).
+
+    Attributes:
+    -----------
+    time: ndarray
+     datetime64[s] time of every report, sorted.
+    bins: ndarray
+     datetime64[s] time rounded to the nearest 5 min.
+    xcoord: ndarray
+     Easting (m, LV95) of every report.
+    ycoord: ndarray
+     Northing (m, LV95) of every report.
+    hailsize: ndarray
+     Hail size class of every report.
+    """
+
+    def __init__(self, reports):
+        """
+        Initializes the index
+
+        Args:
+        -----
+        reports: dict
+         Arrays "time", "xcoord", "ycoord" (LV95) and "hailsize", e.g. from
+         load_days.
+        """
+        time = np.asarray(reports["time"], dtype="datetime64[s]")
+        order = np.argsort(time, kind="stable")
+        self.time = time[order]
+        self.bins = round_times(self.time)
+        self.xcoord = np.asarray(reports["xcoord"], dtype=np.float64)[order]
+        self.ycoord = np.asarray(reports["ycoord"], dtype=np.float64)[order]
+        self.hailsize = np.asarray(reports["hailsize"])[order]
+        self._rtree = None
+
+    @classmethod
+    def from_days(cls, YYDOYS, hail_dir):
+        """
+        Index of the reports of several days, see load_days.
+        """
+        return cls(load_days(YYDOYS, hail_dir))
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Index of the reports of a HailCrowdsource.csv file.
+        """
+        import pandas as pd
+
+        df = pd.read_csv(path, usecols=["time", "xcoord", "ycoord", "hailsize"])
+        return cls(
+            {
+                "time": pd.to_datetime(df["time"]).to_numpy(),
+                "xcoord": df["xcoord"].to_numpy(),
+                "ycoord": df["ycoord"].to_numpy(),
+                "hailsize": df["hailsize"].to_numpy(),
+            }
+        )
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def rtree(self):
+        # bulk-loaded on the first spatial query over a long time window
+        if self._rtree is None:
+            from rtree import index
+
+            points = np.column_stack(
+                (self.xcoord, self.ycoord, self.xcoord, self.ycoord)
+            )
+            self._rtree = index.Index(
+                (i, tuple(point), None) for i, point in enumerate(points)
+            )
+        return self._rtree
+
+    def query(self, rectangle=None, geometry=None, start=None, end=None):
+        """
+        Reports within a region and a time window.
+
+        Args:
+        -----
+        rectangle: list, optional
+         Bounds (xmin, xmax, ymin, ymax), included. Default is None.
+        geometry: shapely.Geometry, optional
+         Polygon in LV95, the reports inside it are selected.
+         Default is None.
+        start: datetime64, optional
+         First 5-min bin. Default is None (from the first report).
+        end: datetime64, optional
+         Last 5-min bin, included. Default is None (to the last report).
+
+        Returns:
+        --------
+        index: ndarray
+         Sorted indices of the selected reports.
+        """
+        t0, t1 = 0, len(self)
+        if start is not None:
+            t0 = np.searchsorted(self.bins, np.datetime64(start, "s"))
+        if end is not None:
+            t1 = np.searchsorted(self.bins, np.datetime64(end, "s"), side="right")
+        if geometry is not None and rectangle is None:
+            xmin, ymin, xmax, ymax = geometry.bounds
+            rectangle = (xmin, xmax, ymin, ymax)
+
+        if rectangle is None:
+            index = np.arange(t0, t1)
+        elif 8 * (t1 - t0) < len(self) or t1 - t0 < 10000:
+            # short window: test the reports of the window
+            x, y = self.xcoord[t0:t1], self.ycoord[t0:t1]
+            inside = (
+                (x >= rectangle[0])
+                & (x <= rectangle[1])
+                & (y >= rectangle[2])
+                & (y <= rectangle[3])
+            )
+            index = t0 + np.flatnonzero(inside)
+        else:
+            box = (rectangle[0], rectangle[2], rectangle[1], rectangle[3])
+            index = np.sort(np.fromiter(self.rtree.intersection(box), dtype=np.int64))
+            index = index[(index >= t0) & (index < t1)]
+
+        if geometry is not None:
+            import shapely
+
+            inside = shapely.contains_xy(geometry, self.xcoord[index], self.ycoord[index])
+            index = index[inside]
+        return index
+
+    def select(self, **kwargs):
+        """
+        Reports selected by query, as a dict of arrays.
+        """
+        index = self.query(**kwargs)
+        return {
+            "time": self.time[index],
+            "bins": self.bins[index],
+            "xcoord": self.xcoord[index],
+            "ycoord": self.ycoord[index],
+            "hailsize": self.hailsize[index],
+        }
+
+    def max_per_slot(self, timeAxis, rectangle=None, geometry=None):
+        """
+        Largest hail size reported in every 5-min slot of a time axis.
+
+        Args:
+        -----
+        timeAxis: TimeAxis
+         The time axis of the event (utils.timeaxis).
+        rectangle: list, optional
+         Bounds (xmin, xmax, ymin, ymax) of the region. Default is None.
+        geometry: shapely.Geometry, optional
+         Polygon of the region. Default is None.
+
+        Returns:
+        --------
+        hailsize: ndarray
+         float array with one value per slot, NaN without report.
+        """
+        index = self.query(
+            rectangle=rectangle,
+            geometry=geometry,
+            start=timeAxis.start,
+            end=timeAxis.times[-1],
+        )
+        slots = timeAxis.slot_of(self.bins[index])
+        onAxis = slots >= 0
+        series = np.full(len(timeAxis), -np.inf)
+        np.maximum.at(series, slots[onAxis], self.hailsize[index][onAxis])
+        series[np.isinf(series)] = np.nan
+        return series
@@ -0,0 +1,227 @@
+"""
+Lazy access to the precipitation cube of an event
+"""
+import numpy as np
+
+from utils import kernels
+
+# number of bytes read at once when iterating over the time axis
+CHUNK_BYTES = 256 * 1024**2
+
+
+def iter_time_blocks(totalDomain, size=None):
+    """
+    Iterate over a (y, x, time) cube in blocks of consecutive time steps.
+
+    Args:
+    -----
+    totalDomain: ndarray
+     (y, x, time) array or LazyCube.
+    size: int, optional
+     Number of time steps per block. Default keeps a block below
+     CHUNK_BYTES.
+
+    Returns:
+    --------
+    blocks: generator
+     Yields (start, block), block being a (y, x, n) array.
+    """
+    if hasattr(totalDomain, "iter_chunks"):
+        yield from totalDomain.iter_chunks(size)
+        return
+    ny, nx, nt = totalDomain.shape
+    if size is None:
+        size = max(1, CHUNK_BYTES // (ny * nx * totalDomain.dtype.itemsize))
+    for start in range(0, nt, size):
+        yield start, totalDomain[:, :, start : start + size]
+
+
+class LazyCube(object):
+    """
+    (y, x, time) view on a cube stored as (time, y, x), e.g. a np.memmap
+     of totalroi.bin or the cube_store.StoreVariable of totalroi.nc. Nothing is read when the view is created: indexing
+     reads only the requested elements and returns an ndarray in which all
+     negative values are set to -1, as open_data.get_totalDomain does for
+     the whole cube. The stored data is never modified.
+
+    Supports the parts of the ndarray interface used on RegionInfo.totalDomain:
+     shape, basic indexing (integers and slices) and np.sum(cube, axis=2).
+
+    Attributes:
+    -----------
+    data: ndarray
+     The (time, y, x) array the view is based on.
+    shape: tuple
+     Shape (y, x, time) of the view.
+    """
+
+    def __init__(self, data):
+        """
+        Initializes the view
+
+        Args:
+        -----
+        data: ndarray or netCDF4.Variable
+         (time, y, x) array, typically a read-only np.memmap or a
+         cube_store.StoreVariable.
+        """
+        self.data = data
+        self.shape = data.shape[1:] + data.shape[:1]
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        # indexing always returns float32
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ky, kx, kt = key + (slice(None),) * (3 - len(key))
+        # index the stored (time, y, x) layout directly, so a chunked store
+        # only reads the chunks overlapping the selection
+        block = self._values(np.asarray(self.data[kt, ky, kx]))
+        if not isinstance(kt, (int, np.integer)):
+            block = np.moveaxis(block, 0, -1)
+        return block
+
+    def _values(self, raw):
+        block = np.array(raw, dtype=np.float32)
+        block[block < 0] = -1.0
+        return block
+
+    def chunk_size(self):
+        """
+        Number of time steps read at once by iter_chunks.
+        """
+        frame_bytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+        return max(1, CHUNK_BYTES // frame_bytes)
+
+    def iter_chunks(self, size=None):
+        """
+        Iterate over the cube in blocks of consecutive time steps.
+
+        Args:
+        -----
+        size: int, optional
+         Number of time steps per block. Default keeps a block
+         below CHUNK_BYTES.
+
+        Returns:
+        --------
+        chunks: generator
+         Yields (start, block), block being a (y, x, n) ndarray with
+         negatives set to -1 for time steps start to start + n.
+        """
+        if size is None:
+            size = self.chunk_size()
+        for start in range(0, self.shape[2], size):
+            yield start, self[:, :, start : start + size]
+
+    def sum(self, axis=None, dtype=None, out=None, keepdims=False, **kwargs):
+        """
+        Sum of the cube, computed block by block over the time axis so that
+         only one block is held in memory. Called by np.sum(cube, ...).
+        """
+        if axis not in (2, -1):
+            return np.sum(self[:, :, :], axis=axis, dtype=dtype, out=out, keepdims=keepdims)
+
+        total = np.zeros(self.shape[:2], dtype=dtype or np.float32)
+        for __, block in self.iter_chunks():
+            total += kernels.time_sum(block)
+        if keepdims:
+            total = total[:, :, np.newaxis]
+        if out is not None:
+            out[...] = total
+            return out
+        return total
+
+
+class QuantizedCube(LazyCube):
+    """
+    (y, x, time) view on a cube of class indices stored as (time, y, x),
+     e.g. the 8-bit palette indices of the RZC/CPC GIF files. The cube takes
+     one (uint8) or two (uint16) bytes per pixel instead of four, and is only
+     converted to precipitation (mm/h) through the lookup table for the
+     elements that are accessed, block by block for np.sum(cube, axis=2).
+
+    Attributes:
+    -----------
+    data: ndarray
+     The (time, y, x) uint8 or uint16 array of class indices.
+    lut: ndarray
+     float32 lookup table from class index to precipitation (mm/h),
+     no-data classes are -1.
+    shape: tuple
+     Shape (y, x, time) of the view.
+    """
+
+    def __init__(self, data, lut):
+        """
+        Initializes the view
+
+        Args:
+        -----
+        data: ndarray
+         (time, y, x) array of class indices.
+        lut: ndarray
+         Lookup table with an entry for every possible index of data.
+        """
+        super().__init__(data)
+        self.lut = np.asarray(lut, dtype=np.float32)
+        self.lut = np.where(self.lut < 0, np.float32(-1.0), self.lut)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def _values(self, raw):
+        return np.take(self.lut, raw)
+
+
+def quantize(values, lut, out=None):
+    """
+    Map precipitation values (mm/h) to the index of the nearest class
+     of a lookup table. Values on the class scale (e.g. RZC HDF5 fields)
+     are mapped without loss, negative and non-finite values go to a
+     no-data class, values above the scale to its top class.
+
+    Args:
+    -----
+    values: ndarray
+     Precipitation (mm/h).
+    lut: ndarray
+     Lookup table from class index to precipitation (mm/h), no-data
+     classes are negative.
+    out: ndarray, optional
+     Integer array the indices are written into.
+
+    Returns:
+    --------
+    indices: ndarray
+     uint8 indices for tables of up to 256 entries, uint16 otherwise.
+    """
+    lut = np.asarray(lut, dtype=np.float32)
+    dtype = np.uint8 if len(lut) <= 256 else np.uint16
+    valid = np.flatnonzero(lut >= 0)
+    order = valid[np.argsort(lut[valid], kind="stable")]
+    classes = lut[order]
+
+    pos = np.clip(np.searchsorted(classes, values), 1, len(classes) - 1)
+    nearest = np.where(
+        np.abs(values - classes[pos - 1]) <= np.abs(classes[pos] - values),
+        pos - 1,
+        pos,
+    )
+    indices = order[nearest]
+    indices[~np.isfinite(values) | (values < 0)] = np.flatnonzero(lut < 0)[-1]
+    if out is None:
+        return indices.astype(dtype)
+    out[...] = indices
+    return out
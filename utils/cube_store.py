@@ -0,0 +1,280 @@
+"""
+Chunked, compressed storage of the precipitation cube (totalroi.nc),
+replacing the raw totalroi.bin/totalroi.json pair
+"""
+import json
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+from utils.timeaxis import parse_times
+
+STORE = "totalroi.nc"
+
+# default chunk: one hour of 5-min steps on 64 x 64 km tiles
+CHUNKS = (12, 64, 64)
+
+PROJ4 = (
+    "+proj=somerc +lat_0=46.95240555555556 +lon_0=7.439583333333333 +k_0=1 "
+    "+x_0=2600000 +y_0=1200000 +ellps=bessel "
+    "+towgs84=674.374,15.056,405.346,0,0,0,0 +units=m +no_defs"
+)
+
+
+def _time_axis(frames):
+    dates = parse_times(frames)
+    return dates, (dates - dates[0]) // np.timedelta64(1, "m")
+
+
+def write_cube_store(dir, cube, prd, frames, fmt, chunks=CHUNKS, complevel=4):
+    """
+    Write a (time, y, x) cube to a chunked, compressed netCDF4 store.
+
+    Args:
+    -----
+    dir: str
+     Directory where totalroi.nc is written.
+    cube: ndarray
+     (time, y, x) float32 array, e.g. a np.memmap of totalroi.bin.
+     It is written in blocks of chunks[0] time steps.
+    prd: str
+     The product, either "RZC" or "CPC".
+    frames: list
+     Base names of the 5-min files, one per time step.
+    fmt: str
+     Format of the 5-min files, ".h5" or ".gif".
+    chunks: tuple, optional
+     Chunk size as (time steps, rows, columns). Reading a subset only
+     decompresses the chunks it overlaps. Default is CHUNKS.
+    complevel: int, optional
+     zlib compression level. Default is 4.
+
+    Returns:
+    --------
+    path: str
+     Path to the written store.
+    """
+    nt, ny, nx = cube.shape
+    chunks = (min(chunks[0], max(nt, 1)), min(chunks[1], ny), min(chunks[2], nx))
+    dates, minutes = _time_axis(frames)
+
+    path = os.path.join(dir, STORE)
+    tmp = path + ".tmp"
+    with Dataset(tmp, "w", format="NETCDF4") as nc:
+        nc.setncattr("prd", prd)
+        nc.setncattr("fmt", fmt)
+        nc.setncattr("proj4", PROJ4)
+        nc.setncattr("x_min", 2255000)
+        nc.setncattr("y_max", 1480000)
+        nc.setncattr("resolution", 1000)
+
+        nc.createDimension("time", None)
+        nc.createDimension("y", ny)
+        nc.createDimension("x", nx)
+
+        time = nc.createVariable("time", np.float64, ("time",))
+        time.units = f'minutes since {str(dates[0]).replace("T", " ")} UTC'
+        frame = nc.createVariable("frame", str, ("time",))
+
+        precip = nc.createVariable(
+            "precip",
+            np.float32,
+            ("time", "y", "x"),
+            zlib=True,
+            complevel=complevel,
+            shuffle=True,
+            chunksizes=chunks,
+        )
+        precip.units = "mm/h"
+        precip.long_name = "Intensity"
+
+        time[:] = minutes
+        for i, name in enumerate(frames):
+            frame[i] = name
+        for start in range(0, nt, chunks[0]):
+            stop = min(start + chunks[0], nt)
+            precip[start:stop] = cube[start:stop]
+    os.replace(tmp, path)
+    return path
+
+
+def append_cube_store(dir, cube, prd, frames):
+    """
+    Append time steps to an existing store.
+
+    Args:
+    -----
+    dir: str
+     Directory containing totalroi.nc.
+    cube: ndarray
+     (time, y, x) array with the additional time steps.
+    prd: str
+     The product of the additional time steps, must be the one of the store.
+    frames: list
+     Base names of the 5-min files of the additional time steps.
+
+    Returns:
+    --------
+    None
+    """
+    with Dataset(os.path.join(dir, STORE), "a") as nc:
+        if nc.getncattr("prd") != prd:
+            raise ValueError(
+                f"cannot append {prd} time steps to a store of {nc.getncattr('prd')}"
+            )
+        precip = nc["precip"]
+        if precip.shape[1:] != cube.shape[1:]:
+            raise ValueError("time steps do not match the grid of the store")
+        start = precip.shape[0]
+        first = parse_times([str(nc["frame"][0])])[0]
+        step = precip.chunking()[0]
+        for i in range(0, cube.shape[0], step):
+            stop = min(i + step, cube.shape[0])
+            precip[start + i : start + stop] = cube[i:stop]
+        minutes = (parse_times(frames) - first) // np.timedelta64(1, "m")
+        for i, name in enumerate(frames):
+            nc["frame"][start + i] = name
+            nc["time"][start + i] = minutes[i]
+
+
+def bin_to_cube_store(dir, frames, chunks=CHUNKS, complevel=4):
+    """
+    Convert the totalroi.bin/totalroi.json written by pexp into totalroi.nc
+     and remove the raw files.
+
+    Args:
+    -----
+    dir: str
+     Directory containing totalroi.bin and totalroi.json.
+    frames: list
+     Base names of the 5-min files contained in totalroi.bin.
+    chunks: tuple, optional
+     Chunk size as (time steps, rows, columns). Default is CHUNKS.
+    complevel: int, optional
+     zlib compression level. Default is 4.
+
+    Returns:
+    --------
+    None
+    """
+    with open(os.path.join(dir, "totalroi.json")) as f:
+        meta = json.loads(f.readlines()[0])
+    shape = (int(meta["z"]), int(meta["height"]), int(meta["width"]))
+    cube = np.memmap(
+        os.path.join(dir, "totalroi.bin"), dtype=np.dtype("f"), mode="r", shape=shape
+    )
+    write_cube_store(
+        dir, cube, meta["prd"], frames, meta["fmt"], chunks=chunks, complevel=complevel
+    )
+    del cube
+    os.remove(os.path.join(dir, "totalroi.bin"))
+    os.remove(os.path.join(dir, "totalroi.json"))
+
+
+def append_bin_to_cube_store(dir, part_dir, frames):
+    """
+    Append the totalroi.bin of part_dir (decoded additional time steps)
+     to the totalroi.nc of dir.
+
+    Args:
+    -----
+    dir: str
+     Directory containing totalroi.nc.
+    part_dir: str
+     Directory containing totalroi.bin and totalroi.json of the
+     additional time steps.
+    frames: list
+     Base names of the 5-min files of the additional time steps.
+
+    Returns:
+    --------
+    None
+    """
+    with open(os.path.join(part_dir, "totalroi.json")) as f:
+        meta = json.loads(f.readlines()[0])
+    shape = (int(meta["z"]), int(meta["height"]), int(meta["width"]))
+    cube = np.memmap(
+        os.path.join(part_dir, "totalroi.bin"),
+        dtype=np.dtype("f"),
+        mode="r",
+        shape=shape,
+    )
+    append_cube_store(dir, cube, meta["prd"], frames)
+
+
+class StoreVariable(object):
+    """
+    The precip variable of totalroi.nc, opened for every read so that no
+     file handle is kept open between reads. Wrapped in a LazyCube by
+     open_data.get_store_domain.
+
+    Attributes:
+    -----------
+    path: str
+     Path of totalroi.nc.
+    shape: tuple
+     Shape (time, y, x) of the stored cube.
+    """
+
+    def __init__(self, dir):
+        """
+        Initializes the variable
+
+        Args:
+        -----
+        dir: str
+         Directory containing totalroi.nc.
+        """
+        self.path = os.path.join(dir, STORE)
+        with Dataset(self.path) as nc:
+            self.shape = nc["precip"].shape
+
+    def __getitem__(self, key):
+        with Dataset(self.path) as nc:
+            precip = nc["precip"]
+            precip.set_auto_mask(False)
+            return precip[key]
+
+
+def stored_frames(dir):
+    """
+    Base names of the 5-min files stored in totalroi.nc, in the order
+     of its time axis.
+
+    Args:
+    -----
+    dir: str
+     Directory containing totalroi.nc.
+
+    Returns:
+    --------
+    frames: list
+     The stored file names.
+    """
+    with Dataset(os.path.join(dir, STORE)) as nc:
+        return [str(name) for name in nc["frame"][:]]
+
+
+def get_store_meta(dir):
+    """
+    Metadata of totalroi.nc in the format of totalroi.json.
+
+    Args:
+    -----
+    dir: str
+     Directory containing totalroi.nc.
+
+    Returns:
+    --------
+    meta: dict
+     width, height, z, prd and fmt of the stored cube.
+    """
+    with Dataset(os.path.join(dir, STORE)) as nc:
+        nt, ny, nx = nc["precip"].shape
+        return {
+            "width": str(nx),
+            "height": str(ny),
+            "z": str(nt),
+            "prd": nc.getncattr("prd"),
+            "fmt": nc.getncattr("fmt"),
+        }
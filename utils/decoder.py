@@ -0,0 +1,486 @@
+"""
+Methods for decoding 5-min precipitation files in-process, as an
+alternative to the pexp binary and its totalroi.bin/totalroi.json output
+"""
+import math
+import os
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from netCDF4 import Dataset
+from PIL import Image
+
+from utils.cube import LazyCube, QuantizedCube, quantize
+from utils.validity import ValidityMask
+from visualization.utils import colorscale, colorscale_rzc, get_rainscale_lut
+
+
+def read_hdf5_frame(file, out=None):
+    """
+    Read the precipitation field (mm/h) of a single HDF5 file,
+     as done by pexp (dataset /dataset1/data1/data, no scaling).
+
+    Args:
+    -----
+    file: str
+     Path to the .h5 file.
+    out: ndarray, optional
+     2-dimensional float32 array the field is written into.
+
+    Returns:
+    --------
+    frame: ndarray
+     A 2-dimensional array (y, x) containing the precipitation (mm/h).
+    """
+    with Dataset(file) as nc:
+        data = nc["dataset1"]["data1"]["data"]
+        data.set_auto_maskandscale(False)
+        if out is None:
+            out = np.empty(data.shape, dtype=np.float32)
+        out[:] = data[:]
+    return out
+
+
+def read_gif_indices(file, out=None):
+    """
+    Read the 8-bit palette indices of a single GIF file.
+
+    Args:
+    -----
+    file: str
+     Path to the .gif file.
+    out: ndarray, optional
+     2-dimensional uint8 array the indices are written into.
+
+    Returns:
+    --------
+    indices: ndarray
+     A 2-dimensional uint8 array (y, x) containing the palette indices.
+    """
+    with Image.open(file) as im:
+        if im.mode not in ("P", "L"):
+            raise ValueError(f"{file} is not a palette image")
+        indices = np.asarray(im)
+    if out is None:
+        return indices.copy()
+    out[:] = indices
+    return out
+
+
+def get_lut(prd):
+    """
+    Get the lookup table from palette index to precipitation (mm/h)
+     for a product, with all no-data values set to -1.
+
+    Args:
+    -----
+    prd: str
+     The product, "CPC" uses the CPC color scale, all others the
+     Metranet color scale.
+
+    Returns:
+    --------
+    lut: ndarray
+     A float32 array with 256 entries.
+    """
+    if prd == "CPC":
+        lut = get_rainscale_lut(colorscale)
+    else:
+        lut = get_rainscale_lut(colorscale_rzc)
+    return np.where(lut < 0, np.float32(-1.0), lut)
+
+
+def read_gif_stack(allFiles):
+    """
+    Read the palette indices of a stack of GIF files.
+
+    Args:
+    -----
+    allFiles: list
+     Sorted list of filenames of the 5-min .gif files.
+
+    Returns:
+    --------
+    indices: ndarray
+     A 3-dimensional (time, y, x) uint8 array of palette indices.
+    """
+    first = read_gif_indices(allFiles[0])
+    indices = np.empty((len(allFiles),) + first.shape, dtype=np.uint8)
+    indices[0] = first
+    for i, file in enumerate(allFiles[1:], start=1):
+        read_gif_indices(file, out=indices[i])
+    return indices
+
+
+def decode_gif_stack(allFiles, out=None):
+    """
+    Decode a stack of GIF files to precipitation (mm/h). The palette
+     indices of all files are collected first and then mapped to mm/h
+     with a single lookup in the color scale table.
+
+    Args:
+    -----
+    allFiles: list
+     Sorted list of filenames of the 5-min .gif files.
+    out: ndarray, optional
+     3-dimensional (time, y, x) float32 array the result is written into.
+
+    Returns:
+    --------
+    cube: ndarray
+     A 3-dimensional (time, y, x) float32 array containing the
+     precipitation (mm/h), missing values are -1.
+    """
+    indices = read_gif_stack(allFiles)
+    lut = get_lut(os.path.basename(allFiles[0])[:3])
+    if out is None:
+        out = np.empty(indices.shape, dtype=np.float32)
+    np.take(lut, indices, out=out)
+    return out
+
+
+def frame_shape(file):
+    """
+    Get the (y, x) shape of the field stored in a 5-min file.
+
+    Args:
+    -----
+    file: str
+     Path to the .h5 or .gif file.
+
+    Returns:
+    --------
+    shape: tuple
+     Number of rows and columns of the field.
+    """
+    if file.endswith(".gif"):
+        with Image.open(file) as im:
+            return im.size[::-1]
+    with Dataset(file) as nc:
+        return nc["dataset1"]["data1"]["data"].shape
+
+
+def _decode_into(files, out, packed=None):
+    """
+    Decode 5-min files into a preallocated (time, y, x) float32 block and
+     optionally set the bits of their valid values (see
+     utils.validity.ValidityMask) in the (time, bytes) uint8 array packed.
+    """
+    fmt = os.path.splitext(files[0])[1]
+    if fmt == ".gif":
+        decode_gif_stack(files, out=out)
+        if packed is not None:
+            for i in range(len(files)):
+                packed[i] = np.packbits(out[i] >= 0, axis=None)
+    elif fmt == ".h5":
+        for i, file in enumerate(files):
+            frame = read_hdf5_frame(file, out=out[i])
+            valid = frame >= 0
+            frame[~valid] = -1.0
+            if packed is not None:
+                packed[i] = np.packbits(valid, axis=None)
+    else:
+        raise ValueError(f"no in-process decoder for {fmt} files, use pexp")
+
+
+def decode_precip(allFiles, return_validity=False):
+    """
+    Decode all 5-min files of an event into one cube, without writing
+     and reading back totalroi.bin.
+
+    The cube is allocated once with the time step as outermost dimension,
+     so every file is decoded into a contiguous block. The returned array is
+     a (y, x, t) view on it, oriented like open_data.get_totalDomain.
+
+    Args:
+    -----
+    allFiles: list
+     Sorted list of filenames of the 5-min files, either .h5 or .gif.
+    return_validity: bool, optional
+     Also return the mask of the valid values, set while the files are
+     decoded. Default is False.
+
+    Returns:
+    --------
+    totalDomain: ndarray
+     A 3D float32 array containing the precipitation (mm/h) over the entire
+     domain, with dimensions (y, x, time). Missing values are set to -1.
+    validity: ValidityMask
+     Only if return_validity, the valid values of totalDomain.
+    """
+    shape = tuple(frame_shape(allFiles[0]))
+    cube = np.empty((len(allFiles),) + shape, dtype=np.float32)
+    validity = ValidityMask.empty(shape + (len(allFiles),))
+    _decode_into(allFiles, cube, validity.packed)
+    if return_validity:
+        return np.moveaxis(cube, 0, -1), validity
+    return np.moveaxis(cube, 0, -1)
+
+
+class FileStack(object):
+    """
+    (time, y, x) array-like over the 5-min files of an event, which only
+     decodes the files of the time steps that are indexed.
+
+    Attributes:
+    -----------
+    files: list
+     Sorted list of filenames of the 5-min files, either .h5 or .gif.
+    shape: tuple
+     Shape (time, y, x) of the stack.
+    """
+
+    def __init__(self, allFiles):
+        """
+        Initializes the stack
+
+        Args:
+        -----
+        allFiles: list
+         Sorted list of filenames of the 5-min files, either .h5 or .gif.
+        """
+        self.files = list(allFiles)
+        self.shape = (len(self.files),) + tuple(frame_shape(self.files[0]))
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        kt, ky, kx = key
+        if isinstance(kt, (int, np.integer)):
+            block = np.empty((1,) + self.shape[1:], dtype=np.float32)
+            _decode_into([self.files[kt]], block)
+            return block[0][ky, kx]
+        files = self.files[kt]
+        block = np.empty((len(files),) + self.shape[1:], dtype=np.float32)
+        if files:
+            _decode_into(files, block)
+        return block[:, ky, kx]
+
+
+def lazy_precip(allFiles):
+    """
+    Get lazy access to the precipitation of the 5-min files of an event,
+     without decoding them upfront.
+
+    Args:
+    -----
+    allFiles: list
+     Sorted list of filenames of the 5-min files, either .h5 or .gif.
+
+    Returns:
+    --------
+    totalDomain: LazyCube
+     The precipitation (mm/h) over the entire domain, with dimensions
+     (y, x, time). The files of the accessed time steps are decoded on
+     every access. Missing values are -1.
+    """
+    return LazyCube(FileStack(allFiles))
+
+
+def decode_precip_quantized(allFiles, return_validity=False):
+    """
+    Decode all 5-min files of an event into a cube of 8-bit class indices
+     of the color scale, a quarter of the size of the float32 cube.
+     GIF files are stored as they are, the fields of HDF5 files are mapped
+     to the nearest class.
+
+    Args:
+    -----
+    allFiles: list
+     Sorted list of filenames of the 5-min files, either .h5 or .gif.
+    return_validity: bool, optional
+     Also return the mask of the valid values, set while the files are
+     decoded. Default is False.
+
+    Returns:
+    --------
+    totalDomain: QuantizedCube
+     The precipitation (mm/h) over the entire domain, with dimensions
+     (y, x, time), converted through the color scale when accessed.
+     Missing values are -1.
+    validity: ValidityMask
+     Only if return_validity, the valid values of totalDomain.
+    """
+    lut = get_lut(os.path.basename(allFiles[0])[:3])
+    fmt = os.path.splitext(allFiles[0])[1]
+    if fmt not in (".gif", ".h5"):
+        raise ValueError(f"no in-process decoder for {fmt} files, use pexp")
+
+    shape = tuple(frame_shape(allFiles[0]))
+    validity = ValidityMask.empty(shape + (len(allFiles),))
+    if fmt == ".gif":
+        indices = read_gif_stack(allFiles)
+        validClass = lut >= 0
+        for i in range(len(allFiles)):
+            validity.set_frame(i, validClass[indices[i]])
+    else:
+        indices = np.empty((len(allFiles),) + shape, dtype=np.uint8)
+        frame = np.empty(shape, dtype=np.float32)
+        for i, file in enumerate(allFiles):
+            read_hdf5_frame(file, out=frame)
+            validity.set_frame(i, np.isfinite(frame) & (frame >= 0))
+            quantize(frame, lut, out=indices[i])
+    if return_validity:
+        return QuantizedCube(indices, lut), validity
+    return QuantizedCube(indices, lut)
+
+
+class SharedCube(object):
+    """
+    A (time, y, x) float32 cube held in multiprocessing.shared_memory,
+     which worker processes decode into directly, followed in the same block
+     by the bits of its valid values (see utils.validity.ValidityMask),
+     which the workers set while decoding.
+
+    Arrays obtained from the cube keep a reference to it, so the shared
+     memory stays mapped as long as any view on it (e.g. the totalDomain
+     of a RegionInfo) exists, and is released after the last one is gone.
+
+    Attributes:
+    -----------
+    shm: SharedMemory
+     The shared memory block holding the cube and its validity bits.
+    shape: tuple
+     Shape (time, y, x) of the cube.
+    """
+
+    def __init__(self, shape):
+        """
+        Allocate a shared cube
+
+        Args:
+        -----
+        shape: tuple
+         Shape (time, y, x) of the cube.
+        """
+        self.shape = tuple(shape)
+        nbytes = _packed_offset(shape) + math.prod(_packed_shape(shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        self._address = np.ndarray(
+            (0,), dtype=np.uint8, buffer=self.shm.buf
+        ).ctypes.data
+
+    @property
+    def __array_interface__(self):
+        return {
+            "shape": self.shape,
+            "typestr": np.dtype(np.float32).str,
+            "data": (self._address, False),
+            "version": 3,
+        }
+
+    @property
+    def cube(self):
+        """
+        The (time, y, x) array on the shared memory.
+        """
+        return np.asarray(self)
+
+    @property
+    def totalDomain(self):
+        """
+        (y, x, time) view on the cube, oriented like open_data.get_totalDomain.
+        """
+        return np.moveaxis(np.asarray(self), 0, -1)
+
+    @property
+    def validity(self):
+        """
+        ValidityMask of the cube, on the shared memory.
+        """
+        packed = np.asarray(
+            _SharedBits(self, self._address + _packed_offset(self.shape))
+        )
+        return ValidityMask(packed, self.shape[1:] + self.shape[:1])
+
+    def unlink(self):
+        """
+        Remove the name of the shared memory block, after which no other
+         process can attach to it anymore.
+        """
+        self.shm.unlink()
+
+
+class _SharedBits(object):
+    # array interface of the validity bits of a SharedCube, arrays obtained
+    # from it keep the cube alive
+
+    def __init__(self, owner, address):
+        self.owner = owner
+        self.__array_interface__ = {
+            "shape": _packed_shape(owner.shape),
+            "typestr": np.dtype(np.uint8).str,
+            "data": (address, False),
+            "version": 3,
+        }
+
+
+def _packed_shape(shape):
+    nt, ny, nx = shape
+    return (nt, (ny * nx + 7) // 8)
+
+
+def _packed_offset(shape):
+    # the bits follow the float32 cube
+    return math.prod(shape) * np.dtype(np.float32).itemsize
+
+
+def _decode_chunk(task):
+    name, shape, start, files = task
+    # workers only borrow the block, the parent owns (and unlinks) it
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        cube = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        packed = np.ndarray(
+            _packed_shape(shape),
+            dtype=np.uint8,
+            buffer=shm.buf,
+            offset=_packed_offset(shape),
+        )
+        stop = start + len(files)
+        _decode_into(files, cube[start:stop], packed[start:stop])
+        del cube, packed
+    finally:
+        shm.close()
+    return start
+
+
+def decode_precip_parallel(allFiles, n_workers=None, chunksize=None):
+    """
+    Decode all 5-min files of an event with several worker processes.
+     Every worker decodes a chunk of consecutive files straight into a
+     cube in shared memory, so nothing is copied back to the parent.
+
+    Args:
+    -----
+    allFiles: list
+     Sorted list of filenames of the 5-min files, either .h5 or .gif.
+    n_workers: int, optional
+     Number of worker processes. Default is the number of CPUs.
+    chunksize: int, optional
+     Number of consecutive files per task. Default spreads the files over
+     four tasks per worker.
+
+    Returns:
+    --------
+    shared: SharedCube
+     The decoded cube, shared.totalDomain is the (y, x, time) view and
+     shared.validity the mask of its valid values to pass to
+     RegionInfo.fetch_precip_data. Missing values are set to -1.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, math.ceil(len(allFiles) / (4 * n_workers)))
+
+    shape = (len(allFiles),) + tuple(frame_shape(allFiles[0]))
+    shared = SharedCube(shape)
+    tasks = [
+        (shared.shm.name, shape, start, list(allFiles[start : start + chunksize]))
+        for start in range(0, len(allFiles), chunksize)
+    ]
+    try:
+        with Pool(processes=n_workers) as pool:
+            pool.map(_decode_chunk, tasks, chunksize=1)
+    finally:
+        # the parent keeps its mapping, the name is no longer needed
+        shared.unlink()
+    return shared
@@ -0,0 +1,205 @@
+"""
+Reduction kernels over the precipitation cube, parallelized with numba
+with a NumPy fallback
+"""
+import os
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # pragma: no cover - numba is in requirements.txt
+    njit = None
+
+# "numba" or "numpy", can be changed at runtime with set_backend
+BACKEND = os.environ.get("EXPERTISE_KERNELS", "numba")
+
+
+def set_backend(name):
+    """
+    Select the implementation of the kernels.
+
+    Args:
+    -----
+    name: str
+     "numba" for the parallel kernels, "numpy" for plain NumPy.
+
+    Returns:
+    --------
+    None
+    """
+    global BACKEND
+    if name not in ("numba", "numpy"):
+        raise ValueError(f"unknown kernel backend {name}")
+    BACKEND = name
+
+
+def _use_numba():
+    return BACKEND == "numba" and njit is not None
+
+
+if njit is not None:
+
+    # the kernels take the cube in its stored (time, y, x) layout, so the
+    # inner loops run over contiguous rows
+
+    @njit(parallel=True, cache=True)
+    def _time_sum_nb(stored, acc, out):
+        # acc: zeroed (y, x) float64 scratch, allocated once by the caller
+        nt, ny, nx = stored.shape
+        for i in prange(ny):
+            for t in range(nt):
+                for j in range(nx):
+                    acc[i, j] += stored[t, i, j]
+            for j in range(nx):
+                out[i, j] = acc[i, j]
+
+    @njit(parallel=True, cache=True)
+    def _step_sums_nb(stored, out):
+        nt, ny, nx = stored.shape
+        for t in prange(nt):
+            acc = 0.0
+            for i in range(ny):
+                for j in range(nx):
+                    if stored[t, i, j] > 0:
+                        acc += stored[t, i, j]
+            out[t] = acc
+
+    @njit(parallel=True, cache=True)
+    def _masked_time_sum_nb(stored, packed, acc, count, out):
+        # acc, count: zeroed (y, x) float64 and int64 scratch
+        nt, ny, nx = stored.shape
+        for i in prange(ny):
+            for t in range(nt):
+                for j in range(nx):
+                    k = i * nx + j
+                    # bit k of the frame, in the big-endian order of np.packbits
+                    if (packed[t, k >> 3] >> (7 - (k & 7))) & 1:
+                        acc[i, j] += stored[t, i, j]
+                        count[i, j] += 1
+            for j in range(nx):
+                out[i, j] = acc[i, j] if count[i, j] > 0 else np.nan
+
+    @njit(parallel=True, cache=True)
+    def _rolling_max_nb(cumsum, n_steps, value, end):
+        nt1, ny, nx = cumsum.shape
+        for i in prange(ny):
+            for j in range(nx):
+                best = cumsum[n_steps, i, j] - cumsum[0, i, j]
+                best_t = 0
+                for t in range(1, nt1 - n_steps):
+                    window = cumsum[t + n_steps, i, j] - cumsum[t, i, j]
+                    if window > best:
+                        best = window
+                        best_t = t
+                value[i, j] = best
+                end[i, j] = best_t + n_steps - 1
+
+
+def time_sum(cube):
+    """
+    Sum over the time axis, np.sum(cube, axis=2).
+
+    Args:
+    -----
+    cube: ndarray
+     (y, x, time) array, or a LazyCube (summed block by block).
+
+    Returns:
+    --------
+    total: ndarray
+     (y, x) float32 sum.
+    """
+    if not isinstance(cube, np.ndarray):
+        return np.sum(cube, axis=2)
+    if not _use_numba():
+        return np.sum(cube, axis=2, dtype=np.float32)
+    out = np.empty(cube.shape[:2], dtype=np.float32)
+    _time_sum_nb(np.moveaxis(cube, -1, 0), np.zeros(cube.shape[:2]), out)
+    return out
+
+
+def masked_time_sum(cube, packed):
+    """
+    Sum over the time axis of the values marked valid in a bit-packed mask
+     (see utils.validity.ValidityMask), NaN where no value is valid.
+
+    Args:
+    -----
+    cube: ndarray
+     (y, x, time) array.
+    packed: ndarray
+     (time, ceil(y * x / 8)) uint8 array of np.packbits bits per time step.
+
+    Returns:
+    --------
+    total: ndarray
+     (y, x) float32 sum.
+    """
+    ny, nx, nt = cube.shape
+    if not _use_numba():
+        valid = np.unpackbits(packed, axis=1, count=ny * nx).reshape(nt, ny, nx)
+        stored = np.moveaxis(cube, -1, 0)
+        total = np.sum(np.where(valid.view(bool), stored, 0), axis=0, dtype=np.float64)
+        total[~np.any(valid, axis=0)] = np.nan
+        return total.astype(np.float32)
+    out = np.empty((ny, nx), dtype=np.float32)
+    _masked_time_sum_nb(
+        np.moveaxis(cube, -1, 0),
+        packed,
+        np.zeros((ny, nx)),
+        np.zeros((ny, nx), dtype=np.int64),
+        out,
+    )
+    return out
+
+
+def step_sums(cube):
+    """
+    Sum of the positive values of every time step, e.g. of a region of
+     interest in which missing values are negative or already 0.
+
+    Args:
+    -----
+    cube: ndarray
+     (y, x, time) array.
+
+    Returns:
+    --------
+    sums: ndarray
+     float64 sum per time step.
+    """
+    if not _use_numba():
+        return np.sum(np.maximum(cube, 0), axis=(0, 1), dtype=np.float64)
+    out = np.empty(cube.shape[2], dtype=np.float64)
+    _step_sums_nb(np.moveaxis(cube, -1, 0), out)
+    return out
+
+
+def rolling_max(cumsum, n_steps):
+    """
+    Maximum of cumsum[t + n_steps] - cumsum[t] along the first axis and the
+     index of the last time step of that window (first one if tied).
+
+    Args:
+    -----
+    cumsum: ndarray
+     (time + 1, y, x) cumulative sum starting with a zero row.
+    n_steps: int
+     Length of the window in time steps.
+
+    Returns:
+    --------
+    value: ndarray
+     (y, x) maximum window sum.
+    end: ndarray
+     (y, x) index of the last time step of the window.
+    """
+    if not _use_numba():
+        windows = cumsum[n_steps:] - cumsum[:-n_steps]
+        end = np.argmax(windows, axis=0)
+        value = np.take_along_axis(windows, end[np.newaxis], axis=0)[0]
+        return value, end + n_steps - 1
+    value = np.empty(cumsum.shape[1:], dtype=cumsum.dtype)
+    end = np.empty(cumsum.shape[1:], dtype=np.int64)
+    _rolling_max_nb(cumsum, n_steps, value, end)
+    return value, end
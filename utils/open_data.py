@@ -4,16 +4,34 @@ Methods for opening and processing data
 
 import glob
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from netCDF4 import Dataset
 import json
 
+from utils import kernels
+from utils.cube import LazyCube
+from utils.cube_store import STORE, StoreVariable, get_store_meta
+from utils.timeaxis import parse_times
+from utils.validity import ValidityMask
 from utils.transformation import coordx2ind, coordy2ind
 
+# threads reading the 5-min POH files
+POH_WORKERS = 8
+
+# the HDF5 library is not thread-safe
+_HDF5_LOCK = threading.Lock()
+
+# bounds of the radar domain as (xmin, xmax, ymin, ymax)
+DOMAIN = (2255000, 2965000, 840000, 1480000)
+
 
 def get_meta(dir):
     """
-    Load metadata from a JSON file.
+    Load metadata from a JSON file, or from the attributes of totalroi.nc
+     if the cube is stored there.
 
     Args:
     -----
@@ -25,6 +43,10 @@ def get_meta(dir):
     meta: dict
      A dictionary containing the metadata from the JSON file
     """
+    if not os.path.exists(os.path.join(dir, "totalroi.json")) and os.path.exists(
+        os.path.join(dir, STORE)
+    ):
+        return get_store_meta(dir)
 
     with open(os.path.join(dir, "totalroi.json")) as f:
         metajson = f.readlines()
@@ -37,7 +59,7 @@ def get_precip_files(dir, prd="RZC"):
     """
     Get a list of precipitation files in a given directory. The product can be
      either "RZC" or "CPC". The file format is determined based on the metadata
-     for the directory.
+     for the directory, or on the files present if there is no metadata.
 
     Args:
     -----
@@ -53,15 +75,24 @@ def get_precip_files(dir, prd="RZC"):
      A list of filenames for the precipitation files with a 5-minute timestep,
      for the specified product
     """
-    meta = get_meta(dir)
-    if meta["fmt"] == ".gif":
+    if os.path.exists(os.path.join(dir, "totalroi.json")) or os.path.exists(
+        os.path.join(dir, STORE)
+    ):
+        fmt = get_meta(dir)["fmt"]
+    elif glob.glob(os.path.join(dir, prd, "*.h5")):
+        # decoded in-process, without totalroi.json
+        fmt = ".h5"
+    else:
+        fmt = ".gif"
+
+    if fmt == ".gif":
         allFiles = glob.glob(os.path.join(dir, prd, "*.gif"))
-    elif meta["fmt"] == ".h5":
+    elif fmt == ".h5":
         allFiles = glob.glob(os.path.join(dir, prd, "*.h5"))
     return allFiles
 
 
-def get_totalDomain(dir, prd):
+def get_totalDomain(dir, prd, mmap=False, return_validity=False):
     """
     Get the precipitation (mm/h) for a region over time.
 
@@ -71,35 +102,123 @@ def get_totalDomain(dir, prd):
      The directory containing the binary file.
     prd: str
      The product for which the data is intended, either "CPC" or "RZC".
+    mmap: bool, optional
+     If True, totalroi.bin is memory-mapped instead of read and a LazyCube
+     is returned, which only reads the parts that are accessed.
+     Default is False. If there is no totalroi.bin but a totalroi.nc, the
+     store is always read lazily (see get_store_domain).
+    return_validity: bool, optional
+     Also return the mask of the valid values, built while totalroi.bin is
+     read. Default is False.
 
     Returns:
     --------
-    totalDomain: ndarray
+    totalDomain: ndarray or LazyCube
      A 3D array containing the precipitation (mm/h) over the entire domain,
-     with dimensions (time,x,y).
+     with dimensions (y,x,time).
+    validity: ValidityMask or None
+     Only if return_validity, the valid values of totalDomain. None for a
+     lazily read cube, of which nothing is read here.
     """
 
+    if not os.path.exists(os.path.join(dir, "totalroi.bin")) and os.path.exists(
+        os.path.join(dir, STORE)
+    ):
+        if return_validity:
+            return get_store_domain(dir, prd), None
+        return get_store_domain(dir, prd)
+
     meta = get_meta(dir)
     dtype = np.dtype("f")
     if meta["prd"] != prd:
         print("Be careful, you are mixing up products!")
-    f = open(os.path.join(dir, "totalroi.bin"), "rb")
-    rdata = np.fromfile(f, dtype)
-    totalDomain = np.flipud(
-        np.rot90(
-            np.transpose(
-                rdata.reshape([int(meta["z"]), int(meta["height"]), int(meta["width"])])
-            )
-        )
-    )
-    totalDomain[totalDomain < 0] = -1.0
+    shape = (int(meta["z"]), int(meta["height"]), int(meta["width"]))
 
+    # the file is stored as (time, y, x), the transpose/rot90/flipud of
+    # earlier versions amounts to moving the time axis to the end
+    if mmap:
+        rdata = np.memmap(
+            os.path.join(dir, "totalroi.bin"), dtype=dtype, mode="r", shape=shape
+        )
+        if return_validity:
+            return LazyCube(rdata), None
+        return LazyCube(rdata)
+
+    # missing values are left as they are, see utils.validity.ValidityMask
+    rdata = np.fromfile(os.path.join(dir, "totalroi.bin"), dtype).reshape(shape)
+    totalDomain = np.moveaxis(rdata, 0, -1)
+
+    if return_validity:
+        validity = ValidityMask.empty(totalDomain.shape)
+        for t, frame in enumerate(rdata):
+            validity.set_frame(t, frame >= 0)
+        return totalDomain, validity
     return totalDomain
 
 
-def get_totalRoi(rectangle, totalDomain):
+def _open_store(dir, prd):
+    if get_store_meta(dir)["prd"] != prd:
+        print("Be careful, you are mixing up products!")
+    return StoreVariable(dir)
+
+
+def get_store_domain(dir, prd):
     """
-    Get the precipitation (mm/h) of a subregion.
+    Get lazy access to the precipitation (mm/h) stored in totalroi.nc.
+     Only the chunks overlapping the accessed tiles and time steps are read
+     and decompressed, the file is opened for every read.
+
+    Args:
+    -----
+    dir: str
+     The directory containing totalroi.nc.
+    prd: str
+     The product for which the data is intended, either "CPC" or "RZC".
+
+    Returns:
+    --------
+    totalDomain: LazyCube
+     The precipitation (mm/h) over the entire domain, with dimensions
+     (y,x,time). Missing values are set to -1 when read.
+    """
+    return LazyCube(_open_store(dir, prd))
+
+
+def get_store_roi(dir, prd, rectangle, start=None, stop=None):
+    """
+    Read the precipitation (mm/h) of a subregion and time range
+     from totalroi.nc.
+
+    Args:
+    -----
+    dir: str
+     The directory containing totalroi.nc.
+    prd: str
+     The product for which the data is intended, either "CPC" or "RZC".
+    rectangle: tuple
+     A tuple specifying the bounds of the region as (xmin, xmax, ymin, ymax).
+    start: int, optional
+     Index of the first time step. Default is the first one.
+    stop: int, optional
+     Index after the last time step. Default is after the last one.
+
+    Returns:
+    --------
+    totalRoi: ndarray
+     A 3-dimensional array (y,x,time) containing the precipitation (mm/h)
+     over the region of interest, missing values are set to -1.
+    """
+    return LazyCube(_open_store(dir, prd))[
+        coordy2ind(rectangle[3]) : coordy2ind(rectangle[2]),
+        coordx2ind(rectangle[0]) : coordx2ind(rectangle[1]),
+        start:stop,
+    ]
+
+
+def get_totalRoi(rectangle, totalDomain, validity=None):
+    """
+    Get the precipitation (mm/h) of a subregion, missing values set to 0.
+     totalDomain is not modified.
 
     Args:
     -----
@@ -107,6 +226,9 @@ def get_totalRoi(rectangle, totalDomain):
      A tuple specifying the bounds of the region as (xmin, xmax, ymin, ymax).
     totalDomain: ndarray
      Array cotaining the whole region region.
+    validity: ValidityMask, optional
+     Valid values of totalDomain, see utils.validity. Default is None
+     (negative values are missing).
 
     Returns:
     --------
@@ -114,13 +236,12 @@ def get_totalRoi(rectangle, totalDomain):
      A 3-dimensional array containing the precipitation (mm/h)
      over the region of interest.
     """
-    totalRoi = totalDomain[
-        coordy2ind(rectangle[3]) : coordy2ind(rectangle[2]),
-        coordx2ind(rectangle[0]) : coordx2ind(rectangle[1]),
-        :,
-    ]
-    totalRoi[totalRoi < 0] = 0
-    return totalRoi
+    rows = slice(coordy2ind(rectangle[3]), coordy2ind(rectangle[2]))
+    cols = slice(coordx2ind(rectangle[0]), coordx2ind(rectangle[1]))
+    totalRoi = np.asarray(totalDomain[rows, cols, :])
+    if validity is None:
+        return np.where(totalRoi < 0, np.float32(0), totalRoi)
+    return np.where(validity[rows, cols, :], totalRoi, np.float32(0))
 
 
 def get_totalSumRois(totalRoi, prd):
@@ -142,9 +263,9 @@ def get_totalSumRois(totalRoi, prd):
 
     """
     if prd == "AQC":
-        totalSumRoi = np.sum(totalRoi, axis=2)
+        totalSumRoi = kernels.time_sum(totalRoi)
     else:
-        totalSumRoi = np.sum(totalRoi / 12.0, axis=2)
+        totalSumRoi = kernels.time_sum(totalRoi) / 12.0
 
     totalSumRoiS = np.around(totalSumRoi, decimals=1)
     totalSumRoiS[totalSumRoiS < 0] = np.NaN
@@ -152,6 +273,72 @@ def get_totalSumRois(totalRoi, prd):
     return totalSumRoiS
 
 
+def _roi_slices(rectangle):
+    return (
+        slice(coordy2ind(rectangle[3]), coordy2ind(rectangle[2])),
+        slice(coordx2ind(rectangle[0]), coordx2ind(rectangle[1])),
+    )
+
+
+def read_POH_rois(file, rectangles, transposed=False, memory=None):
+    """
+    Read the POH of several regions from one file, requesting from HDF5 only
+     the hyperslab of the box around all regions instead of the whole field.
+
+    Args:
+    -----
+    file: str
+     Path of the POH .h5 file.
+    rectangles: list
+     Bounds (xmin, xmax, ymin, ymax) of every region.
+    transposed: bool, optional
+     The field is stored as (x, y), as in the daily files. Default is False.
+    memory: bytes, optional
+     Content of the file, already read. Default is None (read from file).
+
+    Returns:
+    --------
+    POH: list
+     (y, x) array of every region.
+    """
+    slices = [_roi_slices(rectangle) for rectangle in rectangles]
+    y0 = min(rows.start for rows, __ in slices)
+    y1 = max(rows.stop for rows, __ in slices)
+    x0 = min(cols.start for __, cols in slices)
+    x1 = max(cols.stop for __, cols in slices)
+    with _HDF5_LOCK:
+        with Dataset(file, memory=memory) as nc:
+            data = nc["dataset1"]["data1"]["data"]
+            if transposed:
+                box = np.transpose(np.ma.getdata(data[x0:x1, y0:y1]))
+            else:
+                box = data[y0:y1, x0:x1]
+    return [
+        box[rows.start - y0 : rows.stop - y0, cols.start - x0 : cols.stop - x0]
+        for rows, cols in slices
+    ]
+
+
+def _read_file(file):
+    with open(file, "rb") as f:
+        return f.read()
+
+
+def _prefetch(function, files, workers):
+    """
+    function(file) for every file in order, computed by a pool of threads
+     that stays at most 2 * workers files ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = deque()
+        for file in files:
+            pending.append(pool.submit(function, file))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def get_POH_domain(dir, rectangle, POHSingleFiles=False):
     """
     Get the probability of hail (POH) over a given region,
@@ -176,19 +363,42 @@ def get_POH_domain(dir, rectangle, POHSingleFiles=False):
      if True, a 1-dimensional array containing the maximum Probability
      of Hail over the region of interest for each (5-min) time step.
     """
+    return get_POH_domains(dir, [rectangle], POHSingleFiles)[0]
+
+
+def get_POH_domains(dir, rectangles, POHSingleFiles=False, workers=POH_WORKERS):
+    """
+    get_POH_domain for several regions, reading every file once.
+
+    Args:
+    -----
+    dir: str
+     The directory containing the POH files.
+    rectangles: list
+     Bounds (xmin, xmax, ymin, ymax) of every region.
+    POHSingleFiles: bool, optional
+     Also get the maximum POH of every region at 5-min interval.
+     Default is False.
+    workers: int, optional
+     Number of threads reading the 5-min files. Default is POH_WORKERS.
+
+    Returns:
+    --------
+    POH: list
+     (POH_domain, maxPOHOverTime) of every region, see get_POH_domain.
+    """
     POH_Dir = os.path.join(dir, "POH")
     POH_file = glob.glob(os.path.join(POH_Dir, "*2400VL.845.h5"))
-    with Dataset(POH_file[0]) as POH_daily:
-        POH_daily = Dataset(POH_file[0])
-        POH_full = np.transpose(np.ma.getdata(POH_daily["dataset1"]["data1"]["data"][:]))
-        POH_domain = POH_full[
-            coordy2ind(rectangle[3]) : coordy2ind(rectangle[2]),
-            coordx2ind(rectangle[0]) : coordx2ind(rectangle[1]),
-        ]
-    maxPOHOverTime = None
-    if np.count_nonzero(~np.isnan(POH_domain)) != 0 and POHSingleFiles:
-        maxPOHOverTime = get_single_POH(POH_Dir, rectangle)
-    return POH_domain, maxPOHOverTime
+    POH_domains = read_POH_rois(POH_file[0], rectangles, transposed=True)
+
+    # the 5-min files are only read for the regions with hail
+    hail = [i for i, POH in enumerate(POH_domains) if np.count_nonzero(~np.isnan(POH))]
+    maxPOHOverTime = [None] * len(rectangles)
+    if hail and POHSingleFiles:
+        maxPOH = get_single_POHs(POH_Dir, [rectangles[i] for i in hail], workers)
+        for i, series in zip(hail, maxPOH):
+            maxPOHOverTime[i] = series
+    return list(zip(POH_domains, maxPOHOverTime))
 
 
 def get_single_POH(dir, rectangle):
@@ -208,16 +418,78 @@ def get_single_POH(dir, rectangle):
      A 1-dimensional array containing the maximum Probability of
      Hail over the region of interest for each (5-min) time step.
     """
+    return get_single_POHs(dir, [rectangle])[0]
+
+
+def get_single_POHs(dir, rectangles, workers=POH_WORKERS):
+    """
+    Get per 5-min timestep the max POH of several regions.
+
+    The files are read by a pool of threads. Only the decoding of the
+     hyperslab around the regions is serialized, as HDF5 is not thread-safe,
+     so reading the next files overlaps with decoding.
+
+    Args:
+    -----
+    dir: str
+     The directory containing the POH files.
+    rectangles: list
+     Bounds (xmin, xmax, ymin, ymax) of every region.
+    workers: int, optional
+     Number of threads reading the files. Default is POH_WORKERS.
+
+    Returns:
+    --------
+    maxPOH: ndarray
+     (region, time) maximum Probability of Hail over every region for
+     each (5-min) time step.
+    """
     all_POH_files = glob.glob(os.path.join(dir, "SingleFiles", "*.h5"))
     all_POH_files = np.sort(all_POH_files)
-    maxPOH = np.zeros(len(all_POH_files))
-    for i, file in enumerate(all_POH_files):
-        with Dataset(file) as nc:
-            POH_single = nc["dataset1"]["data1"]["data"][:]
-            POH_single_domain = POH_single[
-                coordy2ind(rectangle[3]) : coordy2ind(rectangle[2]),
-                coordx2ind(rectangle[0]) : coordx2ind(rectangle[1]),
-            ]
-        maxPOH[i] = np.nanmax(POH_single_domain)
+    maxPOH = np.zeros((len(rectangles), len(all_POH_files)))
 
+    def roi_maxima(file):
+        POH = read_POH_rois(file, rectangles, memory=_read_file(file))
+        return [np.nanmax(roi) for roi in POH]
+
+    for i, maxima in enumerate(_prefetch(roi_maxima, all_POH_files, workers)):
+        maxPOH[:, i] = maxima
     return maxPOH
+
+
+def iter_single_POH(dir, start=None, end=None, workers=POH_WORKERS):
+    """
+    Iterate over the 5-min POH fields of the whole domain, in time order.
+     The files are read ahead by a pool of threads, only a few fields are in
+     memory at any time.
+
+    Args:
+    -----
+    dir: str
+     The directory containing the POH files.
+    start: datetime64, optional
+     First time to read. Default is None (from the first file).
+    end: datetime64, optional
+     Last time to read. Default is None (to the last file).
+    workers: int, optional
+     Number of threads reading the files. Default is POH_WORKERS.
+
+    Returns:
+    --------
+    fields: generator
+     Yields (time, POH) for every file, time a datetime64[m] and POH a
+     (y, x) float32 array with NaN where there is no data.
+    """
+    all_POH_files = np.sort(glob.glob(os.path.join(dir, "SingleFiles", "*.h5")))
+    times = parse_times(all_POH_files)
+    inWindow = np.ones(len(times), dtype=bool)
+    if start is not None:
+        inWindow &= times >= np.datetime64(start, "m")
+    if end is not None:
+        inWindow &= times <= np.datetime64(end, "m")
+
+    def field(file):
+        POH = read_POH_rois(file, [DOMAIN], memory=_read_file(file))[0]
+        return np.ma.filled(np.ma.asarray(POH, dtype=np.float32), np.nan)
+
+    yield from zip(times[inWindow], _prefetch(field, all_POH_files[inWindow], workers))
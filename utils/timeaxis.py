@@ -0,0 +1,230 @@
+"""
+Time axis of the 5-min files of an event, shared by all outputs
+"""
+import os
+import numpy as np
+
+# minutes between two radar frames
+TIMESTEP = 5
+
+
+def parse_times(names):
+    """
+    Times of files named "prdYYDOYHHMM*", without strptime.
+
+    Args:
+    -----
+    names: list
+     File names or paths.
+
+    Returns:
+    --------
+    times: ndarray
+     datetime64[m] array, one time per file.
+    """
+    names = [os.path.basename(str(name)) for name in names]
+    years = np.array([int(name[3:5]) for name in names]) + 2000
+    days = np.array([int(name[5:8]) for name in names]) - 1
+    minutes = np.array([int(name[8:10]) * 60 + int(name[10:12]) for name in names])
+    return (
+        (years - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+        + days.astype("timedelta64[D]")
+    ).astype("datetime64[m]") + minutes.astype("timedelta64[m]")
+
+
+def round_times(times, step=TIMESTEP):
+    """
+    Round times to the nearest step, half a step being rounded down as in
+     utils.transformation.nearest_5min.
+
+    Args:
+    -----
+    times: array_like
+     Times convertible to datetime64.
+    step: int, optional
+     Step in minutes. Default is 5.
+
+    Returns:
+    --------
+    rounded: ndarray
+     datetime64[s] array.
+    """
+    seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+    rest = seconds % (60 * step)
+    rounded = seconds - rest + np.where(rest > 30 * step, 60 * step, 0)
+    return rounded.astype("datetime64[s]")
+
+
+def _format(times, newline):
+    sep = "\n" if newline else " "
+    return np.array([t.strftime(f"%d-%m-%Y{sep}%H:%MUTC") for t in times.astype(object)])
+
+
+class TimeAxis(object):
+    """
+    Regular 5-min axis from the first to the last file of an event, with
+     the slot of every file. Built once per run from the file names, it gives
+     the timestamps and labels of the outputs and places series with one
+     value per file (the time steps of the cube) on the regular axis, so
+     missing frames show up as gaps instead of shifting the time steps.
+
+    Attributes:
+    -----------
+    files: ndarray
+     The files sorted by time, one per time step of the cube.
+    fileTimes: ndarray
+     datetime64[m] time of every file.
+    slots: ndarray
+     Index of every file on the regular axis.
+    times: ndarray
+     datetime64[m] time of every slot of the regular axis.
+    missing: ndarray
+     Boolean array, True for the slots without a file.
+    """
+
+    def __init__(self, allFiles, step=TIMESTEP):
+        """
+        Initializes the axis
+
+        Args:
+        -----
+        allFiles: list
+         The 5-min files of the event, named "prdYYDOYHHMM*", in any order.
+        step: int, optional
+         Minutes between two slots. Default is 5.
+        """
+        fileTimes = parse_times(allFiles)
+        order = np.argsort(fileTimes, kind="stable")
+        self.files = np.asarray(allFiles)[order]
+        self.fileTimes = fileTimes[order]
+        self.step = np.timedelta64(step, "m")
+
+        # files off the 5-min grid are put in the nearest slot
+        self.slots = np.rint((self.fileTimes - self.start) / self.step).astype(np.int64)
+        n_slots = int(self.slots[-1]) + 1 if len(self.slots) else 0
+        self.times = self.start + np.arange(n_slots) * self.step
+        self.missing = np.ones(n_slots, dtype=bool)
+        self.missing[self.slots] = False
+        self._labels = {}
+
+    @property
+    def start(self):
+        return self.fileTimes[0]
+
+    @property
+    def end(self):
+        return self.fileTimes[-1]
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def n_missing(self):
+        return int(np.count_nonzero(self.missing))
+
+    @property
+    def shared(self):
+        """
+        Boolean array, True for the files put in the same slot as the
+         previous file (files off the 5-min grid, e.g. at 00:10 and 00:11).
+         tools.duration adds up the files of a slot.
+        """
+        return np.concatenate(([False], np.diff(self.slots) == 0))
+
+    @property
+    def n_shared(self):
+        return int(np.count_nonzero(self.shared))
+
+    def minutes(self):
+        """
+        Minutes since the first file of every file, e.g. for the time
+         variable of a netCDF file.
+
+        Returns:
+        --------
+        minutes: ndarray
+         int64 array, one value per file.
+        """
+        return ((self.fileTimes - self.start) // np.timedelta64(1, "m")).astype(np.int64)
+
+    def labels(self, newline=True):
+        """
+        Labels of all files, "DD-MM-YYYY HH:MMUTC" as given by
+         utils.transformation.fname2timestring.
+
+        Args:
+        -----
+        newline: bool, optional
+         Separate date and time by a new line instead of a space.
+         Default is True.
+
+        Returns:
+        --------
+        labels: ndarray
+         One str per file.
+        """
+        if newline not in self._labels:
+            self._labels[newline] = _format(self.fileTimes, newline)
+        return self._labels[newline]
+
+    def label(self, i, newline=True):
+        """
+        Label of the file (time step of the cube) i, see labels.
+        """
+        return self.labels(newline)[i]
+
+    def slot_labels(self, slots, newline=True):
+        """
+        Labels of slots of the regular axis, e.g. for the ticks of a plot,
+         formatted as labels.
+        """
+        return _format(self.times[np.asarray(slots)], newline)
+
+    def to_slots(self, values, fill=np.nan, hold=False):
+        """
+        Place a series with one value per file on the regular axis.
+
+        Args:
+        -----
+        values: ndarray
+         1-dimensional series, one value per file.
+        fill: float, optional
+         Value of the missing slots. Default is NaN.
+        hold: bool, optional
+         Repeat the value of the previous file in the missing slots instead,
+         e.g. for a cumulative sum. Default is False.
+
+        Returns:
+        --------
+        series: ndarray
+         float array with len(self) values.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if hold:
+            # index of the last file at or before every slot
+            last = np.searchsorted(self.slots, np.arange(len(self)), side="right") - 1
+            return values[last]
+        series = np.full(len(self), fill, dtype=np.float64)
+        series[self.slots] = values
+        return series
+
+    def slot_of(self, times):
+        """
+        Nearest slot of arbitrary times, e.g. of crowdsourced reports.
+
+        Args:
+        -----
+        times: array_like
+         Times convertible to datetime64.
+
+        Returns:
+        --------
+        slots: ndarray
+         int64 index on the regular axis, -1 for times more than half a
+         step before the first or after the last slot.
+        """
+        times = np.asarray(times, dtype="datetime64[s]")
+        # half a step is rounded down, as utils.transformation.nearest_5min
+        slots = np.ceil((times - self.start) / self.step - 0.5).astype(np.int64)
+        slots[(slots < 0) | (slots >= len(self))] = -1
+        return slots
@@ -7,6 +7,8 @@ import math
 import numpy as np
 from numba import jit
 
+from utils.timeaxis import round_times
+
 
 @jit
 def coordx2ind(coordx):
@@ -99,16 +101,9 @@ def nearest_5min(df):
     df: DataFrame
      Dataframe with min rounded to 5 min.
     """
-    for i in range(0, len(df["time"])):
-        # Calculate the number of seconds until the nearest 5 minute interval
-        t = datetime.strptime(df["time"][i], "%Y-%m-%d %H:%M:%S")
-        seconds = (t.minute % 5) * 60 + t.second
-        # Subtract that number of seconds from the current time to get the nearest 5 minute interval
-        nearest = t - timedelta(seconds=seconds)
-        # If the nearest interval is more than 2.5 minutes away, round up to the next interval instead
-        if seconds > 150:
-            nearest += timedelta(minutes=5)
-        df["time"][i] = nearest
+
+    times = np.asarray(df["time"], dtype="datetime64[s]")
+    df["time"] = round_times(times)
     return df
 
 
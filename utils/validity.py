@@ -0,0 +1,172 @@
+"""
+Bit-packed mask of the valid (not missing) values of the precipitation cube
+"""
+import numpy as np
+
+from utils import kernels
+from utils.cube import CHUNK_BYTES, iter_time_blocks
+
+
+class ValidityMask(object):
+    """
+    One bit per value of a (y, x, time) cube telling whether it holds a
+     measurement, i.e. is not negative. The bits of every time step are
+     packed with np.packbits, so the mask takes 1/32 of a float32 cube.
+
+    The mask is built once when the cube is decoded or first used, after
+     which reductions select the valid values with it instead of testing and
+     rewriting negative values in the cube again.
+
+    Attributes:
+    -----------
+    packed: ndarray
+     (time, ceil(y * x / 8)) uint8 array, the bits of every time step in
+     row-major (y, x) order.
+    shape: tuple
+     Shape (y, x, time) of the cube.
+    """
+
+    def __init__(self, packed, shape):
+        """
+        Initializes the mask
+
+        Args:
+        -----
+        packed: ndarray
+         (time, ceil(y * x / 8)) uint8 array of packed bits.
+        shape: tuple
+         Shape (y, x, time) of the cube.
+        """
+        self.packed = packed
+        self.shape = tuple(shape)
+
+    @classmethod
+    def empty(cls, shape):
+        """
+        Mask with all values missing, to be filled with set_frame.
+        """
+        ny, nx, nt = shape
+        return cls(np.zeros((nt, (ny * nx + 7) // 8), dtype=np.uint8), shape)
+
+    @classmethod
+    def from_cube(cls, totalDomain):
+        """
+        Build the mask of a cube in one pass over its time steps.
+
+        Args:
+        -----
+        totalDomain: ndarray
+         (y, x, time) array or LazyCube, missing values are negative.
+
+        Returns:
+        --------
+        mask: ValidityMask
+        """
+        mask = cls.empty(totalDomain.shape)
+        for start, block in iter_time_blocks(totalDomain):
+            for i in range(block.shape[2]):
+                mask.set_frame(start + i, block[:, :, i] >= 0)
+        return mask
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def set_frame(self, t, valid):
+        """
+        Store the (y, x) boolean mask of time step t.
+        """
+        self.packed[t] = np.packbits(valid, axis=None)
+
+    def frames(self, start=0, stop=None):
+        """
+        Unpack consecutive time steps.
+
+        Args:
+        -----
+        start: int, optional
+         First time step. Default is 0.
+        stop: int, optional
+         Time step after the last one. Default is the end.
+
+        Returns:
+        --------
+        valid: ndarray
+         (time, y, x) boolean array.
+        """
+        return self._unpack(start, stop, 0, self.shape[0])
+
+    def _unpack(self, start, stop, r0, r1):
+        # only the bytes holding rows r0 to r1 are unpacked
+        nx = self.shape[1]
+        bit0, bit1 = r0 * nx, r1 * nx
+        bits = np.unpackbits(self.packed[start:stop, bit0 >> 3 : (bit1 + 7) >> 3], axis=1)
+        offset = bit0 & 7
+        bits = bits[:, offset : offset + bit1 - bit0]
+        return bits.reshape(-1, r1 - r0, nx).view(bool)
+
+    def __getitem__(self, key):
+        """
+        Boolean (y, x, time) mask of a part of the cube, indexed like the
+         cube with integers and slices.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        ky, kx, kt = key + (slice(None),) * (3 - len(key))
+        if isinstance(ky, slice):
+            r0, r1, rstep = ky.indices(self.shape[0])
+            r1 = max(r0, r1)
+            ky = slice(None, None, rstep)
+        else:
+            r0 = ky % self.shape[0]
+            r1 = r0 + 1
+            ky = 0
+        if isinstance(kt, (int, np.integer)):
+            kt = kt % self.shape[2]
+            return self._unpack(kt, kt + 1, r0, r1)[0][ky, kx]
+        start, stop, step = kt.indices(self.shape[2])
+        valid = self._unpack(start, stop, r0, r1)[::step, ky, kx]
+        return np.moveaxis(valid, 0, -1)
+
+    def count(self):
+        """
+        Number of valid time steps of every pixel.
+
+        Returns:
+        --------
+        count: ndarray
+         (y, x) int array.
+        """
+        count = np.zeros(self.shape[:2], dtype=np.int64)
+        step = max(1, CHUNK_BYTES // (self.shape[0] * self.shape[1]))
+        for start in range(0, self.shape[2], step):
+            count += np.sum(self.frames(start, start + step), axis=0)
+        return count
+
+
+def masked_time_sum(totalDomain, mask):
+    """
+    Sum over time of the valid values of a cube.
+
+    Args:
+    -----
+    totalDomain: ndarray
+     (y, x, time) array or LazyCube.
+    mask: ValidityMask
+     Validity of the values of totalDomain.
+
+    Returns:
+    --------
+    total: ndarray
+     (y, x) float32 sum, NaN where no time step is valid.
+    """
+    if isinstance(totalDomain, np.ndarray):
+        return kernels.masked_time_sum(totalDomain, mask.packed)
+
+    total = np.zeros(mask.shape[:2])
+    for start, block in iter_time_blocks(totalDomain):
+        valid = mask[:, :, start : start + block.shape[2]]
+        total += np.sum(np.where(valid, block, 0), axis=2)
+    total = total.astype(np.float32)
+    total[mask.count() == 0] = np.nan
+    return total
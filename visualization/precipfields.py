@@ -526,7 +526,7 @@ def processSingleFile(region, allFiles, i, outDir, useOsmSingleFiles=False):
         outFile = outDir + "/single-plots/" + bname[:-4] + ".png"
     elif bname[len(bname) - 3 :] == ".h5":
         outFile = outDir + "/single-plots/" + bname[:-3] + ".png"
-    rain = region.totalDomain[:, :, i]
+    rain = np.where(region.validity[:, :, i], region.totalDomain[:, :, i], -1)
 
     fig, ax = plt.subplots(figsize=(20, 20))
     # ax.set_rasterized(True)
@@ -551,20 +551,12 @@ def processSingleFile(region, allFiles, i, outDir, useOsmSingleFiles=False):
     plt.plot()
 
     prd = bname[:3]
-    year = "20" + bname[3:5]
-    day = bname[5:8]
-    hour = bname[8:10]
-    minute = bname[10:12]
-    time = datetime.strptime(year + " " + day, "%Y %j")
+    time = region.timeAxis.fileTimes[i].astype(datetime)
     plt.title(
         "Precipitation intensity over "
         + region.name
         + ", "
-        + time.strftime("%d/%m/%Y")
-        + " "
-        + hour
-        + ":"
-        + minute
+        + time.strftime("%d/%m/%Y %H:%M")
         + "UTC, product = "
         + prd,
         y=1.02,
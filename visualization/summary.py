@@ -5,8 +5,9 @@ from datetime import datetime
 import numpy as np
 from netCDF4 import Dataset
 import pandas as pd
-from visualization.utils import get_totalSum, makeSummaryFile
-from utils.transformation import fname2timestring, make_timeserie
+from visualization.utils import WindowStats, makeSummaryFile
+from tools.duration import duration_label
+from utils.transformation import coordx2ind, coordy2ind
 
 
 ###############
@@ -29,13 +30,13 @@ def make_summary_file(region, allFiles, outDir, POHfiles=False, sizes=[3, 5, 7,
     POHfiles: bool, optional
      Whether to include POH daily data in the analysis. Default is False.
     sizes: list
-     list containing sizes to get nxn output within the region.
+     list containing sizes to get nxn output within the region. Any number
+     of sizes can be given, e.g. range(3, 52, 2).
     """
     
     bname = region.bname
     fname = region.fbname
     totalSumRoiS = region.totalSumRoiS
-    timestamps = np.array(list(map(fname2timestring, allFiles)))
 
     outFile = outDir + "/" + bname['eventCodeName'] + "-summary.txt"
     with open(outFile, "w+") as summary_file:
@@ -70,20 +71,34 @@ def make_summary_file(region, allFiles, outDir, POHfiles=False, sizes=[3, 5, 7,
         summary_file.write("Radar product used: " + bname['prd'] + "\n\n")
         summary_file.write("Maximum over region: " + str(np.nanmax(totalSumRoiS)) + " mm\n")
         summary_file.write("Minimum over region: " + str(np.nanmin(totalSumRoiS)) + " mm\n")
+        # areal statistics, weighted by the covered fraction of every cell
+        # for polygon regions (all weights are 1 for a rectangle)
+        weights = region.roi_weights()
+        valid = weights > 0
+        sumRoi = totalSumRoiS[valid]
+        average = np.average(sumRoi, weights=weights[valid])
         summary_file.write(
             "Average over region: "
-            + str(np.around(np.average(totalSumRoiS), decimals=2))
+            + str(np.around(average, decimals=2))
             + " mm\n"
         )
         summary_file.write(
             "Standard deviation over region: "
-            + str(np.around(np.std(totalSumRoiS), decimals=2))
+            + str(
+                np.around(
+                    np.sqrt(np.average((sumRoi - average) ** 2, weights=weights[valid])),
+                    decimals=2,
+                )
+            )
             + " mm\n"
         )
         summary_file.write(
             "Wet fraction over region: "
             + str(
-                np.around((np.count_nonzero(totalSumRoiS) / totalSumRoiS.size), decimals=2)
+                np.around(
+                    np.sum(weights[valid] * (sumRoi != 0)) / np.sum(weights[valid]),
+                    decimals=2,
+                )
             )
             + " \n\n"
         )
@@ -106,27 +121,28 @@ def make_summary_file(region, allFiles, outDir, POHfiles=False, sizes=[3, 5, 7,
                     "Maximum POH over region: " + str(np.nanmax(region.POH_domain)) + "\n\n"
                 )
 
-        if region.bname['prd'] == "AQC":
-            totalDomainSum = np.sum(region.totalDomain, axis=2)
-        else:
-            totalDomainSum = np.sum(region.totalDomain, axis=2) / 12.0
+        # same as the domain sum of fetch_precip_data, not computed again
+        totalDomainSum = np.array(region.totalSum)
 
         # added in case there is nan values in totalDomainSum
         totalDomainSum[np.isnan(totalDomainSum)] = 0
-        totalSumSizes = {f"totalSum{size}": get_totalSum(totalDomainSum,region.rectangle,size) for size in sizes}
+        # one summed-area table over the region and the largest window
+        windowStats = WindowStats(totalDomainSum, region.rectangle, max(sizes)).stats(sizes)
 
         for size in sizes:
             summary_file.write(
                 f"Minimum and maximum over {size}x{size} km within the region: "
-                + str(np.around(np.nanmin(totalSumSizes[f"totalSum{size}"]), decimals=1))
+                + str(np.around(windowStats[size][0], decimals=1))
                 + "; "
-                + str(np.around(np.nanmax(totalSumSizes[f"totalSum{size}"]), decimals=1))
+                + str(np.around(windowStats[size][1], decimals=1))
                 + " mm\n"
             )
         summary_file.write("\n")
-        timestampsoneline = list()
-        for ts in timestamps:
-            timestampsoneline.append(ts.replace("\n", " "))
+
+        if region.durationMaxima is not None:
+            _write_duration_maxima(summary_file, region)
+
+        timestampsoneline = region.timeAxis.labels(newline=False)
 
         summary_file.write(
             "Precipitation intensity and sum over time for region " + region.name + "\n"
@@ -148,6 +164,34 @@ def make_summary_file(region, allFiles, outDir, POHfiles=False, sizes=[3, 5, 7,
             "\nPrecipitation intensity and sum over time for region " + region.name + "\n"
         )
 
+def _write_duration_maxima(summary_file, region):
+    """
+    Writes the maximum accumulation per duration within the region,
+     for the wettest pixel and for the mean over the region.
+    """
+    weights = region.roi_weights()
+    summary_file.write("Maximum accumulation per duration within the region\n")
+    for d in sorted(region.durationMaxima):
+        maxSum, endStep = region.durationMaxima[d]
+        rows = slice(coordy2ind(region.rectangle[3]), coordy2ind(region.rectangle[2]))
+        cols = slice(coordx2ind(region.rectangle[0]), coordx2ind(region.rectangle[1]))
+        roiMax = np.where(weights > 0, maxSum[rows, cols], -np.inf)
+        pixel = np.unravel_index(np.argmax(roiMax), roiMax.shape)
+        meanSum, meanEnd = region.roiDurationMaxima[d]
+        summary_file.write(
+            f"{duration_label(d)}: "
+            + str(np.around(roiMax[pixel], decimals=1))
+            + " mm at a pixel (ending "
+            + region.timeAxis.label(endStep[rows, cols][pixel], newline=False)
+            + "); "
+            + str(np.around(meanSum, decimals=1))
+            + " mm mean over region (ending "
+            + region.timeAxis.label(meanEnd, newline=False)
+            + ")\n"
+        )
+    summary_file.write("\n")
+
+
 ###############
 # netCDF
 ###############
@@ -155,7 +199,8 @@ def make_summary_file(region, allFiles, outDir, POHfiles=False, sizes=[3, 5, 7,
 def make_netCDF_summary(region,outDir):
     """
     Creates a .nc file containing precipitation (intensity and total rainfall)
-     over region of interest and the whole domain
+     over region of interest. The whole domain is written once per event,
+     see make_netCDF_domain.
 
     Args:
     -----
@@ -171,15 +216,16 @@ def make_netCDF_summary(region,outDir):
     dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
 
     ## Make netCDF
-    timeserie = make_timeserie(bname,fname)
-
-    diff_sec = [t - timeserie[0] for t in timeserie]
+    # one time per file, so the time dimension matches the data even if
+    # frames are missing
+    t0 = region.timeAxis.start.astype(datetime)
+    minutes = region.timeAxis.minutes()
 
     outFile = outDir + "/" + bname['eventCodeName'] + "-summary.nc"
 
     with Dataset(outFile, "w", format="NETCDF4") as ncfile:
 
-        ncfile.title = f'Summary of precipitation for {timeserie[0].strftime("%d/%m/%Y")}'
+        ncfile.title = f'Summary of precipitation for {t0.strftime("%d/%m/%Y")}'
         ncfile.history = f"Created on {dt_string}"
         ncfile.institution = "MeteoSwiss (Switzerland)"
         ncfile.setncattr("Radar product", bname['prd'])
@@ -188,72 +234,6 @@ def make_netCDF_summary(region,outDir):
             "+proj=somerc +lat_0=46.95240555555556 +lon_0=7.439583333333333 +k_0=1 +x_0=2600000 +y_0=1200000 +ellps=bessel +towgs84=674.374,15.056,405.346,0,0,0,0 +units=m +no_defs",
         )
 
-        # group with whole domain
-        domain = ncfile.createGroup("Domain")
-        domain.createDimension("x", 710)
-        domain.createDimension("y", 640)
-        domain.createDimension(
-            "time",
-        )
-
-        dom_t = domain.createVariable("time", np.int64, ("time",))
-        dom_t.long_name = f'minutes since {timeserie[0].strftime("%d/%m/%Y %H:%M")} UTC'
-        dom_t[:] = [(t.total_seconds()) / 60 for t in diff_sec]
-
-        domx = domain.createVariable(
-            "lat",
-            np.float64,
-            (
-                "x",
-                "y",
-            ),
-        )
-        domy = domain.createVariable(
-            "lon",
-            np.float64,
-            (
-                "x",
-                "y",
-            ),
-        )
-        domx.long_name = "x-coordinate in Swiss coordinate system"
-        domy.long_name = "y-coordinate in Swiss coordinate system"
-        domx.units = "km"
-        domy.units = "km"
-
-        X_coord = list(range(2255000, 2965000, 1000))  # 710
-        Y_coord = list(range(840000, 1480000, 1000))  # 640
-        Y, X = np.meshgrid(Y_coord, X_coord)
-
-        domy[:] = Y
-        domx[:] = X
-
-        dom_int = domain.createVariable(
-            "intensity",
-            np.float32,
-            (
-                "x",
-                "y",
-                "time",
-            ),
-        )
-        dom_int.long_name = "Intensity"
-        dom_int.units = "mm/h"
-
-        tot_domain = np.transpose(region.totalDomain[:, :, :], (1, 0, 2))
-        dom_int[:] = tot_domain
-        dom_sum = domain.createVariable(
-            "sum",
-            np.float32,
-            (
-                "x",
-                "y",
-            ),
-        )
-        dom_sum.long_name = "Total rainfall during day"
-        dom_sum.units = "mm"
-        dom_sum[:] = np.around(np.nansum(tot_domain / 12, axis=2), decimals=2)
-        
         # group with basin
         Y_coord = list(range(region.rectangle[0] + 500, region.rectangle[1] + 500, 1000))
         X_coord = list(range(region.rectangle[2] + 500, region.rectangle[3] + 500, 1000))
@@ -267,8 +247,8 @@ def make_netCDF_summary(region,outDir):
         )
 
         basin_t = basin.createVariable("time", np.int64, ("time",))
-        basin_t.long_name = f'minutes since {timeserie[0].strftime("%Y/%m/%d %H:%M")} UTC'
-        basin_t[:] = [(t.total_seconds()) / 60 for t in diff_sec]
+        basin_t.long_name = f'minutes since {t0.strftime("%Y/%m/%d %H:%M")} UTC'
+        basin_t[:] = minutes
 
         x_dim = basin.createVariable(
             "lat",
@@ -319,6 +299,248 @@ def make_netCDF_summary(region,outDir):
         sum.units = "mm"
         sum[:] = np.around(np.sum(region.totalRoi / 12.0, axis=(2)), decimals=2)
 
+        if region.roiDurationMaxima is not None:
+            for d, (meanSum, meanEnd) in sorted(region.roiDurationMaxima.items()):
+                label = duration_label(d)
+                basin_max = basin.createVariable(f"max_mean_sum_{label}", np.float32)
+                basin_max.long_name = f"Maximum {label} rainfall of the mean over the region"
+                basin_max.units = "mm"
+                basin_max.time = (
+                    f"ending {minutes[meanEnd]} minutes since "
+                    f'{t0.strftime("%Y/%m/%d %H:%M")} UTC'
+                )
+                basin_max.assignValue(np.around(meanSum, decimals=2))
+
+
+
+class DomainSummary(object):
+    """
+    .nc file with the precipitation (intensity, total rainfall and maximum
+     rainfall per duration) over the whole domain. It does not depend on the
+     region and is written once per event. The intensity is written block
+     by block over time, so the cube is never loaded completely, and can be
+     fed by the single pass of
+     tools.region.RegionCollection.fetch_precip_data(stream=True), so a
+     lazily decoded cube is not decoded again.
+
+    Attributes:
+    -----------
+    outFile: str
+     Path of the .nc file, {outDir}/{eventCodeName}-domain.nc.
+    n_steps: int
+     Number of time steps written so far.
+    """
+
+    def __init__(self, bname, timeAxis, outDir):
+        """
+        Creates the file and its coordinates
+
+        Args:
+        -----
+        bname: dict
+         Information about the first file of the event (RegionInfo.bname).
+        timeAxis: TimeAxis
+         Time axis of the event, one time per file so the time dimension
+         matches the data even if frames are missing.
+        outDir: str
+         Direcotory where output will be stored.
+        """
+        self.bname = bname
+        self.t0 = timeAxis.start.astype(datetime)
+        self.minutes = timeAxis.minutes()
+        self.n_steps = 0
+        self.outFile = outDir + "/" + bname['eventCodeName'] + "-domain.nc"
+
+        self.ncfile = Dataset(self.outFile, "w", format="NETCDF4")
+        self.ncfile.title = f'Precipitation over the domain for {self.t0.strftime("%d/%m/%Y")}'
+        self.ncfile.history = f'Created on {datetime.now().strftime("%d/%m/%Y %H:%M:%S")}'
+        self.ncfile.institution = "MeteoSwiss (Switzerland)"
+        self.ncfile.setncattr("Radar product", bname['prd'])
+        self.ncfile.setncattr(
+            "proj4",
+            "+proj=somerc +lat_0=46.95240555555556 +lon_0=7.439583333333333 +k_0=1 +x_0=2600000 +y_0=1200000 +ellps=bessel +towgs84=674.374,15.056,405.346,0,0,0,0 +units=m +no_defs",
+        )
+
+        self.domain = self.ncfile.createGroup("Domain")
+        self.domain.createDimension("x", 710)
+        self.domain.createDimension("y", 640)
+        self.domain.createDimension("time", None)
+
+        dom_t = self.domain.createVariable("time", np.int64, ("time",))
+        dom_t.long_name = f'minutes since {self.t0.strftime("%d/%m/%Y %H:%M")} UTC'
+        dom_t[:] = self.minutes
+
+        domx = self.domain.createVariable("lat", np.float64, ("x", "y"))
+        domy = self.domain.createVariable("lon", np.float64, ("x", "y"))
+        domx.long_name = "x-coordinate in Swiss coordinate system"
+        domy.long_name = "y-coordinate in Swiss coordinate system"
+        domx.units = "km"
+        domy.units = "km"
+        X_coord = list(range(2255000, 2965000, 1000))  # 710
+        Y_coord = list(range(840000, 1480000, 1000))  # 640
+        Y, X = np.meshgrid(Y_coord, X_coord)
+        domy[:] = Y
+        domx[:] = X
+
+        self.intensity = self.domain.createVariable(
+            "intensity", np.float32, ("x", "y", "time")
+        )
+        self.intensity.long_name = "Intensity"
+        self.intensity.units = "mm/h"
+
+    def add_block(self, block, valid):
+        """
+        Write the intensity of consecutive time steps.
+
+        Args:
+        -----
+        block: ndarray
+         (y, x, n) precipitation (mm/h) of the domain.
+        valid: ndarray
+         (y, x, n) mask of the valid values of block, the others are
+         written as -1.
+
+        Returns:
+        --------
+        None
+        """
+        start, stop = self.n_steps, self.n_steps + block.shape[2]
+        block = np.where(valid, block, np.float32(-1))
+        self.intensity[:, :, start:stop] = np.transpose(block, (1, 0, 2))
+        self.n_steps = stop
+
+    def close(self, totalSum, durationMaxima=None):
+        """
+        Write the total and maximum rainfall and close the file, once all
+         time steps are written.
+
+        Args:
+        -----
+        totalSum: ndarray
+         (y, x) total rainfall (mm), RegionInfo.totalSum.
+        durationMaxima: dict, optional
+         Maximum rainfall per duration, RegionInfo.durationMaxima.
+         Default is None.
+
+        Returns:
+        --------
+        None
+        """
+        tot_sum = np.nan_to_num(totalSum.T)
+        if self.bname["prd"] == "AQC":
+            tot_sum = tot_sum / 12
+        dom_sum = self.domain.createVariable("sum", np.float32, ("x", "y"))
+        dom_sum.long_name = "Total rainfall during day"
+        dom_sum.units = "mm"
+        dom_sum[:] = np.around(tot_sum, decimals=2)
+
+        if durationMaxima is not None:
+            for d, (maxSum, endStep) in sorted(durationMaxima.items()):
+                label = duration_label(d)
+                dom_max = self.domain.createVariable(f"max_sum_{label}", np.float32, ("x", "y"))
+                dom_max.long_name = f"Maximum {label} rainfall"
+                dom_max.units = "mm"
+                dom_max[:] = np.around(maxSum.T, decimals=2)
+                dom_tmax = self.domain.createVariable(
+                    f"time_max_sum_{label}", np.int64, ("x", "y")
+                )
+                dom_tmax.long_name = (
+                    f"End of the maximum {label} rainfall, minutes since "
+                    f'{self.t0.strftime("%d/%m/%Y %H:%M")} UTC'
+                )
+                dom_tmax[:] = self.minutes[endStep.T]
+        self.ncfile.close()
+
+
+def make_netCDF_domain(region, outDir):
+    """
+    Creates the .nc file with the precipitation over the whole domain
+     (see DomainSummary) from the cube of a region, reading it in blocks of
+     time steps. A lazily decoded cube is decoded again, in stream mode
+     DomainSummary is instead fed by the pass of fetch_precip_data.
+
+    Args:
+    -----
+    region: object
+     contains information about the region, any region of the event.
+    outDir: str
+     Direcotory where output will be stored.
+    """
+    writer = DomainSummary(region.bname, region.timeAxis, outDir)
+    ny, nx, n_steps = region.totalDomain.shape
+    step = max(1, 64 * 1024**2 // (4 * ny * nx))
+    for start in range(0, n_steps, step):
+        block = np.asarray(region.totalDomain[:, :, start : start + step])
+        stop = start + block.shape[2]
+        writer.add_block(block, region.validity[:, :, start:stop])
+    writer.close(region.totalSum, region.durationMaxima)
+
+
+def make_netCDF_hailswath(bname, swath, outDir):
+    """
+    Creates a .nc file with the hail swath over the whole domain: maximum
+     POH, first time and minutes with POH above the thresholds (see
+     tools.hailswath). The swath does not depend on the region, it is
+     written once per event.
+
+    Args:
+    -----
+    bname: dict
+     Information about the first file of the event (RegionInfo.bname).
+    swath: HailSwath
+     The swath of the event, from tools.hailswath.hail_swath.
+    outDir: str
+     Direcotory where output will be stored.
+    """
+    t0 = swath.start.astype(datetime)
+    t1 = swath.end.astype(datetime)
+    dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+
+    outFile = outDir + "/" + bname['eventCodeName'] + "-hailswath.nc"
+
+    with Dataset(outFile, "w", format="NETCDF4") as ncfile:
+        ncfile.title = (
+            f'Hail swath from {t0.strftime("%d/%m/%Y %H:%M")} UTC'
+            f' to {t1.strftime("%d/%m/%Y %H:%M")} UTC'
+        )
+        ncfile.history = f"Created on {dt_string}"
+        ncfile.institution = "MeteoSwiss (Switzerland)"
+        ncfile.setncattr("Number of POH files", swath.n_frames)
+        ncfile.setncattr(
+            "proj4",
+            "+proj=somerc +lat_0=46.95240555555556 +lon_0=7.439583333333333 +k_0=1 +x_0=2600000 +y_0=1200000 +ellps=bessel +towgs84=674.374,15.056,405.346,0,0,0,0 +units=m +no_defs",
+        )
+
+        domain = ncfile.createGroup("Domain")
+        domain.createDimension("x", 710)
+        domain.createDimension("y", 640)
+
+        X_coord = list(range(2255000, 2965000, 1000))  # 710
+        Y_coord = list(range(840000, 1480000, 1000))  # 640
+        Y, X = np.meshgrid(Y_coord, X_coord)
+        domx = domain.createVariable("lat", np.float64, ("x", "y"))
+        domy = domain.createVariable("lon", np.float64, ("x", "y"))
+        domy[:] = Y
+        domx[:] = X
+
+        max_POH = domain.createVariable("max_POH", np.float32, ("x", "y"))
+        max_POH.long_name = "Maximum probability of hail"
+        max_POH[:] = swath.maxPOH.T
+
+        for thr in sorted(swath.firstHit):
+            label = f"{int(round(thr * 100))}"
+            first = domain.createVariable(f"first_hit_{label}", np.int32, ("x", "y"))
+            first.long_name = (
+                f"First time with POH >= {thr}, minutes since "
+                f'{t0.strftime("%d/%m/%Y %H:%M")} UTC, -1 if never'
+            )
+            first[:] = swath.firstHit[thr].T
+            exceedance = domain.createVariable(
+                f"exceedance_{label}", np.int32, ("x", "y")
+            )
+            exceedance.long_name = f"Duration with POH >= {thr}"
+            exceedance.units = "min"
+            exceedance[:] = swath.exceedance[thr].T
 
 
 ###############
@@ -6,11 +6,10 @@ import numpy as np
 from math import floor
 import matplotlib.pyplot as plt
 import re
-import pandas as pd
 import subprocess
 from glob import glob
-from visualization.utils import select_coord
-from utils.transformation import nearest_5min, fname2timestring, make_timeserie
+from utils import crowdsource
+from utils.timeaxis import parse_times
 
 ###############
 # PRECIPITATON
@@ -33,7 +32,10 @@ def make_ganglinie(region,allFiles,outDir):
     """
     bname = region.bname
     fname = region.fbname
-    timestamps = np.array(list(map(fname2timestring, allFiles)))
+    # plotted on the regular 5-min axis, missing frames are gaps
+    timeAxis = region.timeAxis
+    intensityOverTime = timeAxis.to_slots(region.intensityOverTime)
+    sumOverTime = timeAxis.to_slots(region.sumOverTime, hold=True)
 
     outFile = outDir + "/" + bname['eventCodeName'] + "-ganglinie.png"
     fig, axs = plt.subplots(2, figsize=(17, 12))
@@ -60,30 +62,30 @@ def make_ganglinie(region,allFiles,outDir):
     )
 
     nticks = 5
-    tistep = int(floor(len(allFiles) / nticks))
-    ticks = list(range(tistep, len(allFiles) - tistep, tistep))
-    ticks.append(len(allFiles) - 1)
+    tistep = int(floor(len(timeAxis) / nticks))
+    ticks = list(range(tistep, len(timeAxis) - tistep, tistep))
+    ticks.append(len(timeAxis) - 1)
     ticks.insert(0, 0)
-    tlabels = timestamps[np.array(ticks)]
+    tlabels = timeAxis.slot_labels(ticks)
 
     axs[0].grid(axis="x")
-    axs[0].plot(region.intensityOverTime, color="red")
+    axs[0].plot(intensityOverTime, color="red")
     axs[0].set_ylabel("\nmm/h", fontsize=18)
     axs[0].set_xticklabels("")
     axs[0].set_xticks(ticks)
     axs[0].set_xticklabels(tlabels)
     axs[0].spines["bottom"].set_position("zero")
-    axs[0].set_xlim([0, len(region.intensityOverTime) - 1])
+    axs[0].set_xlim([0, len(intensityOverTime) - 1])
     axs[0].xaxis.set_tick_params(pad=18, labelsize=14)
-    axs[1].plot(region.sumOverTime)
-    indexes = list(range(0, len(region.sumOverTime)))
-    axs[1].fill_between(np.array(indexes), np.array(region.sumOverTime), interpolate=True)
+    axs[1].plot(sumOverTime)
+    indexes = list(range(0, len(sumOverTime)))
+    axs[1].fill_between(np.array(indexes), sumOverTime, interpolate=True)
     axs[1].set_ylabel("\nmm", fontsize=18)
     axs[1].set_xlabel("\nTime", fontsize=18)
     axs[1].set_xticks(ticks)
     axs[1].set_xticklabels(tlabels)
     axs[1].grid(axis="x")
-    axs[1].set_xlim([0, len(region.sumOverTime) - 1])
+    axs[1].set_xlim([0, len(sumOverTime) - 1])
     axs[1].xaxis.set_tick_params(pad=18, labelsize=14)
     axs[1].spines["bottom"].set_position("zero")
     fig.savefig(outFile)
@@ -116,11 +118,10 @@ def make_POH_series(region,allFiles,Dir):
     
     bname = region.bname
     fname = region.fbname
-    allFiles = np.sort(allFiles)
-    timestamps = np.array(list(map(fname2timestring, allFiles)))
-    all_POH_files = glob(os.path.join(Dir,"POH", "SingleFiles", "*.h5"))
+    timeAxis = region.timeAxis
+    all_POH_files = np.sort(glob(os.path.join(Dir,"POH", "SingleFiles", "*.h5")))
     outDir = os.path.join(Dir,region.name)
-    CrowdPath = os.path.join(Dir,"HailCrowdsource.csv")
+    crowd = _crowdsource_index(Dir, timeAxis)
     outFile = outDir + "/" + bname['eventCodeName'] + "-POH-timeserie.png"
 
     name = all_POH_files[0].rsplit('/', 1)[-1]
@@ -151,20 +152,22 @@ def make_POH_series(region,allFiles,Dir):
     )
 
     nticks = 5
-    tistep = int(floor(len(all_POH_files) / nticks))
-    ticks = list(range(tistep, len(all_POH_files) - tistep, tistep))
-    ticks.append(len(all_POH_files) - 1)
+    tistep = int(floor(len(timeAxis) / nticks))
+    ticks = list(range(tistep, len(timeAxis) - tistep, tistep))
+    ticks.append(len(timeAxis) - 1)
     ticks.insert(0, 0)
-    tlabels = timestamps[np.array(ticks)]
+    tlabels = timeAxis.slot_labels(ticks)
 
-    timeserie=make_timeserie(bname,fname)
+    # the POH files are placed on the time axis of the precipitation
+    POHslots = timeAxis.slot_of(parse_times(all_POH_files))
+    onAxis = POHslots >= 0
+    MaxPOHOverTime = np.zeros(len(timeAxis))
+    MaxPOHOverTime[POHslots[onAxis]] = np.nan_to_num(region.MaxPOHOverTime[onAxis])
 
     ax.grid(axis="x")
-    region.MaxPOHOverTime[np.isnan(region.MaxPOHOverTime) == True] = 0
-    xrange = range(len(region.MaxPOHOverTime))
+    xrange = range(len(MaxPOHOverTime))
 
-    ax.bar(xrange,region.MaxPOHOverTime, color="red", label="POH")
-    # ax.plot(timeserie, region.MaxPOHOverTime, color="red", label="POH")
+    ax.bar(xrange,MaxPOHOverTime, color="red", label="POH")
 
 
     ax.set_ylabel("\nMax probability of hail", fontsize=18)
@@ -172,10 +175,10 @@ def make_POH_series(region,allFiles,Dir):
     ax.set_xticks(ticks)
     ax.set_xticklabels(tlabels)
     ax.spines["bottom"].set_position("zero")
-    ax.set_xlim([0, len(region.MaxPOHOverTime) - 1])
+    ax.set_xlim([0, len(MaxPOHOverTime) - 1])
     ax.set_ylim([0, 1])
 
-    if os.path.exists(CrowdPath):
+    if crowd is not None and len(crowd):
         fig.suptitle(
             "Maximum POH and hail size over region "
             + region.name
@@ -198,15 +201,10 @@ def make_POH_series(region,allFiles,Dir):
             fontsize=22,
         )
 
-        df = pd.read_csv(CrowdPath)
-        df = select_coord(df,region)
-        df = nearest_5min(df)
-        df = df.groupby("time").max()
-        df = df.reset_index(drop=False)
-
-        POHseries = np.zeros(len(timeserie))
-        for i in range(0, len(df["time"])):
-            POHseries[timeserie == df["time"][i]] = df["hailsize"][i]
+        # largest report of every 5-min slot within the region
+        POHseries = crowd.max_per_slot(
+            timeAxis, rectangle=region.rectangle, geometry=region.geometry
+        )
         POHseries[POHseries == 0] = np.nan
 
         ax2 = ax.twinx()
@@ -242,5 +240,24 @@ def make_POH_series(region,allFiles,Dir):
     )
 
 
-
-    
\ No newline at end of file
+def _crowdsource_index(Dir, timeAxis):
+    """
+    Index of the hail reports of the event: the cached days in Dir/POH
+     (utils.crowdsource.load_day), or else a HailCrowdsource.csv.
+     None if there are no reports.
+    """
+    hail_dir = os.path.join(Dir, "POH")
+    days = crowdsource.event_days(timeAxis.times)
+    if any(
+        os.path.exists(crowdsource.prd_path(YYDOY, hail_dir))
+        or os.path.exists(crowdsource.cache_path(YYDOY, hail_dir))
+        for YYDOY in days
+    ):
+        return crowdsource.CrowdsourceIndex.from_days(days, hail_dir)
+    for path in (
+        os.path.join(Dir, "HailCrowdsource.csv"),
+        os.path.join(hail_dir, "HailCrowdsource.csv"),
+    ):
+        if os.path.exists(path):
+            return crowdsource.CrowdsourceIndex.from_csv(path)
+    return None
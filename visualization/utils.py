@@ -2,9 +2,9 @@
 Methods for visualizing data
 """
 import os
+from functools import lru_cache
 import numpy as np
 import pandas as pd
-from scipy.ndimage import uniform_filter
 
 from utils.transformation import coordx2ind, coordy2ind
 
@@ -49,6 +49,42 @@ def getRainscale(colorscale):
     return rainscale
 
 
+@lru_cache(maxsize=None)
+def get_rainscale_lut(colorscale):
+    """
+    Get the lookup table from 8-bit palette index to precipitation (mm/h).
+     The table is parsed from the color map file once and stored next to it
+     in binary form (.npy), which is reused as long as it is newer than
+     the color map file.
+
+    Args:
+    -----
+    colorscale: str
+     The path to the file containing the color map.
+
+    Returns:
+    --------
+    lut: ndarray
+     A float32 array with 256 entries, the value of palette index i is lut[i].
+     Indices missing in the color map are set to -1 (no data).
+    """
+    lutFile = os.path.splitext(colorscale)[0] + ".npy"
+    if os.path.exists(lutFile) and os.path.getmtime(lutFile) >= os.path.getmtime(
+        colorscale
+    ):
+        return np.load(lutFile)
+
+    rainscale = getRainscale(colorscale)
+    lut = np.full(256, -1.0, dtype=np.float32)
+    lut[rainscale[:, 0].astype(int)] = rainscale[:, 4]
+    try:
+        np.save(lutFile, lut)
+    except OSError:
+        # read-only installation, parse the color map again next time
+        pass
+    return lut
+
+
 def plotShapefile(shape, colour, ax, linewidth=1.0):
     """
     Plot a shapefile on a given axis.
@@ -102,13 +138,105 @@ def get_totalSum(totalDomainSum, rectangle, size):
     totalSum: ndarray
      The sum of the array within the specified rectangle.
     """
+    return WindowStats(totalDomainSum, rectangle, size).window_mean(size)
+
+
+class WindowStats(object):
+    """
+    Summed-area table of a 2-dimensional field over a rectangle plus a halo,
+     from which the mean over any n x n window centred on a pixel of the
+     rectangle is obtained with four lookups. The windows are the ones of
+     scipy.ndimage.uniform_filter(mode="constant"): values outside the
+     domain count as 0.
+
+    Attributes:
+    -----------
+    halo: int
+     Number of pixels added around the rectangle, windows up to
+     2 * halo + 1 pixels wide are supported.
+    shape: tuple
+     (y, x) shape of the rectangle.
+    """
 
-    totalSum = uniform_filter(totalDomainSum, size=size, mode="constant")
-    totalSum = totalSum[
-        coordy2ind(rectangle[3]) : coordy2ind(rectangle[2]),
-        coordx2ind(rectangle[0]) : coordx2ind(rectangle[1]),
-    ]
-    return totalSum
+    def __init__(self, totalDomainSum, rectangle, max_size):
+        """
+        Build the summed-area table
+
+        Args:
+        -----
+        totalDomainSum: ndarray
+         The 2-dimensional field over the whole domain.
+        rectangle: tuple
+         The rectangle as (xmin, xmax, ymin, ymax).
+        max_size: int
+         Largest window size that will be requested.
+        """
+        ny, nx = totalDomainSum.shape
+        y0, y1, __ = slice(coordy2ind(rectangle[3]), coordy2ind(rectangle[2])).indices(ny)
+        x0, x1, __ = slice(coordx2ind(rectangle[0]), coordx2ind(rectangle[1])).indices(nx)
+        self.shape = (max(y1 - y0, 0), max(x1 - x0, 0))
+        self.halo = max_size // 2
+        h = self.halo
+
+        field = np.zeros((self.shape[0] + 2 * h, self.shape[1] + 2 * h))
+        ya, yb = max(y0 - h, 0), min(y1 + h, ny)
+        xa, xb = max(x0 - h, 0), min(x1 + h, nx)
+        field[ya - y0 + h : yb - y0 + h, xa - x0 + h : xb - x0 + h] = totalDomainSum[
+            ya:yb, xa:xb
+        ]
+
+        self.sat = np.zeros((field.shape[0] + 1, field.shape[1] + 1))
+        np.cumsum(np.cumsum(field, axis=0), axis=1, out=self.sat[1:, 1:])
+
+    def window_mean(self, size):
+        """
+        Mean over the size x size window of every pixel of the rectangle.
+
+        Args:
+        -----
+        size: int
+         Window size in pixels (km), at most 2 * halo + 1.
+
+        Returns:
+        --------
+        mean: ndarray
+         Array with the shape of the rectangle.
+        """
+        if size // 2 > self.halo:
+            raise ValueError(f"window size {size} exceeds the halo of the table")
+        # same window offsets as uniform_filter, also for even sizes
+        lo = size // 2
+        hi = size - lo - 1
+        ny, nx = self.shape
+        r0, r1 = self.halo - lo, self.halo + hi + 1
+        sat = self.sat
+        total = (
+            sat[r1 : r1 + ny, r1 : r1 + nx]
+            - sat[r0 : r0 + ny, r1 : r1 + nx]
+            - sat[r1 : r1 + ny, r0 : r0 + nx]
+            + sat[r0 : r0 + ny, r0 : r0 + nx]
+        )
+        return (total / size**2).astype(np.float32)
+
+    def stats(self, sizes):
+        """
+        Minimum, maximum and mean of the window means within the rectangle.
+
+        Args:
+        -----
+        sizes: list
+         Window sizes in pixels (km).
+
+        Returns:
+        --------
+        stats: dict
+         (min, max, mean) per size.
+        """
+        stats = {}
+        for size in sizes:
+            mean = self.window_mean(size)
+            stats[size] = (np.nanmin(mean), np.nanmax(mean), np.nanmean(mean))
+        return stats
 
 
 def select_coord(df, region):
@@ -130,18 +258,15 @@ def select_coord(df, region):
      Dataframe containing only the rows with coordinates within the specified region.
     """
 
-    for i in range(0, len(df["xcoord"])):
-        x = df["xcoord"][i]
-        y = df["ycoord"][i]
-        if x >= region.rectangle[0] and x <= region.rectangle[1]:
-            pass
-        else:
-            df["xcoord"][i] = np.nan
-        if y >= region.rectangle[2] and y <= region.rectangle[3]:
-            pass
-        else:
-            df["ycoord"][i] = np.nan
-    df = df.dropna(axis=0)
+    x = df["xcoord"].to_numpy()
+    y = df["ycoord"].to_numpy()
+    inside = (
+        (x >= region.rectangle[0])
+        & (x <= region.rectangle[1])
+        & (y >= region.rectangle[2])
+        & (y <= region.rectangle[3])
+    )
+    df = df[inside].dropna(axis=0)
     df = df.reset_index(drop=True)
 
     return df